@@ -1,12 +1,29 @@
-import config, unittest
+import config, unittest, pickle
 
 
 class Block():
-  """A single voxel in the world and it's type."""
-  def __init__(self, block_type=None):
+  """A single voxel in the world and it's type. There is only ever one Block for each config.BlockType; Block(t) always returns that shared instance, so blocks can't be changed and can be compared by identity."""
+  __slots__ = ('block_type',)
+  __instances__ = {} # {config.BlockType: Block()}
+
+  def __new__(cls, block_type=None):
+    try:
+      return cls.__instances__[block_type]
+    except (KeyError, TypeError): pass
+
     if not isinstance(block_type, config.BlockType):
       raise ValueError("Invalid block type {}".format(block_type))
-    self.block_type = block_type
+    block = super(Block, cls).__new__(cls)
+    object.__setattr__(block, 'block_type', block_type)
+    cls.__instances__[block_type] = block
+    return block
+
+  def __setattr__(self, name, value):
+    raise AttributeError("Blocks are shared between every use of their type and can't be changed")
+
+  def __reduce__(self):
+    """Unpickle to the shared instance. Pickle memoizes it, so a chunk's worth of the same block only costs one reference each."""
+    return (Block, (self.block_type,))
 
   def __repr__(self):
     return self.__str__()
@@ -15,8 +32,10 @@ class Block():
     return str("A block of type {}".format(self.block_type))
 
   def __eq__(self, other):
-    if not isinstance(other, Block): return False
-    return self.block_type == other.block_type
+    return self is other
+
+  def __hash__(self):
+    return hash(self.block_type)
 
 
 class TestBlock(unittest.TestCase):
@@ -26,3 +45,11 @@ class TestBlock(unittest.TestCase):
     self.assertNotEqual(a, b)
     b = Block(config.BlockType.Grass)
     self.assertEqual(a, b)
+
+  def test_shared(self):
+    self.assertIs(Block(config.BlockType.Grass), Block(config.BlockType.Grass))
+    self.assertIs(pickle.loads(pickle.dumps(Block(config.BlockType.Water))), Block(config.BlockType.Water))
+    with self.assertRaises(AttributeError):
+      Block(config.BlockType.Grass).block_type = config.BlockType.Water
+    with self.assertRaises(ValueError):
+      Block('Grass')
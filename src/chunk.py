@@ -1,23 +1,85 @@
-import config, unittest, itertools
-from collections import defaultdict
+import config, unittest, itertools, pickle, struct
+import numpy as np
 from block import Block
 from hashlib import sha3_512
 
 
+BLOCK_TYPES = tuple(config.BlockType) # The config.BlockType for each block ID stored in a chunk. Empty must stay first so a zeroed array is an empty chunk.
+BLOCK_IDS = {t: i for i, t in enumerate(BLOCK_TYPES)} # The block ID stored in a chunk for each config.BlockType.
+BLOCKS = tuple(Block(t) for t in BLOCK_TYPES) # The shared Block() for each block ID.
+CHUNK_HEADER = struct.Struct('<BQ') # Chunk.to_bytes header: flags, bitmask of the sections that follow.
+CHUNK_VERSION = struct.Struct('<Q') # Chunk.get_version(), after the header if the HAS_VERSION flag is set. Chunks saved before it was added don't have it.
+IS_GENERATED = 1 # Chunk.to_bytes flag set when the chunk is generated.
+HAS_VERSION = 2 # Chunk.to_bytes flag set when the header is followed by the version.
+
+
 def default_block():
-    return Block(config.BlockType.Empty)
+    return BLOCKS[0]
+
+
+class PackedBlocks:
+    """A palette compressed array of block IDs. Stores the block IDs that are actually used and an index into that palette for every block, bit-packed to as few bits as the palette needs. A chunk with only one block type doesn't store any indices at all."""
+    def __init__(self, blocks):
+        """blocks: A numpy array of block IDs to compress."""
+        palette, indices = np.unique(blocks, return_inverse=True)
+        self.shape = blocks.shape
+        self.palette = palette.astype(np.uint8)
+        self.bits = (len(palette) - 1).bit_length() # 0 bits for 1 block type, 1 bit for 2, 2 bits for 3 or 4...
+        if self.bits == 0:
+            self.data = np.zeros(0, dtype=np.uint8)
+        else:
+            indices = indices.reshape(-1, 1).astype(np.uint8)
+            self.data = np.packbits(np.unpackbits(indices, axis=1)[:, 8-self.bits:])
+
+
+    def __eq__(self, other):
+        if not isinstance(other, PackedBlocks): return False
+        return np.array_equal(self.unpack(), other.unpack())
+
+
+    def unpack(self):
+        """Returns a new numpy array of the block IDs."""
+        if self.bits == 0:
+            return np.full(self.shape, self.palette[0], dtype=np.uint8)
+
+        count = int(np.prod(self.shape))
+        bits = np.unpackbits(self.data, count=count*self.bits).reshape(count, self.bits)
+        bits = np.pad(bits, ((0, 0), (8-self.bits, 0)))
+        indices = np.packbits(bits, axis=1).reshape(self.shape)
+        return self.palette[indices]
+
+
+    def nbytes(self):
+        """How many bytes the compressed blocks take up."""
+        return self.palette.nbytes + self.data.nbytes
 
 
 class Chunk:
-    """A chunk of blocks in the world. config.WorldDataServer.ChunkSize blocks in with and height. Also converts between Chunk:Block coordinates and absolute block coordinates."""
+    """A chunk of blocks in the world. config.WorldDataServer.ChunkSize blocks in with and height. Also converts between Chunk:Block coordinates and absolute block coordinates.
+    The blocks are split vertically into sections config.WorldDataServer.SectionHeight blocks tall. Sections without any blocks aren't stored at all, so they cost nothing to store, iterate, or send."""
     def __init__(self):
-        self.__blocks__ = defaultdict(default_block) # {(x, y, z): Block()}
+        self.__sections__ = [None] * Chunk.section_count() # Each is None when empty, a numpy array of block IDs indexed [x, y, z] (see BLOCK_TYPES), or PackedBlocks() while palette compressed.
+        self.__heightmap__ = np.full((config.WorldDataServer.ChunkSize, config.WorldDataServer.ChunkSize), -1, dtype=np.int16) # [x, z] = y of the top most non-empty block, -1 if the column is empty. None until rebuilt after unpickling.
+        self.__column_counts__ = np.zeros((config.WorldDataServer.ChunkSize, config.WorldDataServer.ChunkSize), dtype=np.uint16) # [x, z] = number of non-empty blocks in the column. None until rebuilt after unpickling.
+        self.__digest__ = None # Cached SHA3-512 hex digest of the blocks. None when it needs to be recalculated.
+        self.__version__ = 0 # Goes up by one every time the blocks change.
         self.__generated__ = False
 
 
     def __eq__(self, other):
+        """Chunks are equal if they have the same blocks. Compares the cached digests, so this is only slow the first time after a chunk changes."""
         if not isinstance(other, Chunk): return False
-        return self.__blocks__ == other.__blocks__
+        if self is other: return True
+        return self.digest() == other.digest()
+
+
+    def __getstate__(self):
+        """Palette compress the sections when pickling if config.WorldDataServer.ChunkStorage says so. This is what gets sent through the WorldDataServer pipes. Empty sections are never sent."""
+        state = self.__dict__.copy()
+        state['__sections__'] = Chunk.__compact_sections__(self.__sections__)
+        state['__heightmap__'] = None # Cheaper to rebuild than to send.
+        state['__column_counts__'] = None
+        return state
 
 
     def __repr__(self):
@@ -25,17 +87,18 @@ class Chunk:
 
 
     def __str__(self):
-        h = sha3_512()
-        for p, b in self.__blocks__.items():
-            h.update((p, b).__str__().encode())
-        h = h.hexdigest()[0:config.WorldDataServer.ChunkHexLength]
+        h = self.digest()[0:config.WorldDataServer.ChunkHexLength]
         return "Chunk: {}".format(h)
 
 
     def __iter__(self):
-        """Using `for p, b in Chunk()` will result in p being the position of a given chunk, and b being the block object for that position."""
-        for pos, block in self.__blocks__.items():
-            yield (pos, block)
+        """Using `for p, b in Chunk()` will result in p being the position of a given chunk, and b being the block object for that position. Empty blocks are skipped."""
+        for sy, section in self.sections():
+            xs, ys, zs = np.nonzero(section)
+            ids = section[xs, ys, zs]
+            ys += sy * config.WorldDataServer.SectionHeight
+            for x, y, z, i in zip(xs.tolist(), ys.tolist(), zs.tolist(), ids.tolist()):
+                yield ((x, y, z), BLOCKS[i])
 
 
     @classmethod
@@ -55,21 +118,129 @@ class Chunk:
             yield (bx, bz)
 
 
+    @classmethod
+    def section_count(cls):
+        """How many sections a chunk is split into."""
+        return -(-config.WorldDataServer.WorldHeight // config.WorldDataServer.SectionHeight)
+
+
+    @classmethod
+    def section_shape(cls, sy):
+        """The shape of the block ID array for section sy. The top section is shorter if WorldHeight isn't a multiple of SectionHeight."""
+        height = min(config.WorldDataServer.SectionHeight, config.WorldDataServer.WorldHeight - sy * config.WorldDataServer.SectionHeight)
+        return (config.WorldDataServer.ChunkSize, height, config.WorldDataServer.ChunkSize)
+
+
+    @classmethod
+    def __compact_sections__(cls, sections):
+        """Returns a copy of the sections list with empty sections removed and, if config.WorldDataServer.ChunkStorage is Palette, the rest palette compressed."""
+        pack = config.WorldDataServer.ChunkStorage is config.WorldDataServer.ChunkStorageModes.Palette
+        compact = []
+        for section in sections:
+            if isinstance(section, np.ndarray):
+                if not section.any():
+                    section = None
+                elif pack:
+                    section = PackedBlocks(section)
+            compact.append(section)
+        return compact
+
+
     @classmethod
     def __check_position__(cls, bx, by, bz):
         """Return True if a given position is a valid position in this chunk, else False"""
         if not 0 <= bx < config.WorldDataServer.ChunkSize:
             raise ValueError("X coordinate must be > 0 and < {}, not {}".format(config.WorldDataServer.ChunkSize, bx))
-        if not 0 <= by < config.WorldDataServer.WorldHeight+1:
+        if not 0 <= by < config.WorldDataServer.WorldHeight:
             raise ValueError("Y coordinate must be > 0 and < {}, not {}".format(config.WorldDataServer.WorldHeight, by))
         if not 0 <= bz < config.WorldDataServer.ChunkSize:
             raise ValueError("Z coordinate must be > 0 and < {}, not {}".format(config.WorldDataServer.ChunkSize, bz))
 
 
+    def get_section(self, sy, create=False):
+        """Get the array of block IDs for section sy, indexed [x, y, z] relative to the bottom of the section. Unpacks the section if it is palette compressed.
+        create: If True, an empty section is allocated instead of returning None."""
+        section = self.__sections__[sy]
+        if isinstance(section, PackedBlocks):
+            section = section.unpack()
+            self.__sections__[sy] = section
+        elif section is None and create:
+            section = np.zeros(Chunk.section_shape(sy), dtype=np.uint8)
+            self.__sections__[sy] = section
+        return section
+
+
+    def sections(self, cache=True):
+        """Iterate through (sy, array of block IDs) for every section that has been allocated. Missing sections are skipped.
+        cache: If False, palette compressed sections are unpacked into temporary arrays and stay compressed in the chunk. Use this for read only passes."""
+        for sy in range(len(self.__sections__)):
+            section = self.__sections__[sy]
+            if section is None: continue
+            if cache:
+                yield (sy, self.get_section(sy))
+            elif isinstance(section, PackedBlocks):
+                yield (sy, section.unpack())
+            else:
+                yield (sy, section)
+
+
+    def to_bytes(self):
+        """Serialize the chunk into bytes for storing outside of Python: A header saying whether it is generated and which sections there are and the version, followed by the block IDs of each of those sections.
+        The version is kept so a chunk that is compressed or saved and loaded again still has a get_version() no lower than before."""
+        mask = 0
+        data = []
+        for sy, section in self.sections(cache=False):
+            if not section.any(): continue
+            mask |= 1 << sy
+            data.append(np.ascontiguousarray(section).tobytes())
+        flags = HAS_VERSION | (IS_GENERATED if self.__generated__ else 0)
+        return CHUNK_HEADER.pack(flags, mask) + CHUNK_VERSION.pack(self.__version__) + b''.join(data)
+
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Create a chunk from what to_bytes returned. Chunks saved without a version start at 0."""
+        flags, mask = CHUNK_HEADER.unpack_from(data)
+        offset = CHUNK_HEADER.size
+        version = 0
+        if flags & HAS_VERSION:
+            version = CHUNK_VERSION.unpack_from(data, offset)[0]
+            offset += CHUNK_VERSION.size
+        blocks = np.frombuffer(bytearray(data[offset:]), dtype=np.uint8) # One copy so the sections can be changed.
+        sections = [None] * cls.section_count()
+        offset = 0
+        for sy in range(len(sections)):
+            if not mask & (1 << sy): continue
+            shape = cls.section_shape(sy)
+            size = shape[0] * shape[1] * shape[2]
+            sections[sy] = blocks[offset:offset+size].reshape(shape)
+            offset += size
+        return cls.from_sections(sections, bool(flags & IS_GENERATED), version)
+
+
+    @classmethod
+    def from_sections(cls, sections, generated, version=0):
+        """Create a chunk that uses the given section arrays as is, without copying them.
+        sections: A list of Chunk.section_count() arrays of block IDs or None for empty sections.
+        generated: What is_generated() should return.
+        version: The version of the chunk the sections came from."""
+        chunk = cls()
+        chunk.__sections__ = list(sections)
+        chunk.__heightmap__ = None
+        chunk.__column_counts__ = None
+        chunk.__version__ = version
+        chunk.__generated__ = generated
+        return chunk
+
+
     def get_block(self, x, y, z):
         """Get the Block() at block position relative to chunk's SW corner."""
         Chunk.__check_position__(x, y, z)
-        return self.__blocks__[(x, y, z)]
+        sy, y = divmod(y, config.WorldDataServer.SectionHeight)
+        section = self.get_section(sy)
+        if section is None:
+            return default_block()
+        return BLOCKS[section[x, y, z]]
 
 
     def set_block(self, x, y, z, block):
@@ -80,15 +251,193 @@ class Chunk:
         Chunk.__check_position__(x, y, z)
         if not isinstance(block, Block):
             raise TypeError("Must be a Block object")
-        self.__blocks__[(x, y, z)] = block
+        sy, sby = divmod(y, config.WorldDataServer.SectionHeight)
+        block_id = BLOCK_IDS[block.block_type]
+        section = self.get_section(sy, create=block_id != 0)
+        if section is None: return
+        old_id = section[x, sby, z]
+        if old_id == block_id: return
+        heightmap, counts = self.__column_index__() # Has to be rebuilt before the block changes if it was dropped, or the change is counted twice.
+        section[x, sby, z] = block_id
+        self.touch()
+
+        if (old_id == 0) == (block_id == 0): return
+        if block_id != 0:
+            counts[x, z] += 1
+            if y > heightmap[x, z]:
+                heightmap[x, z] = y
+        else:
+            counts[x, z] -= 1
+            if y == heightmap[x, z]:
+                heightmap[x, z] = self.__column_top__(x, z)
+
+
+    def set_blocks(self, positions, ids):
+        """Set many blocks at once with numpy instead of calling set_block for each of them.
+        positions: An (n, 3) array of block positions relative to chunk's SW corner.
+        ids: An (n,) array of the block IDs to put at them. See BLOCK_TYPES.
+        Returns a delta of only the blocks that changed: (positions as an (n, 3) uint16 array, block IDs as a uint8 array). Calling set_blocks(*delta) on another copy of this chunk makes the same change.
+        Nothing is changed if any of the positions are outside the chunk. The chunk is only marked as generated if a block changed."""
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+        ids = np.asarray(ids, dtype=np.uint8).reshape(-1)
+        for bx, by, bz in (positions.min(axis=0), positions.max(axis=0)) if len(positions) > 0 else ():
+            Chunk.__check_position__(bx, by, bz)
+
+        changed = np.zeros(len(ids), dtype=bool)
+        all_sy, all_sby = np.divmod(positions[:, 1], config.WorldDataServer.SectionHeight)
+        for sy in np.unique(all_sy).tolist():
+            mask = all_sy == sy
+            section = self.get_section(sy, create=bool(ids[mask].any()))
+            if section is None: continue # Only empty blocks going into an empty section.
+            index = (positions[mask, 0], all_sby[mask], positions[mask, 2])
+            changed[mask] = section[index] != ids[mask]
+            section[index] = ids[mask]
+
+        if changed.any():
+            self.__generated__ = True
+            self.__heightmap__ = None # Rebuilt the next time it's needed.
+            self.__column_counts__ = None
+            self.touch()
+        return (positions[changed].astype(np.uint16), ids[changed])
+
+
+    def fill_columns(self, bottoms, tops, block):
+        """Fill every column from y = bottoms[x, z] up to but not including tops[x, z] with block. Each section is filled with one array assignment instead of calling set_block for every block, so this is how generators should build chunks.
+        bottoms, tops: Arrays indexed [x, z], or numbers to use for every column. They are clipped to the height of the world.
+        block: The Block() to fill the columns with.
+        The chunk is marked as generated even if no blocks change."""
+        if not isinstance(block, Block):
+            raise TypeError("Must be a Block object")
+        self.__generated__ = True
+        shape = (config.WorldDataServer.ChunkSize, config.WorldDataServer.ChunkSize)
+        bottoms = np.clip(np.broadcast_to(bottoms, shape), 0, config.WorldDataServer.WorldHeight).astype(np.int64)
+        tops = np.clip(np.broadcast_to(tops, shape), 0, config.WorldDataServer.WorldHeight).astype(np.int64)
+        tops = np.maximum(tops, bottoms)
+        filled = tops > bottoms
+        if not filled.any(): return
+
+        was_empty = all(section is None for section in self.__sections__)
+        block_id = BLOCK_IDS[block.block_type]
+        for sy in range(int(bottoms[filled].min()) // config.WorldDataServer.SectionHeight, (int(tops.max()) - 1) // config.WorldDataServer.SectionHeight + 1):
+            ys = sy * config.WorldDataServer.SectionHeight + np.arange(Chunk.section_shape(sy)[1])[None, :, None]
+            mask = (ys >= bottoms[:, None, :]) & (ys < tops[:, None, :])
+            if not mask.any(): continue
+            section = self.get_section(sy, create=block_id != 0)
+            if section is None: continue
+            section[mask] = block_id
+
+        if was_empty and block_id != 0: # The column index is just the fill.
+            self.__heightmap__ = np.where(filled, tops - 1, -1).astype(np.int16)
+            self.__column_counts__ = (tops - bottoms).astype(np.uint16)
+        else:
+            self.__heightmap__ = None # Rebuilt the next time it's needed.
+            self.__column_counts__ = None
+        self.touch()
+
+
+    def mark_generated(self):
+        """Make is_generated() True without changing any blocks, for generators that leave a chunk empty."""
+        self.__generated__ = True
+
+
+    def __column_index__(self):
+        """Returns (heightmap, column_counts), rebuilding them from the sections if they were dropped when pickling."""
+        if self.__heightmap__ is None:
+            heightmap = np.full((config.WorldDataServer.ChunkSize, config.WorldDataServer.ChunkSize), -1, dtype=np.int16)
+            counts = np.zeros((config.WorldDataServer.ChunkSize, config.WorldDataServer.ChunkSize), dtype=np.uint16)
+            for sy, section in self.sections(cache=False): # Don't keep them unpacked, the server only wants the heightmap.
+                filled = section != 0
+                counts += filled.sum(axis=1, dtype=np.uint16)
+                top = section.shape[1] - 1 - np.argmax(filled[:, ::-1, :], axis=1) + sy * config.WorldDataServer.SectionHeight
+                heightmap = np.where(filled.any(axis=1), top, heightmap).astype(np.int16) # Sections go bottom to top, so higher sections win.
+            self.__heightmap__ = heightmap
+            self.__column_counts__ = counts
+        return (self.__heightmap__, self.__column_counts__)
+
+
+    def __column_top__(self, bx, bz):
+        """Scan down column (bx, bz) for the top most non-empty block. Returns its y, or -1 if the column is empty."""
+        if self.__column_counts__[bx, bz] == 0: return -1
+        for sy in reversed(range(len(self.__sections__))):
+            if self.__sections__[sy] is None: continue
+            filled = np.flatnonzero(self.get_section(sy)[bx, :, bz])
+            if len(filled) > 0:
+                return sy * config.WorldDataServer.SectionHeight + int(filled[-1])
+        return -1
+
+
+    def get_heightmap(self):
+        """Get the array of the top most non-empty block's y for every column, indexed [x, z]. Empty columns are -1. Don't change it."""
+        return self.__column_index__()[0]
+
+
+    def get_height(self, bx, bz):
+        """Get the y of the top most non-empty block in column (bx, bz), or -1 if the column is empty."""
+        return int(self.__column_index__()[0][bx, bz])
+
+
+    def column_block_count(self, bx, bz):
+        """Get the number of non-empty blocks in column (bx, bz)."""
+        return int(self.__column_index__()[1][bx, bz])
+
+
+    def digest(self):
+        """Get the SHA3-512 hex digest of the blocks in this chunk. It is cached until the chunk changes. Empty sections hash the same whether or not they are allocated."""
+        if self.__digest__ is None:
+            h = sha3_512()
+            for sy, section in self.sections(cache=False):
+                if not section.any(): continue
+                h.update(sy.to_bytes(4, 'little'))
+                h.update(section.tobytes())
+            self.__digest__ = h.hexdigest()
+        return self.__digest__
+
+
+    def get_version(self):
+        """Get the version of this chunk. It goes up every time a block changes, so comparing versions is a cheap way to see if a chunk changed."""
+        return self.__version__
+
+
+    def set_version(self, version):
+        """Make get_version() return version, for a chunk made again from something that doesn't keep its blocks, like a procedural.ProceduralChunk."""
+        self.__version__ = version
+
+
+    def touch(self):
+        """Mark the blocks as changed. Bumps the version and drops the cached digest. Call this after writing to a section array directly."""
+        self.__version__ += 1
+        self.__digest__ = None
+
+
+    def get_blocks(self):
+        """Get a new array of all the block IDs for this chunk, indexed [x, y, z]. See BLOCK_TYPES for what each ID is. Changing it doesn't change the chunk."""
+        blocks = np.zeros((config.WorldDataServer.ChunkSize, config.WorldDataServer.WorldHeight, config.WorldDataServer.ChunkSize), dtype=np.uint8)
+        for sy, section in self.sections():
+            y = sy * config.WorldDataServer.SectionHeight
+            blocks[:, y:y+section.shape[1]] = section
+        return blocks
+
+
+    def pack(self):
+        """Drop empty sections and, if config.WorldDataServer.ChunkStorage is Palette, palette compress the rest to save memory. They are unpacked again the next time they are used."""
+        self.__sections__ = Chunk.__compact_sections__(self.__sections__)
+
+
+    def is_packed(self):
+        """True if any section is currently palette compressed."""
+        return any(isinstance(s, PackedBlocks) for s in self.__sections__)
 
 
     def get_column(self, bx, by):
-        """Get a dict of all the blocks in the requested column."""
+        """Get a dict of all the non-empty blocks in the requested column."""
         column = {}
-        for (bx1, by1, bz1), b in self:
-            if (bx, by) == (bx1, by1):
-                column[(bx1, by1, bz1)] = b
+        sy, y = divmod(by, config.WorldDataServer.SectionHeight)
+        section = self.get_section(sy)
+        if section is None:
+            return column
+        ids = section[bx, y]
+        for bz in np.nonzero(ids)[0].tolist():
+            column[(bx, by, bz)] = BLOCKS[ids[bz]]
         return column
 
 
@@ -146,10 +495,115 @@ class TestChunk(unittest.TestCase):
         a = Chunk()
         b = Chunk()
         self.assertEqual(a, b)
-        a.__blocks__[(0, 0, 0)] = Block(config.BlockType.Grass)
+        a.set_block(0, 0, 0, Block(config.BlockType.Grass))
         self.assertNotEqual(a, b)
 
 
+    def test_digest_version(self):
+        chunk = Chunk()
+        empty = chunk.digest()
+        self.assertEqual(chunk.get_version(), 0)
+        chunk.set_block(0, 20, 0, Block(config.BlockType.Grass))
+        self.assertEqual(chunk.get_version(), 1)
+        self.assertNotEqual(chunk.digest(), empty)
+        chunk.set_block(0, 20, 0, Block(config.BlockType.Grass))
+        self.assertEqual(chunk.get_version(), 1)
+        chunk.set_block(0, 20, 0, Block(config.BlockType.Empty))
+        self.assertEqual(chunk.get_version(), 2)
+        self.assertEqual(chunk.digest(), empty)
+
+
+    def test_pickle(self):
+        chunk = Chunk()
+        chunk.set_block(1, 2, 3, Block(config.BlockType.Grass))
+        chunk.set_block(3, 2, 1, Block(config.BlockType.Water))
+        res = pickle.loads(pickle.dumps(chunk))
+        self.assertEqual(chunk, res)
+        self.assertTrue(res.is_generated())
+        self.assertEqual(res.get_block(3, 2, 1), Block(config.BlockType.Water))
+
+
+    def test_to_bytes(self):
+        chunk = Chunk()
+        chunk.set_block(1, 2, 3, Block(config.BlockType.Grass))
+        chunk.set_block(3, 200, 1, Block(config.BlockType.Water))
+        res = Chunk.from_bytes(chunk.to_bytes())
+        self.assertEqual(chunk, res)
+        self.assertTrue(res.is_generated())
+        self.assertEqual(len(list(res.sections())), 2)
+        self.assertEqual(res.get_version(), chunk.get_version())
+        res.set_block(1, 2, 3, Block(config.BlockType.Empty))
+        self.assertFalse(Chunk.from_bytes(Chunk().to_bytes()).is_generated())
+
+        # Saved before the version was.
+        old = CHUNK_HEADER.pack(IS_GENERATED, 1) + bytes(Chunk.section_shape(0)[0] * Chunk.section_shape(0)[1] * Chunk.section_shape(0)[2])
+        res = Chunk.from_bytes(old)
+        self.assertTrue(res.is_generated())
+        self.assertEqual(res.get_version(), 0)
+
+
+    def test_pack(self):
+        orig = config.WorldDataServer.ChunkStorage
+        config.WorldDataServer.ChunkStorage = config.WorldDataServer.ChunkStorageModes.Palette
+
+        try:
+            chunk = Chunk()
+            chunk.set_block(1, 2, 3, Block(config.BlockType.Grass))
+            chunk.pack()
+            self.assertTrue(chunk.is_packed())
+            self.assertEqual(chunk.get_block(1, 2, 3), Block(config.BlockType.Grass))
+            self.assertFalse(chunk.is_packed())
+
+            res = pickle.loads(pickle.dumps(chunk))
+            self.assertTrue(res.is_packed())
+            self.assertEqual(chunk, res)
+        finally:
+            config.WorldDataServer.ChunkStorage = orig
+
+
+    def test_sections(self):
+        chunk = Chunk()
+        self.assertEqual(list(chunk.sections()), [])
+        top = config.WorldDataServer.WorldHeight - 1
+        chunk.set_block(0, top, 0, Block(config.BlockType.Grass))
+        chunk.set_block(0, 0, 0, Block(config.BlockType.Empty))
+        self.assertEqual([sy for sy, _ in chunk.sections()], [Chunk.section_count() - 1])
+        self.assertEqual(list(chunk), [((0, top, 0), Block(config.BlockType.Grass))])
+
+        chunk.set_block(0, top, 0, Block(config.BlockType.Empty))
+        chunk.pack()
+        self.assertEqual(list(chunk.sections()), [])
+        self.assertEqual(chunk, Chunk())
+
+
+    def test_heightmap(self):
+        chunk = Chunk()
+        grass = Block(config.BlockType.Grass)
+        empty = Block(config.BlockType.Empty)
+        self.assertEqual(chunk.get_height(1, 2), -1)
+        chunk.set_block(1, 3, 2, grass)
+        chunk.set_block(1, 40, 2, grass)
+        self.assertEqual(chunk.get_height(1, 2), 40)
+        self.assertEqual(chunk.column_block_count(1, 2), 2)
+        chunk.set_block(1, 40, 2, empty)
+        self.assertEqual(chunk.get_height(1, 2), 3)
+        chunk.set_block(1, 40, 2, grass)
+
+        res = pickle.loads(pickle.dumps(chunk)) # Edit before anything rebuilds the column index.
+        res.set_block(1, 40, 2, empty)
+        self.assertEqual(res.column_block_count(1, 2), 1)
+        self.assertEqual(res.get_height(1, 2), 3)
+        res.set_block(1, 40, 2, grass)
+
+        res = pickle.loads(pickle.dumps(chunk))
+        self.assertTrue(np.array_equal(chunk.get_heightmap(), res.get_heightmap()))
+        self.assertEqual(res.column_block_count(1, 2), 2)
+        res.set_block(1, 3, 2, empty)
+        res.set_block(1, 40, 2, empty)
+        self.assertEqual(res.get_height(1, 2), -1)
+        self.assertEqual(res.column_block_count(1, 2), 0)
+
+
     def test_setget(self):
         chunk = Chunk()
         block = Block(config.BlockType.Grass)
@@ -160,6 +614,71 @@ class TestChunk(unittest.TestCase):
         self.assertNotEqual(block, res)
 
 
+    def test_set_blocks(self):
+        chunk = Chunk()
+        chunk.set_block(1, 2, 3, Block(config.BlockType.Grass))
+        chunk.pack()
+        grass, water = BLOCK_IDS[config.BlockType.Grass], BLOCK_IDS[config.BlockType.Water]
+        version = chunk.get_version()
+        delta = chunk.set_blocks([(1, 2, 3), (4, 200, 5), (6, 7, 8)], [grass, water, 0])
+        self.assertEqual(delta[0].tolist(), [[4, 200, 5]])
+        self.assertEqual(delta[1].tolist(), [water])
+        self.assertGreater(chunk.get_version(), version)
+        self.assertEqual(chunk.get_block(4, 200, 5), Block(config.BlockType.Water))
+        self.assertEqual(chunk.get_height(4, 5), 200)
+
+        copy = Chunk()
+        copy.set_block(1, 2, 3, Block(config.BlockType.Grass))
+        copy.set_blocks(*delta)
+        self.assertEqual(copy, chunk)
+
+        version = chunk.get_version()
+        self.assertEqual(len(chunk.set_blocks([(4, 200, 5)], [water])[1]), 0)
+        self.assertEqual(chunk.get_version(), version)
+        with self.assertRaises(ValueError):
+            chunk.set_blocks([(0, config.WorldDataServer.WorldHeight, 0)], [grass])
+
+        empty = Chunk()
+        self.assertEqual(len(empty.set_blocks([(1, 2, 3)], [0])[1]), 0)
+        self.assertFalse(empty.is_generated())
+        with self.assertRaises(ValueError):
+            empty.set_blocks([(1, 2, 3), (-1, 2, 3)], [grass, grass])
+        self.assertFalse(empty.is_generated())
+        self.assertEqual(empty.get_block(1, 2, 3), Block(config.BlockType.Empty))
+
+
+    def test_fill_columns(self):
+        rng = np.random.default_rng(4)
+        size = config.WorldDataServer.ChunkSize
+        tops = rng.integers(-3, config.WorldDataServer.WorldHeight + 3, (size, size))
+        bottoms = tops - 5
+        grass = Block(config.BlockType.Grass)
+
+        chunk = Chunk()
+        chunk.fill_columns(bottoms, tops, grass)
+        correct = Chunk()
+        for bx, bz in Chunk.all_columns():
+            for by in range(max(0, bottoms[bx, bz]), min(tops[bx, bz], config.WorldDataServer.WorldHeight)):
+                correct.set_block(bx, by, bz, grass)
+        self.assertEqual(chunk, correct)
+        self.assertTrue(np.array_equal(chunk.get_heightmap(), correct.get_heightmap()))
+        self.assertEqual(chunk.column_block_count(3, 4), correct.column_block_count(3, 4))
+
+        version = chunk.get_version()
+        chunk.fill_columns(0, 1, Block(config.BlockType.Water))
+        self.assertGreater(chunk.get_version(), version)
+        self.assertEqual(chunk.get_block(0, 0, 0), Block(config.BlockType.Water))
+        self.assertEqual(chunk.get_height(0, 0), max(0, min(tops[0, 0], config.WorldDataServer.WorldHeight) - 1))
+
+        empty = Chunk()
+        empty.fill_columns(0, 0, grass)
+        self.assertTrue(empty.is_generated())
+        self.assertEqual(empty, Chunk())
+        blank = Chunk()
+        blank.mark_generated()
+        self.assertTrue(blank.is_generated())
+
+
     def test_get_column(self):
         orig = config.WorldDataServer.WorldHeight
         config.WorldDataServer.WorldHeight = 3
@@ -190,3 +709,22 @@ class TestChunk(unittest.TestCase):
                 for z in range(config.WorldDataServer.ChunkSize):
                     corr.append((x, y, z))
         self.assertCountEqual(corr, all_positions)
+
+
+
+class TestPackedBlocks(unittest.TestCase):
+    def test_bits(self):
+        blocks = np.zeros((4, 4, 4), dtype=np.uint8)
+        self.assertEqual(PackedBlocks(blocks).bits, 0)
+        blocks[0, 0, 0] = BLOCK_IDS[config.BlockType.Grass]
+        self.assertEqual(PackedBlocks(blocks).bits, 1)
+        blocks[0, 0, 1] = BLOCK_IDS[config.BlockType.Water]
+        self.assertEqual(PackedBlocks(blocks).bits, 2)
+
+
+    def test_unpack(self):
+        rng = np.random.default_rng(0)
+        for types in (1, 2, 3, 5, 17):
+            blocks = rng.integers(0, types, size=(5, 7, 3), dtype=np.uint8)
+            res = PackedBlocks(blocks).unpack()
+            self.assertTrue(np.array_equal(blocks, res), "Failed with {} block types".format(types))
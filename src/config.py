@@ -50,10 +50,14 @@ class WorldGenerator:
     InitialDistance = Game.InitialGeneration # radius of chunks to generate when starting the game.
     Processes = 4 # Number of processes generating chunks in parallel.
     WaitTime = 1 # Specifies how long, in seconds, the generator slaves should wait for requests before checking if they should exit.
-    RequestQueueSize = 1024 # Number of chunks that can be requested before old requests are removed.
+    TaskSize = 4 # Chunks are generated in TaskSize by TaskSize squares. Requesting any chunk in a square queues the whole square as one task, so its noise is made in one call and it is claimed and initialized with one request each.
+    BatchSize = 1 # Max number of queued tasks a generator slave takes at once.
+    RequestQueueSize = 1024 # Number of tasks that can be requested before old requests are removed.
     RecentlyRequested = 10 # Number of seconds to store recently requested chunks. This is used to avoid two GenerationSlaves generating the same chunk more than once.
     GarbageCollectionInterval = 1.0 # Once every how many seconds should we clear out the recently requested chunk list.
     MaxRecentChunksStored = 4096 # How many chunks should be stored if the list isn't being cleared quick enough?
+    Procedural = True # Send chunks from generators with Generation.PROCEDURAL to the WorldDataServer as procedural.ProceduralChunks, so it can drop their blocks when they aren't used and make them again when they are.
+    SendBlocks = True # Generate the blocks of ProceduralChunks before sending them anyway, so the WorldDataServer doesn't have to when the chunk is first used. If False, generation slaves only send the ProceduralChunk and the server makes the blocks.
     Seed = random.random()
 
 
@@ -69,27 +73,61 @@ class WorldRenderer:
     Distance = Game.ViewDistance # Radius of chunks to render around the player.
     InitialDistance = Game.InitialGeneration
     LogLevel = logging.ERROR
-    MaxQueuedChunks = 16
+    MaxQueuedChunks = 1024 # Max number of chunks waiting to be rendered. Enough for every chunk in Distance, so none are dropped while the player stands still.
     MaxFinishedChunks = 16 # This should be low enough that there is no noticable delay when drawing. It will then stop the renderer for that frame. It is essentially the main bottle neck in speed of rendering chunks, how many can we deal with on the main thread in a single frame without stuttering issues.
     WaitTime = 1 # Specifies how long, in seconds, the renderer should wait for requests before checking if it should exit.
     TrashChunksOnFullFinishedQueue = 1 # Throw out the data for this many chunks if the finished data queue is full. This is intended to ensure that chunks being rendered are not too old and unneeded.
     MaxBlocksPerFrame = 400 # Max number of blocks to add to the pyglet batch every frame. This results in a chunk being rendered over many frames to stop stuttering issues.
     BatchAddMode = BatchAddModes.Nonindexed # Which call to use when adding to pyglet.graphics.Batch.
     PutFinishedChunkTimeout = 2
+    PendingWaitTime = 0.05 # How long, in seconds, the renderer waits for requests before checking for generated chunks while some chunks are waiting to be generated.
 
 
 class WorldDataServer:
+    class WireProtocols(Enum):
+        Pickle = 'pickle' # Pickle the whole (request, data, request ID) tuple.
+        Binary = 'binary' # A fixed size header plus pickle protocol 5 with out-of-band buffers. See world_protocol.py.
+
+    class ChunkStorageModes(Enum):
+        Dense = 'dense' # One byte per block. Fastest to access but the biggest.
+        Palette = 'palette' # Only the block types a chunk uses, with bit-packed indices into them. Much smaller when sent between processes or stored.
+
     LogLevel = logging.ERROR
     MainConnectionName = 'Main'
     RandomIDLength = 5
     ConnectionWaitTime = 1 # Specifies how long, in seconds, the server should wait for requests before checking if it should exit.
+    EventFlushTime = 0.01 # How long, in seconds, the server waits for requests instead while chunk events are queued for a client whose pipe is full.
+    MaxQueuedEvents = 100000 # How many chunk events can wait for a client whose pipe is full before it is unsubscribed.
     ChunkSize = 32
     ChunkHexLength = 6 # This is 1-512. It trims a SHA 512 hash to this length to compare and print chunks.
     WorldHeight = 256
+    SectionHeight = 16 # Chunks are split vertically into sections this many blocks tall. Sections with no blocks in them aren't stored.
+    ChunkStorage = ChunkStorageModes.Palette # How chunks are stored in the WorldDataServer and sent through pipes.
+    WireProtocol = WireProtocols.Binary # How requests and replies are written to the pipes.
+    SharedMemory = True # Send chunks to clients through multiprocessing.shared_memory instead of pickling them through the pipe.
+    SharedPagesPerSegment = 256 # How many chunk sections fit in each shared memory segment. A section takes 16 KB.
+    MaxSharedPages = 4096 # Max number of chunk sections each shard keeps in shared memory (64 MB). Once it is reached, the pages of the chunks least recently sent are reused. None for no limit. Must be at least Chunk.section_count().
+    SaveDirectory = 'world' # Directory to save the world in so it is kept between runs. None keeps the world only in RAM.
+    SaveInterval = 10 # Once every how many seconds changed chunks are written to the SaveDirectory. They are always written when the server stops.
+    RegionSize = 8 # Width and height in chunks of the area each region file in the SaveDirectory holds. Regions are also how chunks are split between Shards, so this should be well below the view distance.
+    RegionCompression = 6 # zlib compression level for chunks in region files.
+    Shards = 2 # Number of WorldDataServer processes the world is split between, so requests for different regions are handled in parallel. See ShardedWorldDataServer.
+    MaxResidentChunks = 4096 # Most chunks each shard keeps decoded in RAM. The least recently used ones are compressed into the cold chunks after that. None keeps every chunk decoded.
+    ColdChunkAge = 30 # Seconds since a chunk was last used before it is compressed into the cold chunks. None only compresses chunks past MaxResidentChunks.
+    MaxColdChunks = 32768 # Most compressed chunks each shard keeps in RAM. The least recently used ones are written to the SaveDirectory and dropped after that. None (or no SaveDirectory) keeps every chunk.
+    ColdCompression = 1 # zlib compression level for cold chunks. Generated terrain compresses well even at the fastest level.
+    ClaimTimeout = 30 # Seconds a client's claim on a chunk lasts if it doesn't initialize the chunk, so chunks claimed by a crashed generator are generated by another one.
+
+
+class Metrics:
+    HistogramBuckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5) # Upper bounds, in seconds, of the request latency histogram buckets.
+    DumpInterval = 60 # Once every how many seconds the WorldDataServer and WorldDataClients write their request metrics to their log. None never does.
+    DumpLevel = logging.INFO # The log level the metrics are written at.
 
 
 class WorldDataClient:
     LogLevel = logging.ERROR
+    CacheSize = 256 # Most chunks each client keeps in its read cache, so chunks that didn't change aren't sent again. 0 turns the cache off.
 
 
 @unique
@@ -104,6 +142,18 @@ class WorldRequests(Enum):
     InitChunkReq = 'init_chunk'
     DuplicateInit = 'dupe_init_chunk'
     IsGenerated = 'is_generated'
+    GetHeightmapReq = 'get_heightmap'
+    GetChunksReq = 'get_chunks'
+    InitChunksReq = 'init_chunks'
+    IsGeneratedManyReq = 'is_generated_many'
+    SubscribeReq = 'subscribe'
+    UnsubscribeReq = 'unsubscribe'
+    ChunkEventMsg = 'chunk_event' # Sent by the server to subscribed clients without being requested.
+    StatsReq = 'stats'
+    GetBlockReq = 'get_block'
+    SetBlockReq = 'set_block'
+    SetBlocksReq = 'set_blocks'
+    ClaimChunksReq = 'claim_chunks'
 
 @unique
 class WorldRequestData(Enum):
@@ -114,6 +164,30 @@ class WorldRequestData(Enum):
     ChunkPos = 'chunk_pos'
     ChunkData = 'chunk_data'
     Boolean = 'boolean'
+    Heightmap = 'heightmap'
+    SharedChunk = 'shared_chunk'
+    ChunkPositions = 'chunk_positions' # [(cx, cy), ...]
+    Chunks = 'chunks' # {(cx, cy): Chunk()}
+    SharedChunks = 'shared_chunks' # {(cx, cy): SharedChunkHandle()}
+    Results = 'results' # {(cx, cy): result for that chunk}
+    Events = 'events' # [config.ChunkEvents, ...]
+    ChunkEvent = 'chunk_event' # config.ChunkEvents
+    Versions = 'versions' # {(cx, cy): world_data.chunk_version()} of the chunks a client already has.
+    Unchanged = 'unchanged' # [(cx, cy), ...] chunks that still match the Versions the client sent, so they aren't sent again.
+    Stats = 'stats' # metrics.RequestMetrics.snapshot() of the server with its cache_stats() and shard number added.
+    BlockPos = 'block_pos' # (abx, aby, abz)
+    BlockData = 'block_data' # Block()
+    BlockChanges = 'block_changes' # [((abx, aby, abz), Block()), ...]
+    Delta = 'delta' # Chunk.set_blocks() delta for one chunk.
+    Deltas = 'deltas' # {(cx, cy): Chunk.set_blocks() delta}
+
+
+@unique
+class ChunkEvents(Enum):
+    Generated = 'generated' # A chunk was set or initialized for the first time.
+    Modified = 'modified' # A generated chunk was set again.
+    Evicted = 'evicted' # A chunk was dropped from the WorldDataServer's RAM.
+    Edited = 'edited' # Blocks in a chunk were changed in place with set_block(s). Sent with the delta.
 
 
 @unique
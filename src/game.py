@@ -5,6 +5,7 @@ import config
 import world_data
 import player
 import world_generator
+import region_files
 import block
 import math
 import os
@@ -53,6 +54,7 @@ class Game(pyglet.window.Window):
     self.log.info("Started.")
 
     self.times = []
+    self.player_chunk = None # The (cx, cy) the generator and renderer were last told the player is in.
     if config.Debug.Game.FPS_SPAM: # Create the fps dictionary if we want to spam the current FPS to the console.
       self.fps = {}
 
@@ -107,8 +109,10 @@ class Game(pyglet.window.Window):
     # Setup the world data storange.
     if sys.platform == 'linux': # Set the niceness a little lower on Linux so the main thread runs smooth at all times.
       os.nice(2)
+    if config.WorldDataServer.SaveDirectory is not None: # The generators and the server have to use the seed the saved world was made with, so load it before either is started.
+      region_files.load_seed(config.WorldDataServer.SaveDirectory)
     self.log.info("Setting up world data server...")
-    self.world_server = world_data.WorldDataServer(self.log) # Stores the world data.
+    self.world_server = world_data.make_world_server(self.log) # Stores the world data, split between config.WorldDataServer.Shards processes.
     self.world_server.start() # Start the server.
     self.world_client = self.world_server.get_main_client() # Get the client that is used by the main thread and to create more clients.
     self.log.info("Setup world data server.")
@@ -183,36 +187,6 @@ class Game(pyglet.window.Window):
     pass
 
 
-  def generate_view_sequence(self, cx, cy, view_distance):
-    """This is intended to return the sequence to request chunks. However right now just the radius functions are being used instead. So if you want to generate things furthest to closest, this would be for that. But it's not used right now."""
-    seq = []
-    for distance in range(view_distance):
-      if distance == 0:
-        seq.append((cx, cy))
-        continue;
-
-    for length in range(distance):
-      if length == 0:
-        seq.append((cx-distance, cy))
-        seq.append((cx+distance, cy))
-      else:
-        seq.append((cx+distance, cy-length))
-        seq.append((cx-distance, cy-length))
-        seq.append((cx+distance, cy+length))
-        seq.append((cx-distance, cy+length))
-
-    for height in range(distance):
-      if height == 0:
-        seq.append((cx, cy-distance))
-        seq.append((cx, cy+distance))
-      else:
-        seq.append((cx-height, cy+distance))
-        seq.append((cx-height, cy-distance))
-        seq.append((cx+height, cy+distance))
-        seq.append((cx+height, cy-distance))
-    return seq
-
-
   def generate_view(self):
     """
     Requests chunks to be generated, rendered, and continue rendering any pre-calculated chunks.
@@ -231,15 +205,14 @@ class Game(pyglet.window.Window):
         self.times.append(res)
 
     cx, cy = self.world_client.abs_block_to_chunk_block(*self.player.standing_on())[0] # Get the chunk the player is in.
+    if (cx, cy) != self.player_chunk: # Work on the chunks nearest the player first and cancel the ones that are now out of range.
+      self.player_chunk = (cx, cy)
+      self.world_generator.recenter(cx, cy)
+      self.world_renderer.recenter(cx, cy)
 
-    # Generate all the chunks in the generation distance.
+    # Generate all the chunks in the generation distance. The order doesn't matter, the generator and renderer always take the nearest queued chunk.
     self.generate_radius(cx, cy, config.WorldGenerator.Distance)
     self.render_radius(cx, cy, config.WorldRenderer.Distance)
-    # Using a funky pattern because why not.
-    #for x, y in self.generate_view_sequence(cx, cy, config.WorldGenerator.Distance):
-      #self.world_generator.request_chunk(x, y)
-    #for x, y in self.generate_view_sequence(cx, cy, config.WorldRenderer.Distance):
-      #self.world_renderer.request_chunk(x, y)
 
 
   def check_user_input(self):
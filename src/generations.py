@@ -1,9 +1,9 @@
 from chunk import Chunk
 from block import Block
-from world_data import WorldDataClient
 import unittest
 import config
-import noise
+import numpy as np
+import noise_arrays
 import time
 
 
@@ -39,6 +39,7 @@ class Generation:
     PERSISTENCE = None # No idea.
     MULTIPLIER = None # Just multiply the resulting noise value [0:1] by this number. No idea what this does either.
     DEPTH = None # Generate this many of the top most blocks. This is for performance when testing worlds.
+    PROCEDURAL = False # True if generate only depends on the seed and the chunk position, not on world_client, so the chunk can be stored as a procedural.ProceduralChunk and made again when it is needed.
 
     def __init__(self, parent_log):
         raise NotImplementedError()
@@ -46,9 +47,63 @@ class Generation:
 
     @classmethod
     def generate(self, cx, cy, world_client):
-        """This generates the Chunk() at cx, cy and returns it. To access the already generated world data, use world_client."""
+        """This generates the Chunk() at cx, cy and returns it. To access the already generated world data, use world_client.
+        Fill the chunk with whole columns at a time using Chunk.fill_columns where possible, it is much faster than Chunk.set_block for every block."""
         raise NotImplementedError()
 
+
+    @classmethod
+    def generate_many(cls, positions, world_client):
+        """Generate the chunks at positions [(cx, cy), ...] and return them as a dict[(cx, cy)] = Chunk(). This calls generate for each one; generators that can share work between neighbouring chunks, like making the noise for all of them at once, override it."""
+        return {(cx, cy): cls.generate(cx, cy, world_client) for cx, cy in positions}
+
+
+    @classmethod
+    def heights(cls, abx, abz):
+        """Returns the height of the top block in the columns at absolute block positions abx, abz as an int array. abx and abz are arrays that are broadcast together, so the noise for all the columns is made in one call."""
+        raise NotImplementedError()
+
+
+    @classmethod
+    def heightmap(cls, cx, cy, chunks_x=1, chunks_y=1):
+        """Gets the column heights of the chunks_x by chunks_y chunks starting at chunk (cx, cy) with a single call to heights. Returns an int array indexed [abx - first abx, abz - first abz], so for one chunk it is indexed [bx, bz]."""
+        size = config.WorldDataServer.ChunkSize
+        abx = np.arange(cx * size, (cx + chunks_x) * size)
+        abz = np.arange(cy * size, (cy + chunks_y) * size)
+        heights = cls.heights(abx[:, None], abz[None, :])
+        if (heights > config.WorldDataServer.WorldHeight).any():
+            print("Generator returned an invalid world height.")
+        return heights
+
+
+    @classmethod
+    def heightmaps(cls, positions):
+        """Gets the heightmap of every chunk in positions [(cx, cy), ...] from one call to heightmap for the rectangle of chunks around them. The noise is made for the whole rectangle, so positions must be close together, like the chunks of one world_generator task. Returns a dict[(cx, cy)] = heightmap indexed [bx, bz]."""
+        size = config.WorldDataServer.ChunkSize
+        xs, ys = [cx for cx, cy in positions], [cy for cx, cy in positions]
+        cx0, cy0 = min(xs), min(ys)
+        heights = cls.heightmap(cx0, cy0, max(xs) - cx0 + 1, max(ys) - cy0 + 1)
+        return {(cx, cy): heights[(cx - cx0) * size:(cx - cx0 + 1) * size, (cy - cy0) * size:(cy - cy0 + 1) * size] for cx, cy in positions}
+
+
+    @classmethod
+    def top_blocks(cls, cx, cy):
+        """Returns what Chunk.get_heightmap() would for the chunk generate makes, without making it. This is right for generators that fill every column up to its heightmap height; others have to override it."""
+        return (np.clip(cls.heightmap(cx, cy), 0, config.WorldDataServer.WorldHeight) - 1).astype(np.int16)
+
+
+    @classmethod
+    def column_height(cls, abx, abz):
+        """Returns the height of the top block in this column."""
+        return int(cls.heights(np.array(abx), np.array(abz)))
+
+
+    @classmethod
+    def column_heights(cls, cx, cy):
+        """Gets all the column heights for the chunk as a dict[(bx, bz)] = height. See heightmap for them as an array."""
+        heights = cls.heightmap(cx, cy)
+        return {(bx, bz): int(heights[bx, bz]) for bx, bz in Chunk.all_columns()}
+
 class SimplexHeight(Generation):
     """This generation type uses simplex noise to decide on the height of the ground. It then creates a grass only world. See the Generation docstring for documentation on the noise algorithm variables."""
     X_SCALE = 1000
@@ -58,47 +113,39 @@ class SimplexHeight(Generation):
     LACUNARITY = 2.0
     MULTIPLIER = 1
     DEPTH = 5 # How many blocks deep to go
+    PROCEDURAL = True
 
 
     @classmethod
-    def column_height(cls, abx, abz):
-        """Returns the height of the top block in this column."""
-        n = noise.snoise3(abx / cls.X_SCALE,
-                          abz / cls.Z_SCALE,
-                          config.WorldGenerator.Seed,
-                          octaves=cls.OCTAVES,
-                          persistence=cls.PERSISTENCE,
-                          lacunarity=cls.LACUNARITY
-        )
+    def heights(cls, abx, abz):
+        n = noise_arrays.snoise3(abx / cls.X_SCALE,
+                                 abz / cls.Z_SCALE,
+                                 config.WorldGenerator.Seed,
+                                 octaves=cls.OCTAVES,
+                                 persistence=cls.PERSISTENCE,
+                                 lacunarity=cls.LACUNARITY
+        ).astype(np.float64)
 
         n *= cls.MULTIPLIER
         n = translate(n, 0, cls.MULTIPLIER, 0, config.WorldDataServer.WorldHeight)
-        height = round(n)
-        return height
+        return np.rint(n).astype(np.int64)
 
 
     @classmethod
-    def column_heights(cls, cx, cy):
-        """Gets all the column heights for the chunk."""
-        column_heights = {}
-        for bx, bz in Chunk.all_columns():
-            abx, _, abz = WorldDataClient.chunk_block_to_abs_block(cx, cy, bx, 0, bz)
-            h = cls.column_height(abx, abz)
-            if h > config.WorldDataServer.WorldHeight:
-                print("Generator returned an invalid world height.")
-            column_heights[(bx, bz)] = h
-        return column_heights
+    def generate(cls, cx, cy, world_client):
+        return cls.fill(cls.heightmap(cx, cy))
 
 
     @classmethod
-    def generate(cls, cx, cy, world_client):
-        chunk = Chunk()
-        column_heights = cls.column_heights(cx, cy)
+    def generate_many(cls, positions, world_client):
+        return {pos: cls.fill(column_heights) for pos, column_heights in cls.heightmaps(positions).items()}
+
 
-        for bx, bz in chunk.all_columns():
-            lowest = max(0, column_heights[bx, bz]-PerlinHeight.DEPTH)
-            for by in range(lowest, column_heights[bx, bz]):
-                chunk.set_block(bx, by, bz, Block(config.BlockType.Grass))
+    @classmethod
+    def fill(cls, column_heights):
+        """Make the chunk for the heightmap column_heights."""
+        chunk = Chunk()
+        chunk.fill_columns(column_heights - cls.DEPTH, column_heights, Block(config.BlockType.Grass))
         return chunk
 
 
@@ -112,62 +159,61 @@ class PerlinHeight(Generation):
     PERSISTENCE = 0.5
     MULTIPLIER = 10
     DEPTH = 5 # How many blocks deep to go
+    PROCEDURAL = True
 
 
     @classmethod
-    def column_height(cls, abx, abz):
-        """Returns the height of the top block in this column."""
-        n = noise.pnoise3(abx / cls.X_SCALE,
-                          abz / cls.Z_SCALE,
-                          config.WorldGenerator.Seed,
-                          octaves=cls.OCTAVES,
-                          persistence=cls.PERSISTENCE)
+    def heights(cls, abx, abz):
+        n = noise_arrays.pnoise3(abx / cls.X_SCALE,
+                                 abz / cls.Z_SCALE,
+                                 config.WorldGenerator.Seed,
+                                 octaves=cls.OCTAVES,
+                                 persistence=cls.PERSISTENCE).astype(np.float64)
         n *= cls.MULTIPLIER
         n = translate(n, 0, cls.MULTIPLIER, 0, config.WorldDataServer.WorldHeight)
-        height = round(n)
-        return height
+        return np.rint(n).astype(np.int64)
 
 
     @classmethod
-    def column_heights(cls, cx, cy):
-        """Gets all the column heights for the chunk."""
-        column_heights = {}
-        for bx, bz in Chunk.all_columns():
-            abx, _, abz = WorldDataClient.chunk_block_to_abs_block(cx, cy, bx, 0, bz)
-            h = cls.column_height(abx, abz)
-            if h > config.WorldDataServer.WorldHeight:
-                print("Generator returned an invalid world height.")
-            column_heights[(bx, bz)] = h
-        return column_heights
+    def generate(cls, cx, cy, world_client):
+        return cls.fill(cls.heightmap(cx, cy))
 
 
     @classmethod
-    def generate(cls, cx, cy, world_client):
-        chunk = Chunk()
-        column_heights = cls.column_heights(cx, cy)
+    def generate_many(cls, positions, world_client):
+        return {pos: cls.fill(column_heights) for pos, column_heights in cls.heightmaps(positions).items()}
+
 
-        for bx, bz in chunk.all_columns():
-            lowest = max(0, column_heights[bx, bz]-PerlinHeight.DEPTH)
-            for by in range(lowest, column_heights[bx, bz]):
-                chunk.set_block(bx, by, bz, Block(config.BlockType.Grass))
+    @classmethod
+    def fill(cls, column_heights):
+        """Make the chunk for the heightmap column_heights."""
+        chunk = Chunk()
+        chunk.fill_columns(column_heights - cls.DEPTH, column_heights, Block(config.BlockType.Grass))
         return chunk
 
 
 class Flat(Generation):
     """Generates a flat world HEIGHT deep made of grass."""
     HEIGHT = 4 # How many blocks deep should we generate.
+    PROCEDURAL = True
+
+
+    @classmethod
+    def heights(cls, abx, abz):
+        return np.full(np.broadcast(abx, abz).shape, cls.HEIGHT, dtype=np.int64)
 
 
     @classmethod
     def generate(cls, cx, cy, world_client):
         chunk = Chunk()
-        for bx, bz in chunk.all_columns():
-            for by in range(cls.HEIGHT):
-                chunk.set_block(bx, by, bz, Block(config.BlockType.Grass))
+        chunk.fill_columns(0, cls.HEIGHT, Block(config.BlockType.Grass))
         return chunk
 
 
 
+GENERATORS = {generator.__name__: generator for generator in (SimplexHeight, PerlinHeight, Flat)} # Generators by the name procedural.ProceduralChunk stores.
+
+
 class TestTranslate(unittest.TestCase):
     def test_translate(self):
         tests = [
@@ -188,3 +234,44 @@ class TestTranslate(unittest.TestCase):
             ret = translate(*inp)
             self.assertEqual(corr, ret, "Test failed: {}\nShould be {}, not {}.".format(inp, corr, ret))
 
+
+
+class TestHeights(unittest.TestCase):
+    def test_heightmap(self):
+        import noise
+        heights = SimplexHeight.heightmap(-3, 5)
+        self.assertEqual(heights.shape, (config.WorldDataServer.ChunkSize, config.WorldDataServer.ChunkSize))
+        self.assertEqual(SimplexHeight.column_heights(-3, 5), {(bx, bz): heights[bx, bz] for bx, bz in Chunk.all_columns()})
+        for bx, bz in [(0, 0), (5, 31), (31, 12)]:
+            abx, abz = -3 * config.WorldDataServer.ChunkSize + bx, 5 * config.WorldDataServer.ChunkSize + bz
+            n = noise.snoise3(abx / SimplexHeight.X_SCALE, abz / SimplexHeight.Z_SCALE, config.WorldGenerator.Seed,
+                              octaves=SimplexHeight.OCTAVES, persistence=SimplexHeight.PERSISTENCE, lacunarity=SimplexHeight.LACUNARITY)
+            self.assertAlmostEqual(heights[bx, bz], translate(n * SimplexHeight.MULTIPLIER, 0, SimplexHeight.MULTIPLIER, 0, config.WorldDataServer.WorldHeight), delta=0.51)
+            self.assertEqual(SimplexHeight.column_height(abx, abz), heights[bx, bz])
+
+        region = PerlinHeight.heightmap(-1, -1, 2, 3)
+        self.assertEqual(region.shape, (2 * config.WorldDataServer.ChunkSize, 3 * config.WorldDataServer.ChunkSize))
+        self.assertTrue(np.array_equal(region[config.WorldDataServer.ChunkSize:, 2 * config.WorldDataServer.ChunkSize:], PerlinHeight.heightmap(0, 1)))
+        self.assertTrue((Flat.heightmap(0, 0) == Flat.HEIGHT).all())
+
+
+    def test_generate(self):
+        for generator in (SimplexHeight, PerlinHeight):
+            heights = generator.heightmap(2, -7)
+            correct = Chunk()
+            grass = Block(config.BlockType.Grass)
+            for bx, bz in Chunk.all_columns():
+                for by in range(max(0, heights[bx, bz] - generator.DEPTH), heights[bx, bz]):
+                    correct.set_block(bx, by, bz, grass)
+            chunk = generator.generate(2, -7, None)
+            self.assertEqual(chunk, correct)
+            self.assertTrue(chunk.is_generated())
+            self.assertTrue(np.array_equal(chunk.get_heightmap(), np.where(heights > 0, heights - 1, -1)))
+            self.assertTrue(np.array_equal(generator.top_blocks(2, -7), chunk.get_heightmap()))
+
+            positions = [(2, -7), (3, -7), (2, -5)]
+            chunks = generator.generate_many(positions, None)
+            self.assertEqual(list(chunks), positions)
+            for cx, cy in positions:
+                self.assertEqual(chunks[(cx, cy)], generator.generate(cx, cy, None))
+        self.assertEqual(Flat.generate_many([(0, 0)], None), {(0, 0): Flat.generate(0, 0, None)})
@@ -0,0 +1,161 @@
+import unittest
+from bisect import bisect_left
+from time import time
+import config
+
+
+"""Counters and latency histograms for the requests between WorldDataClients and the WorldDataServer. Both sides keep a RequestMetrics, the server's can be fetched with WorldDataClient.get_stats."""
+
+
+class Histogram:
+    """Counts how many times fell in each of config.Metrics.HistogramBuckets. Also keeps the total and max so the mean is exact."""
+    __slots__ = ('counts', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(config.Metrics.HistogramBuckets) + 1) # The last bucket is everything over the largest bound.
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def add(self, seconds):
+        self.counts[bisect_left(config.Metrics.HistogramBuckets, seconds)] += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+    def count(self):
+        return sum(self.counts)
+
+
+    def percentile(self, p):
+        """Upper bound of the bucket the p-th percentile (0-100) falls in. None if nothing was added, inf if it is past the largest bucket."""
+        n = self.count()
+        if n == 0: return None
+        seen = 0
+        for bound, count in zip(tuple(config.Metrics.HistogramBuckets) + (float('inf'),), self.counts):
+            seen += count
+            if seen * 100 >= p * n:
+                return bound
+
+
+    def snapshot(self):
+        """Returns {'count', 'mean', 'max', 'p50', 'p99', 'buckets'} where buckets is [(upper bound in seconds, count), ...]."""
+        n = self.count()
+        return {
+            'count': n,
+            'mean': self.total / n if n > 0 else 0.0,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'buckets': list(zip(tuple(config.Metrics.HistogramBuckets) + (float('inf'),), self.counts)),
+        }
+
+
+class RequestStats:
+    """What is kept for each request type."""
+    __slots__ = ('count', 'bytes_sent', 'bytes_received', 'latency', 'queue')
+
+    def __init__(self):
+        self.count = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency = Histogram() # Client: from sending the request to handling the reply. Server: time spent handling it.
+        self.queue = Histogram() # Server only: from the client sending the request to the server starting to handle it.
+
+
+class RequestMetrics:
+    """Collects RequestStats for every request type a WorldDataClient or WorldDataServer sends or receives, and says when it is time to dump them to the log."""
+    def __init__(self):
+        self.__requests__ = {} # {config.WorldRequests: RequestStats()}
+        self.__started__ = time()
+        self.__last_dump__ = time()
+
+
+    def __stats__(self, cmd):
+        stats = self.__requests__.get(cmd)
+        if stats is None:
+            stats = RequestStats()
+            self.__requests__[cmd] = stats
+        return stats
+
+
+    def sent(self, cmd, nbytes):
+        """Record a message of type cmd that was nbytes long being sent."""
+        self.__stats__(cmd).bytes_sent += nbytes
+
+
+    def received(self, cmd, nbytes):
+        """Record a message of type cmd that was nbytes long being received."""
+        self.__stats__(cmd).bytes_received += nbytes
+
+
+    def finished(self, cmd, latency, queue=None):
+        """Record a request of type cmd being done.
+        latency: Seconds it took. See RequestStats.latency.
+        queue: Seconds it waited before it was handled, if known."""
+        stats = self.__stats__(cmd)
+        stats.count += 1
+        stats.latency.add(latency)
+        if queue is not None:
+            stats.queue.add(max(0.0, queue))
+
+
+    def snapshot(self):
+        """Returns {'uptime': seconds, 'requests': {request type value: {'count', 'rate', 'bytes_sent', 'bytes_received', 'latency', 'queue'}}} where latency and queue are Histogram.snapshot()s and rate is requests per second."""
+        uptime = max(time() - self.__started__, 1e-9)
+        requests = {}
+        for cmd, stats in self.__requests__.items():
+            requests[getattr(cmd, 'value', cmd)] = {
+                'count': stats.count,
+                'rate': stats.count / uptime,
+                'bytes_sent': stats.bytes_sent,
+                'bytes_received': stats.bytes_received,
+                'latency': stats.latency.snapshot(),
+                'queue': stats.queue.snapshot(),
+            }
+        return {'uptime': uptime, 'requests': requests}
+
+
+    def dump_due(self):
+        """True once every config.Metrics.DumpInterval seconds. Always False if that is None."""
+        if config.Metrics.DumpInterval is None: return False
+        if time() - self.__last_dump__ < config.Metrics.DumpInterval: return False
+        self.__last_dump__ = time()
+        return True
+
+
+    def format(self):
+        """A table of the snapshot for the log, busiest request types first."""
+        snapshot = self.snapshot()
+        lines = ["{:<20} {:>8} {:>8} {:>10} {:>10} {:>9} {:>9} {:>9}".format('request', 'count', 'per sec', 'sent', 'received', 'mean ms', 'max ms', 'queue ms')]
+        for name, stats in sorted(snapshot['requests'].items(), key=lambda item: -item[1]['latency']['count'] * item[1]['latency']['mean']):
+            lines.append("{:<20} {:>8} {:>8.1f} {:>10} {:>10} {:>9.3f} {:>9.3f} {:>9.3f}".format(
+                str(name), stats['count'], stats['rate'], stats['bytes_sent'], stats['bytes_received'],
+                stats['latency']['mean'] * 1000, stats['latency']['max'] * 1000, stats['queue']['mean'] * 1000))
+        return "\n".join(lines)
+
+
+class TestRequestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        h = Histogram()
+        self.assertIsNone(h.percentile(50))
+        for i in range(99):
+            h.add(config.Metrics.HistogramBuckets[0] / 2)
+        h.add(config.Metrics.HistogramBuckets[-1] * 2)
+        self.assertEqual(h.count(), 100)
+        self.assertEqual(h.percentile(50), config.Metrics.HistogramBuckets[0])
+        self.assertEqual(h.percentile(100), float('inf'))
+        self.assertEqual(h.snapshot()['max'], config.Metrics.HistogramBuckets[-1] * 2)
+
+
+    def test_metrics(self):
+        m = RequestMetrics()
+        m.sent(config.WorldRequests.PingReq, 10)
+        m.received(config.WorldRequests.PingReq, 20)
+        m.finished(config.WorldRequests.PingReq, 0.002, queue=0.001)
+        m.finished(config.WorldRequests.PingReq, 0.004)
+        stats = m.snapshot()['requests'][config.WorldRequests.PingReq.value]
+        self.assertEqual((stats['count'], stats['bytes_sent'], stats['bytes_received']), (2, 10, 20))
+        self.assertAlmostEqual(stats['latency']['mean'], 0.003)
+        self.assertEqual(stats['queue']['count'], 1)
+        self.assertIn(config.WorldRequests.PingReq.value, m.format())
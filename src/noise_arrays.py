@@ -0,0 +1,216 @@
+import unittest, random
+import numpy as np
+import noise
+
+
+"""NumPy versions of noise.snoise3 and noise.pnoise3 that take arrays of coordinates, so the noise for every column of a chunk (or of many chunks) is made in one call instead of one call per column.
+They are ports of the noise library's C code and use the same float32 math, permutation table and gradients, so they return the same values as the noise library (simplex noise can differ in the last bit of a float32)."""
+
+
+# Ken Perlin's permutation table, doubled so lookups don't need to wrap. This is the table the noise library's C code uses; the one in noise.perlin has a typo.
+PERM = np.array([151,160,137,91,90,15,
+    131,13,201,95,96,53,194,233,7,225,140,36,103,30,69,142,8,99,37,240,21,10,23,
+    190,6,148,247,120,234,75,0,26,197,62,94,252,219,203,117,35,11,32,57,177,33,
+    88,237,149,56,87,174,20,125,136,171,168,68,175,74,165,71,134,139,48,27,166,
+    77,146,158,231,83,111,229,122,60,211,133,230,220,105,92,41,55,46,245,40,244,
+    102,143,54,65,25,63,161,1,216,80,73,209,76,132,187,208,89,18,169,200,196,
+    135,130,116,188,159,86,164,100,109,198,173,186,3,64,52,217,226,250,124,123,
+    5,202,38,147,118,126,255,82,85,212,207,206,59,227,47,16,58,17,182,189,28,42,
+    223,183,170,213,119,248,152,2,44,154,163,70,221,153,101,155,167,43,172,9,
+    129,22,39,253,19,98,108,110,79,113,224,232,178,185,112,104,218,246,97,228,
+    251,34,242,193,238,210,144,12,191,179,162,241,81,51,145,235,249,14,239,107,
+    49,192,214,31,181,199,106,157,184,84,204,176,115,121,50,45,127,4,150,254,
+    138,236,205,93,222,114,67,29,24,72,243,141,128,195,78,66,215,61,156,180] * 2, dtype=np.intp)
+
+GRAD3 = np.array([
+    (1,1,0),(-1,1,0),(1,-1,0),(-1,-1,0),
+    (1,0,1),(-1,0,1),(1,0,-1),(-1,0,-1),
+    (0,1,1),(0,-1,1),(0,1,-1),(0,-1,-1),
+    (1,0,-1),(-1,0,-1),(0,-1,1),(0,1,1)], dtype=np.float32)
+
+F3 = np.float32(1.0 / 3.0) # Simplex skew constants
+G3 = np.float32(1.0 / 6.0)
+BLOCK_SIZE = 4096 # Points are worked on this many at a time so the temporary arrays stay in the CPU cache.
+
+
+GRAD_X, GRAD_Y, GRAD_Z = (np.ascontiguousarray(GRAD3[:, i]) for i in range(3))
+PERM12 = PERM % 12 # Simplex noise only uses the first 12 gradients.
+
+
+def __dot__(g, x, y, z):
+    """Dot product of the gradients at indexes g with the vectors (x, y, z)."""
+    return x * GRAD_X.take(g) + y * GRAD_Y.take(g) + z * GRAD_Z.take(g)
+
+
+def __gradient_index__(I, J, K, oi, oj, ok, table):
+    """table[I + oi + PERM[J + oj + PERM[K + ok]]], where I, J and K are the cell's coordinates & 255 and oi, oj and ok are offsets to one of its corners."""
+    h = PERM.take(K + ok)
+    h += J
+    h += oj
+    PERM.take(h, out=h)
+    h += I
+    h += oi
+    return table.take(h)
+
+
+def simplex3(x, y, z):
+    """One octave of 3D simplex noise for float32 arrays x, y and z of the same shape. Returns values in about [-1, 1]."""
+    s = (x + y + z) * F3
+    i = np.floor(x + s)
+    j = np.floor(y + s)
+    k = np.floor(z + s)
+    t = (i + j + k) * G3
+    x0 = x - (i - t) # Distances from the cell origin.
+    y0 = y - (j - t)
+    z0 = z - (k - t)
+    I = i.astype(np.intp) & 255
+    J = j.astype(np.intp) & 255
+    K = k.astype(np.intp) & 255
+
+    # Which of the six tetrahedrons in the cell the point is in decides the offsets of the second and third corners.
+    xy, yz, xz = x0 >= y0, y0 >= z0, x0 >= z0
+    i1 = xy & (yz | xz)
+    j1 = ~xy & yz
+    k1 = ~(i1 | j1)
+    i2 = xy | (yz & xz)
+    j2 = ~xy | yz
+    k2 = ~(xy & yz) & ~(~xy & yz & xz)
+
+    total = np.zeros(x.shape, dtype=np.float32)
+    for oi, oj, ok, g in ((0, 0, 0, np.float32(0)), (i1, j1, k1, G3), (i2, j2, k2, np.float32(2) * G3), (1, 1, 1, np.float32(3) * G3)):
+        xc, yc, zc = x0 - oi, y0 - oj, z0 - ok
+        xc += g
+        yc += g
+        zc += g
+        f = np.float32(0.6) - xc * xc
+        f -= yc * yc
+        f -= zc * zc
+        np.maximum(f, 0, out=f) # Corners further than this don't add anything.
+        n = f * f
+        n *= f
+        n *= f
+        n *= __dot__(__gradient_index__(I, J, K, oi, oj, ok, PERM12), xc, yc, zc)
+        total += n
+    total *= np.float32(32)
+    return total
+
+
+def perlin3(x, y, z, repeat):
+    """One octave of 3D Perlin "improved" noise for float32 arrays x, y and z of the same shape, repeating every repeat units. repeat can be an int array that broadcasts against x."""
+    repeat = np.asarray(repeat, dtype=np.intp)
+    def cells(v):
+        c = np.floor(np.fmod(v, repeat.astype(np.float32))).astype(np.intp)
+        return (c & 255, np.fmod(c + 1, repeat) & 255)
+    i, ii = cells(x)
+    j, jj = cells(y)
+    k, kk = cells(z)
+
+    x = x - np.floor(x)
+    y = y - np.floor(y)
+    z = z - np.floor(z)
+    fx = x * x * x * (x * (x * np.float32(6) - np.float32(15)) + np.float32(10))
+    fy = y * y * y * (y * (y * np.float32(6) - np.float32(15)) + np.float32(10))
+    fz = z * z * z * (z * (z * np.float32(6) - np.float32(15)) + np.float32(10))
+
+    A = PERM[i]
+    AA = PERM[A + j]
+    AB = PERM[A + jj]
+    B = PERM[ii]
+    BA = PERM[B + j]
+    BB = PERM[B + jj]
+
+    def grad(h, x, y, z):
+        return __dot__(h & 15, x, y, z)
+    def lerp(t, a, b):
+        return a + t * (b - a)
+
+    one = np.float32(1)
+    return lerp(fz, lerp(fy, lerp(fx, grad(PERM[AA + k], x, y, z), grad(PERM[BA + k], x - one, y, z)),
+                             lerp(fx, grad(PERM[AB + k], x, y - one, z), grad(PERM[BB + k], x - one, y - one, z))),
+                    lerp(fy, lerp(fx, grad(PERM[AA + kk], x, y, z - one), grad(PERM[BA + kk], x - one, y, z - one)),
+                             lerp(fx, grad(PERM[AB + kk], x, y - one, z - one), grad(PERM[BB + kk], x - one, y - one, z - one))))
+
+
+def __as_arrays__(x, y, z):
+    """Broadcast x, y and z together. Returns (x, y, z, shape) where x, y and z are flat float32 arrays and shape is what the results should be reshaped to."""
+    x, y, z = np.broadcast_arrays(np.asarray(x, dtype=np.float32), np.asarray(y, dtype=np.float32), np.asarray(z, dtype=np.float32))
+    return (x.ravel(), y.ravel(), z.ravel(), x.shape)
+
+
+def __octaves__(octaves, persistence, lacunarity):
+    """The float32 frequency and amplitude of every octave, worked out the same way the noise library does. Frequencies are a column so they broadcast against the flat coordinates."""
+    freqs, amps = [np.float32(1)], [np.float32(1)]
+    for i in range(1, octaves):
+        freqs.append(freqs[-1] * np.float32(lacunarity))
+        amps.append(amps[-1] * np.float32(persistence))
+    return (np.array(freqs, dtype=np.float32)[:, None], amps)
+
+
+def snoise3(x, y, z, octaves=1, persistence=0.5, lacunarity=2.0):
+    """Array version of noise.snoise3. x, y and z can be arrays or numbers and are broadcast together.
+    Returns a float32 array of the noise at every point. Every octave is made in the same call to simplex3."""
+    x, y, z, shape = __as_arrays__(x, y, z)
+    freqs, amps = __octaves__(octaves, persistence, lacunarity)
+    max_amp = np.float32(1)
+    for amp in amps[1:]:
+        max_amp += amp
+
+    result = np.empty(x.shape, dtype=np.float32)
+    for start in range(0, len(x), BLOCK_SIZE):
+        block = slice(start, start + BLOCK_SIZE)
+        layers = simplex3(x[block] * freqs, y[block] * freqs, z[block] * freqs)
+        total = layers[0]
+        for layer, amp in zip(layers[1:], amps[1:]):
+            total += layer * amp
+        result[block] = total / max_amp
+    return result.reshape(shape)
+
+
+def pnoise3(x, y, z, octaves=1, persistence=0.5, lacunarity=2.0, repeat=1024):
+    """Array version of noise.pnoise3. x, y and z can be arrays or numbers and are broadcast together. repeat is used for repeatx, repeaty and repeatz.
+    Returns a float32 array of the noise at every point."""
+    x, y, z, shape = __as_arrays__(x, y, z)
+    if octaves == 1:
+        return perlin3(x, y, z, repeat).reshape(shape)
+    freqs, amps = __octaves__(octaves, persistence, lacunarity)
+    max_amp = np.float32(0)
+    for amp in amps:
+        max_amp += amp
+
+    repeats = np.array([int(repeat * freq) for freq in freqs[:, 0]], dtype=np.intp)[:, None]
+
+    result = np.empty(x.shape, dtype=np.float32)
+    for start in range(0, len(x), BLOCK_SIZE):
+        block = slice(start, start + BLOCK_SIZE)
+        layers = perlin3(x[block] * freqs, y[block] * freqs, z[block] * freqs, repeats)
+        total = np.zeros(layers.shape[1], dtype=np.float32)
+        for layer, amp in zip(layers, amps):
+            total += layer * amp
+        result[block] = total / max_amp
+    return result.reshape(shape)
+
+
+class TestNoiseArrays(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.x = rng.uniform(-2000, 2000, 2000)
+        self.y = rng.uniform(-2000, 2000, 2000)
+        self.z = random.random()
+
+
+    def test_snoise3(self):
+        for kwargs in ({}, {'octaves': 5, 'persistence': 0.5, 'lacunarity': 2.0}):
+            correct = [noise.snoise3(x, y, self.z, **kwargs) for x, y in zip(self.x, self.y)]
+            np.testing.assert_allclose(snoise3(self.x, self.y, self.z, **kwargs), correct, atol=1e-5)
+
+
+    def test_pnoise3(self):
+        for kwargs in ({}, {'octaves': 4, 'persistence': 0.5}):
+            correct = [noise.pnoise3(x, y, self.z, **kwargs) for x, y in zip(self.x, self.y)]
+            np.testing.assert_allclose(pnoise3(self.x, self.y, self.z, **kwargs), correct, atol=1e-5)
+
+
+    def test_shapes(self):
+        grid = snoise3(np.arange(4)[:, None] / 10, np.arange(3)[None, :] / 10, self.z)
+        self.assertEqual(grid.shape, (4, 3))
+        self.assertAlmostEqual(float(grid[2, 1]), noise.snoise3(0.2, 0.1, self.z), places=5)
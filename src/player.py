@@ -15,14 +15,12 @@ def legacy_get_abs_block_pos(player_pos):
   return (x, y, z)
 
 
-def legacy_get_top_block_height(world_client, abx, aby):
-  """Returns the height of the top most block at the given absolute block position in the world."""
-  (cx, cy), (bx, by) = WorldDataClient.abs_block_to_chunk_block(abx, aby)
-  chunk = world_client.get_chunk(cx, cy)
-  column = chunk.get_column(bx, by)
-  column = list(column.items())
-  column.sort(reverse=True)
-  return column[0][2]
+def legacy_get_top_block_height(world_client, abx, abz):
+  """Returns the height of the top most block at the given absolute block position in the world, -1 if the column is empty, or None if the heightmap couldn't be fetched."""
+  (cx, cy), (bx, _, bz) = world_client.abs_block_to_chunk_block(abx, 0, abz)
+  heightmap = world_client.get_heightmap(cx, cy)
+  if heightmap is None: return None
+  return int(heightmap[bx, bz])
 
 
 class Player:
@@ -0,0 +1,159 @@
+import struct, unittest
+import numpy as np
+import config
+from chunk import Chunk, BLOCK_IDS
+from block import Block
+import generations
+
+
+"""Generated chunks stored as how to make them instead of their blocks. Terrain from generators with Generation.PROCEDURAL set only depends on the seed, the generator and the chunk position, so a ProceduralChunk with those (plus any blocks changed since) is enough to make the chunk again.
+The WorldDataServer keeps these instead of compressed blocks for chunks nobody is using and saves them to region files in place of the blocks. The blocks are only made when a chunk is actually needed."""
+
+
+HEADER = struct.Struct('<iidHI') # cx, cy, seed, length of the generator name, number of edits
+VERSION = struct.Struct('<Q') # ProceduralChunk.version, after the edits. ProceduralChunks saved before it was added don't have it.
+
+
+class ProceduralChunk:
+    """A generated chunk as (generator, seed, position) and an overlay of the blocks changed after it was generated. See the module docstring."""
+    def __init__(self, generator, cx, cy, seed=None, chunk=None):
+        """generator: The name of the generations.Generation in generations.GENERATORS that makes the chunk.
+        seed: The config.WorldGenerator.Seed it was generated with. Defaults to the current one.
+        chunk: The Chunk() the generator already made, if it has. It is handed to whoever materializes this first and isn't saved by to_bytes."""
+        if generator not in generations.GENERATORS:
+            raise ValueError("Unknown generator '{}'".format(generator))
+        self.generator = generator
+        self.cx = cx
+        self.cy = cy
+        self.seed = config.WorldGenerator.Seed if seed is None else seed
+        self.chunk = chunk
+        self.__edits__ = {} # {(bx, by, bz): block ID} changed after the chunk was generated.
+        self.version = 0 # Chunk.get_version() of the chunk when its blocks were last dropped, so the one made again carries on from it.
+        self.__heightmap__ = None # Cached get_heightmap()
+
+
+    def __eq__(self, other):
+        if not isinstance(other, ProceduralChunk): return False
+        return (self.generator, self.cx, self.cy, self.seed, self.__edits__) == (other.generator, other.cx, other.cy, other.seed, other.__edits__)
+
+
+    def __repr__(self):
+        return "ProceduralChunk: {} ({}, {}) with {} edits".format(self.generator, self.cx, self.cy, len(self.__edits__))
+
+
+    def is_generated(self):
+        return True
+
+
+    def edit_count(self):
+        return len(self.__edits__)
+
+
+    def add_edits(self, delta):
+        """Record blocks that changed after the chunk was generated.
+        delta: (positions, block IDs) as returned by Chunk.set_blocks."""
+        positions, ids = delta
+        for pos, block_id in zip(np.asarray(positions).tolist(), np.asarray(ids).tolist()):
+            self.__edits__[tuple(pos)] = block_id
+        self.__heightmap__ = None
+
+
+    def materialize(self):
+        """Returns the Chunk() this describes. The generator is only run if the chunk it already made was handed out before."""
+        chunk, self.chunk = self.chunk, None
+        if chunk is not None: return chunk
+
+        if self.seed != config.WorldGenerator.Seed:
+            raise ValueError("Chunk ({}, {}) was generated with seed {}, not {}".format(self.cx, self.cy, self.seed, config.WorldGenerator.Seed))
+        chunk = generations.GENERATORS[self.generator].generate(self.cx, self.cy, None)
+        chunk.mark_generated()
+        if len(self.__edits__) > 0:
+            chunk.set_blocks(list(self.__edits__.keys()), list(self.__edits__.values()))
+        chunk.set_version(self.version)
+        return chunk
+
+
+    def get_heightmap(self):
+        """Get what Chunk.get_heightmap would return for the materialized chunk. Without edits it comes from the generator's heightmap, so no blocks are made."""
+        if self.__heightmap__ is None:
+            if self.chunk is not None:
+                self.__heightmap__ = self.chunk.get_heightmap()
+            elif len(self.__edits__) == 0:
+                self.__heightmap__ = generations.GENERATORS[self.generator].top_blocks(self.cx, self.cy)
+            else:
+                self.__heightmap__ = self.materialize().get_heightmap()
+        return self.__heightmap__
+
+
+    def drop_cache(self):
+        """Forget the materialized chunk and heightmap, leaving only what to_bytes saves."""
+        self.chunk = None
+        self.__heightmap__ = None
+
+
+    def to_bytes(self):
+        """Serialize the description of the chunk, without its blocks."""
+        name = self.generator.encode()
+        positions = np.array(list(self.__edits__.keys()), dtype=np.uint16).reshape(-1, 3)
+        ids = np.array(list(self.__edits__.values()), dtype=np.uint8)
+        return HEADER.pack(self.cx, self.cy, self.seed, len(name), len(ids)) + name + positions.tobytes() + ids.tobytes() + VERSION.pack(self.version)
+
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Create a ProceduralChunk from what to_bytes returned."""
+        cx, cy, seed, name_length, count = HEADER.unpack_from(data)
+        offset = HEADER.size
+        procedural = cls(bytes(data[offset:offset+name_length]).decode(), cx, cy, seed)
+        offset += name_length
+        positions = np.frombuffer(data, dtype=np.uint16, count=count*3, offset=offset).reshape(-1, 3)
+        ids = np.frombuffer(data, dtype=np.uint8, count=count, offset=offset+positions.nbytes)
+        procedural.add_edits((positions, ids))
+        offset += positions.nbytes + ids.nbytes
+        if len(data) >= offset + VERSION.size:
+            procedural.version = VERSION.unpack_from(data, offset)[0]
+        return procedural
+
+
+    def __getstate__(self):
+        """The cached heightmap is cheap to make again, so it isn't pickled. The chunk is, so a generator can send the blocks it made along with this."""
+        state = self.__dict__.copy()
+        state['__heightmap__'] = None
+        return state
+
+
+
+class TestProceduralChunk(unittest.TestCase):
+    def test_materialize(self):
+        procedural = ProceduralChunk('SimplexHeight', 3, -2)
+        chunk = procedural.materialize()
+        self.assertEqual(chunk, generations.SimplexHeight.generate(3, -2, None))
+        self.assertTrue(np.array_equal(procedural.get_heightmap(), chunk.get_heightmap()))
+
+        delta = chunk.set_blocks([(1, 255, 1)], [BLOCK_IDS[config.BlockType.Water]])
+        procedural.add_edits(delta)
+        self.assertEqual(procedural.materialize(), chunk)
+        self.assertEqual(procedural.get_heightmap()[1, 1], 255)
+
+        given = Chunk()
+        self.assertIs(ProceduralChunk('Flat', 0, 0, chunk=given).materialize(), given)
+        with self.assertRaises(ValueError):
+            ProceduralChunk('NotAGenerator', 0, 0)
+        with self.assertRaises(ValueError):
+            ProceduralChunk('Flat', 0, 0, seed=config.WorldGenerator.Seed + 1).materialize()
+
+
+    def test_to_bytes(self):
+        procedural = ProceduralChunk('PerlinHeight', -7, 12, chunk=Chunk())
+        procedural.add_edits(([(1, 2, 3), (4, 5, 6)], [BLOCK_IDS[config.BlockType.Grass], 0]))
+        data = procedural.to_bytes()
+        res = ProceduralChunk.from_bytes(data)
+        self.assertEqual(res, procedural)
+        self.assertIsNone(res.chunk)
+        self.assertLess(len(data), 100)
+        self.assertEqual(res.materialize().get_block(1, 2, 3), Block(config.BlockType.Grass))
+
+        procedural.version = 9
+        res = ProceduralChunk.from_bytes(procedural.to_bytes())
+        self.assertEqual(res.materialize().get_version(), 9)
+        self.assertEqual(ProceduralChunk.from_bytes(data[:-VERSION.size]).version, 0) # Saved before the version was.
@@ -0,0 +1,385 @@
+import os, mmap, struct, zlib, re, unittest, tempfile, itertools
+import numpy as np
+import config
+from chunk import Chunk
+from block import Block
+from procedural import ProceduralChunk
+
+
+"""Stores the world on disk in region files. Each region file holds config.WorldDataServer.RegionSize by RegionSize chunks.
+A region file starts with a header and an offset table with an entry for every chunk in the region, followed by the zlib compressed chunks (see Chunk.to_bytes) or procedural.ProceduralChunks.
+Chunks are read through a memory map of the file. A changed chunk is written over its old copy if it still fits, otherwise it is appended to the end of the file.
+Files made by an older version, or with another config.WorldDataServer.RegionSize, are rewritten when the RegionStore is created (see RegionStore.__migrate__)."""
+
+
+MAGIC = b'W3DR'
+FILE_VERSION = 2
+HEADER = struct.Struct('<4sII') # magic, file version, config.WorldDataServer.RegionSize the file was made with
+HEADER_V1 = struct.Struct('<4sI') # magic, file version. Version 1 files didn't say what RegionSize they were made with.
+ENTRY = struct.Struct('<QII') # offset of the chunk in the file, compressed length (0 if the chunk isn't stored), space available at that offset
+ENTRY_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u4'), ('capacity', '<u4')])
+REGION_FILE_NAME = re.compile(r'^r\.(-?\d+)\.(-?\d+)\.region$')
+SEED_FILE_NAME = 'seed'
+PROCEDURAL_TAG = b'P' # Starts a stored ProceduralChunk. zlib data never starts with it.
+OLD_SUFFIX = '.old' # Added to the name of a region file while its chunks are copied into files of the current version and RegionSize.
+
+
+def region_of(cx, cy):
+    """Returns ((rx, ry), index in the region's offset table) for chunk (cx, cy)."""
+    rx, lx = divmod(cx, config.WorldDataServer.RegionSize)
+    ry, ly = divmod(cy, config.WorldDataServer.RegionSize)
+    return ((rx, ry), lx * config.WorldDataServer.RegionSize + ly)
+
+
+def load_seed(directory):
+    """Make config.WorldGenerator.Seed the seed the world in directory was generated with, so chunks generated after a restart line up with the saved ones. Saves the current seed if the world is new.
+    Must be called before the generator processes are started."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, SEED_FILE_NAME)
+    if os.path.exists(path):
+        with open(path) as f:
+            config.WorldGenerator.Seed = float(f.read())
+    else:
+        with open(path, 'w') as f:
+            f.write(repr(config.WorldGenerator.Seed))
+
+
+def read_header(path):
+    """Returns (file version, config.WorldDataServer.RegionSize) of the region file at path. The size is worked out from the offset table for version 1 files, which didn't store it.
+    Raises ValueError if path isn't a region file this version can read."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < HEADER_V1.size or data[:len(MAGIC)] != MAGIC:
+        raise ValueError("{} is not a region file".format(path))
+    version = HEADER_V1.unpack_from(data)[1]
+    if version == 1:
+        size = guess_region_size(data)
+        if size is None:
+            raise ValueError("{} is a version 1 region file, but its offset table doesn't fit any region size".format(path))
+        return (1, size)
+    if version == FILE_VERSION and len(data) >= HEADER.size:
+        return (version, HEADER.unpack_from(data)[2])
+    raise ValueError("{} is a version {} region file, only versions 1 to {} can be read".format(path, version, FILE_VERSION))
+
+
+def guess_region_size(data):
+    """Work out the RegionSize a version 1 region file was made with from data, the whole file. The first chunk written to a file always goes right after the offset table, so it is the size whose table ends there and only points at chunks inside the file.
+    Returns None if no size fits."""
+    for size in itertools.count(1):
+        table_end = HEADER_V1.size + size * size * ENTRY.size
+        if table_end > len(data): return None
+        table = np.frombuffer(data, dtype=ENTRY_DTYPE, count=size * size, offset=HEADER_V1.size)
+        stored = table[table['capacity'] > 0]
+        if len(stored) == 0:
+            if len(data) == table_end: return size
+            continue
+        if (table['length'] > table['capacity']).any() or ((table['capacity'] == 0) & (table['offset'] != 0)).any(): continue
+        if (stored['offset'] + stored['capacity'] > len(data)).any(): continue
+        if int(stored['offset'].min()) == table_end: return size
+
+
+def compress(chunk, level=None):
+    """zlib compress chunk the way it is stored in region files. level defaults to config.WorldDataServer.RegionCompression.
+    A procedural.ProceduralChunk is stored as is behind PROCEDURAL_TAG, it is already smaller than its compressed blocks would be."""
+    if isinstance(chunk, ProceduralChunk):
+        return PROCEDURAL_TAG + chunk.to_bytes()
+    if level is None: level = config.WorldDataServer.RegionCompression
+    return zlib.compress(chunk.to_bytes(), level)
+
+
+def decompress(data):
+    """Get the Chunk or ProceduralChunk back from what compress returned."""
+    if bytes(data[:len(PROCEDURAL_TAG)]) == PROCEDURAL_TAG:
+        return ProceduralChunk.from_bytes(bytes(data[len(PROCEDURAL_TAG):]))
+    return Chunk.from_bytes(zlib.decompress(data))
+
+
+class RegionFile:
+    """One region file. Keeps its offset table in memory and reads chunks through a memory map."""
+    def __init__(self, path):
+        """path: The file to open. It is created if it doesn't exist.
+        Raises ValueError if it isn't a region file of this version, or was made with another config.WorldDataServer.RegionSize, since every chunk in it would be looked up at the wrong place."""
+        self.path = path
+        entries = config.WorldDataServer.RegionSize ** 2
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, FILE_VERSION, config.WorldDataServer.RegionSize))
+                f.write(bytes(ENTRY.size * entries))
+
+        self.__file__ = open(path, 'r+b')
+        header = self.__file__.read(HEADER.size)
+        if len(header) < HEADER.size or HEADER.unpack(header)[:2] != (MAGIC, FILE_VERSION):
+            self.__file__.close()
+            raise ValueError("{} is not a version {} region file".format(path, FILE_VERSION))
+        size = HEADER.unpack(header)[2]
+        if size != config.WorldDataServer.RegionSize:
+            self.__file__.close()
+            raise ValueError("{} has regions of {} by {} chunks, but config.WorldDataServer.RegionSize is {}".format(path, size, size, config.WorldDataServer.RegionSize))
+        self.__table__ = np.frombuffer(self.__file__.read(ENTRY.size * entries), dtype=ENTRY_DTYPE).copy()
+        self.__map__ = None # mmap of the file, recreated when the file grows past it.
+
+
+    def __mapped__(self, end):
+        """Get a memory map of the file that covers at least up to byte end."""
+        if self.__map__ is None or len(self.__map__) < end:
+            if self.__map__ is not None:
+                self.__map__.close()
+            self.__file__.flush()
+            self.__map__ = mmap.mmap(self.__file__.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.__map__
+
+
+    def indexes(self):
+        """Iterate through the offset table index of every chunk stored in this file."""
+        return np.flatnonzero(self.__table__['length']).tolist()
+
+
+    def read(self, index):
+        """Returns the Chunk or ProceduralChunk at offset table index, or None if it isn't stored."""
+        offset, length, _ = self.__table__[index].tolist()
+        if length == 0: return None
+        return decompress(self.__mapped__(offset + length)[offset:offset+length])
+
+
+    def write(self, index, data):
+        """Store a chunk at offset table index.
+        data: The chunk compressed with compress()."""
+        offset, _, capacity = self.__table__[index].tolist()
+        if len(data) > capacity:
+            self.__file__.seek(0, os.SEEK_END)
+            offset = self.__file__.tell()
+            capacity = len(data)
+        self.__file__.seek(offset)
+        self.__file__.write(data)
+
+        self.__table__[index] = (offset, len(data), capacity)
+        self.__file__.seek(HEADER.size + index * ENTRY.size)
+        self.__file__.write(ENTRY.pack(offset, len(data), capacity))
+
+
+    def delete(self, index):
+        """Stop storing the chunk at offset table index. Its space is kept for the next chunk written there."""
+        offset, _, capacity = self.__table__[index].tolist()
+        self.__table__[index] = (offset, 0, capacity)
+        self.__file__.seek(HEADER.size + index * ENTRY.size)
+        self.__file__.write(ENTRY.pack(offset, 0, capacity))
+
+
+    def close(self):
+        if self.__map__ is not None:
+            self.__map__.close()
+            self.__map__ = None
+        self.__file__.close()
+
+
+class RegionStore:
+    """All the region files in a directory. Files are opened the first time a chunk in them is needed."""
+    def __init__(self, directory):
+        """Raises ValueError if there are region files in directory that can't be read or migrated."""
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.__regions__ = {} # {(rx, ry): RegionFile()}
+        self.__migrate__()
+
+
+    def __migrate__(self):
+        """Copy the chunks in region files made by an older version or with another config.WorldDataServer.RegionSize into files of the current ones, so changing either doesn't lose the saved world.
+        Every file is checked before any are changed. The old files are renamed with OLD_SUFFIX first and only deleted once their chunks are copied, so a migration that doesn't finish is picked up again next time."""
+        stale = [] # (path, rx, ry, file version, region size)
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            match = REGION_FILE_NAME.match(name[:-len(OLD_SUFFIX)] if name.endswith(OLD_SUFFIX) else name)
+            if match is None: continue
+            try:
+                version, size = read_header(path)
+            except ValueError as e:
+                raise ValueError("Can't load the world in {}: {}. Move the file out of the directory to start without the chunks in it.".format(self.directory, e))
+            if name.endswith(OLD_SUFFIX) or (version, size) != (FILE_VERSION, config.WorldDataServer.RegionSize):
+                stale.append((path, int(match.group(1)), int(match.group(2)), version, size))
+
+        for i, (path, rx, ry, version, size) in enumerate(stale):
+            if not path.endswith(OLD_SUFFIX):
+                os.rename(path, path + OLD_SUFFIX)
+                stale[i] = (path + OLD_SUFFIX, rx, ry, version, size)
+        for path, rx, ry, version, size in stale:
+            with open(path, 'rb') as f:
+                data = f.read()
+            table = np.frombuffer(data, dtype=ENTRY_DTYPE, count=size * size, offset=HEADER_V1.size if version == 1 else HEADER.size)
+            for index in np.flatnonzero(table['length']).tolist():
+                offset, length, _ = table[index].tolist()
+                lx, ly = divmod(index, size)
+                self.save_compressed(rx * size + lx, ry * size + ly, data[offset:offset+length])
+            os.remove(path)
+        self.close()
+
+
+    def __path__(self, rx, ry):
+        return os.path.join(self.directory, 'r.{}.{}.region'.format(rx, ry))
+
+
+    def __region__(self, rx, ry, create=False):
+        """Get the RegionFile for region (rx, ry). Returns None if it doesn't exist, unless create is True."""
+        region = self.__regions__.get((rx, ry))
+        if region is None:
+            if not create and not os.path.exists(self.__path__(rx, ry)):
+                return None
+            region = RegionFile(self.__path__(rx, ry))
+            self.__regions__[(rx, ry)] = region
+        return region
+
+
+    def positions(self, region_filter=None):
+        """Iterate through the (cx, cy) of every chunk stored on disk. Only reads the offset tables.
+        region_filter: If given, only regions (rx, ry) that region_filter(rx, ry) returns True for are read."""
+        size = config.WorldDataServer.RegionSize
+        for name in os.listdir(self.directory):
+            match = REGION_FILE_NAME.match(name)
+            if match is None: continue
+            rx, ry = int(match.group(1)), int(match.group(2))
+            if region_filter is not None and not region_filter(rx, ry): continue
+            for index in self.__region__(rx, ry).indexes():
+                lx, ly = divmod(index, size)
+                yield (rx * size + lx, ry * size + ly)
+
+
+    def load(self, cx, cy):
+        """Returns the Chunk or ProceduralChunk at (cx, cy) from disk, or None if it isn't stored."""
+        (rx, ry), index = region_of(cx, cy)
+        region = self.__region__(rx, ry)
+        if region is None: return None
+        return region.read(index)
+
+
+    def save(self, cx, cy, chunk):
+        """Write the Chunk or ProceduralChunk at (cx, cy) to disk."""
+        self.save_compressed(cx, cy, compress(chunk))
+
+
+    def save_compressed(self, cx, cy, data):
+        """Write the chunk at (cx, cy) to disk when it is already compressed with compress()."""
+        (rx, ry), index = region_of(cx, cy)
+        self.__region__(rx, ry, create=True).write(index, data)
+
+
+    def delete(self, cx, cy):
+        """Remove the chunk at (cx, cy) from disk, if it is stored."""
+        (rx, ry), index = region_of(cx, cy)
+        region = self.__region__(rx, ry)
+        if region is not None:
+            region.delete(index)
+
+
+    def close(self):
+        for region in self.__regions__.values():
+            region.close()
+        self.__regions__ = {}
+
+
+class TestRegionStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = RegionStore(self.directory.name)
+
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+
+    def test_region_of(self):
+        size = config.WorldDataServer.RegionSize
+        self.assertEqual(region_of(0, 0), ((0, 0), 0))
+        self.assertEqual(region_of(1, 2), ((0, 0), size + 2))
+        self.assertEqual(region_of(-1, 0), ((-1, 0), (size - 1) * size))
+        self.assertEqual(region_of(size, -size), ((1, -1), 0))
+
+
+    def test_save_load(self):
+        chunk = Chunk()
+        chunk.set_block(1, 2, 3, Block(config.BlockType.Grass))
+        self.assertIsNone(self.store.load(-5, 40))
+        self.store.save(-5, 40, chunk)
+        self.assertEqual(self.store.load(-5, 40), chunk)
+        self.assertIsNone(self.store.load(-5, 41))
+
+        # Grow the chunk so it has to be moved to the end of the file, then reopen everything.
+        for y in range(0, config.WorldDataServer.WorldHeight, 7):
+            chunk.set_block(4, y, 4, Block(config.BlockType.Water))
+        self.store.save(-5, 40, chunk)
+        self.store.save(0, 0, chunk)
+        self.store.close()
+        self.store = RegionStore(self.directory.name)
+        self.assertEqual(self.store.load(-5, 40), chunk)
+        self.assertCountEqual(self.store.positions(), [(-5, 40), (0, 0)])
+        self.assertCountEqual(self.store.positions(lambda rx, ry: rx < 0), [(-5, 40)])
+
+        self.store.save_compressed(1, 1, compress(chunk, 1))
+        self.assertEqual(self.store.load(1, 1), chunk)
+
+        self.store.delete(1, 1)
+        self.store.delete(1000, 1000)
+        self.assertIsNone(self.store.load(1, 1))
+        self.assertNotIn((1, 1), list(self.store.positions()))
+
+        procedural = ProceduralChunk('Flat', 2, 2)
+        self.store.save(2, 2, procedural)
+        self.assertEqual(self.store.load(2, 2), procedural)
+
+
+    def test_region_size(self):
+        chunks = {}
+        for pos in [(0, 0), (-1, 3), (9, -17)]:
+            chunks[pos] = Chunk()
+            chunks[pos].set_block(pos[0] % 8, 2, 3, Block(config.BlockType.Grass))
+            self.store.save(*pos, chunks[pos])
+        self.store.close()
+        orig = config.WorldDataServer.RegionSize
+        try:
+            config.WorldDataServer.RegionSize = orig * 2
+            self.store = RegionStore(self.directory.name)
+            self.assertCountEqual(self.store.positions(), chunks)
+            for pos, chunk in chunks.items():
+                self.assertEqual(self.store.load(*pos), chunk)
+            self.store.close()
+        finally:
+            config.WorldDataServer.RegionSize = orig
+        self.store = RegionStore(self.directory.name)
+        self.assertCountEqual(self.store.positions(), chunks)
+        self.assertEqual(self.store.load(9, -17), chunks[(9, -17)])
+
+
+    def test_migrate_v1(self):
+        chunk = Chunk()
+        chunk.set_block(1, 2, 3, Block(config.BlockType.Grass))
+        size = config.WorldDataServer.RegionSize
+        data = compress(chunk)
+        table = np.zeros(size * size, dtype=ENTRY_DTYPE)
+        table[size + 2] = (HEADER_V1.size + table.nbytes, len(data), len(data))
+        with open(os.path.join(self.directory.name, 'r.-1.0.region'), 'wb') as f:
+            f.write(HEADER_V1.pack(MAGIC, 1) + table.tobytes() + data)
+        with open(os.path.join(self.directory.name, 'r.0.0.region'), 'wb') as f:
+            f.write(HEADER_V1.pack(MAGIC, 1) + bytes(ENTRY.size * size * size))
+        self.assertEqual(read_header(os.path.join(self.directory.name, 'r.-1.0.region')), (1, size))
+        self.assertEqual(read_header(os.path.join(self.directory.name, 'r.0.0.region')), (1, size))
+
+        self.store = RegionStore(self.directory.name)
+        self.assertEqual(list(self.store.positions()), [(-size + 1, 2)])
+        self.assertEqual(self.store.load(-size + 1, 2), chunk)
+        self.assertEqual(read_header(os.path.join(self.directory.name, 'r.-1.0.region')), (FILE_VERSION, size))
+
+        with open(os.path.join(self.directory.name, 'r.5.5.region'), 'wb') as f:
+            f.write(b'not a region file')
+        with self.assertRaises(ValueError):
+            RegionStore(self.directory.name)
+        self.assertEqual(self.store.load(-size + 1, 2), chunk) # Nothing was changed.
+
+
+    def test_load_seed(self):
+        orig = config.WorldGenerator.Seed
+        try:
+            load_seed(self.directory.name)
+            config.WorldGenerator.Seed = orig + 1
+            load_seed(self.directory.name)
+            self.assertEqual(config.WorldGenerator.Seed, orig)
+        finally:
+            config.WorldGenerator.Seed = orig
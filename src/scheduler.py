@@ -0,0 +1,165 @@
+import unittest, queue
+from time import time
+import multiprocessing as mp
+import numpy as np
+
+
+"""A queue of chunk positions shared between processes that always hands out the one nearest the player first, instead of the oldest.
+The main process tells it where the player is with recenter every time they move into another chunk; requests that are now out of range are cancelled instead of being worked on."""
+
+
+QUEUED = 2 # Column of an entry that is 1 if the slot holds a request.
+
+
+class ChunkScheduler:
+    """Used in place of a multiprocessing.Queue of positions by WorldGenerator and WorldRenderer. get, empty and qsize work like they do on a Queue.
+    Entries live in a fixed number of slots in shared memory. Every call scans the slots, which is cheap for the few thousand a scheduler holds."""
+    def __init__(self, capacity, size=1):
+        """capacity: Max number of requests queued at once.
+        size: Each position is a size by size square of chunks, like a world_generator task. Its distance from the player is from the nearest chunk in it."""
+        self.size = size
+        self.__requests__ = mp.Array('q', capacity * 3, lock=False) # (x, y, QUEUED) for each slot.
+        self.__center__ = mp.Array('q', 3, lock=False) # (cx, cy, radius) of the player's chunk and the range of chunks to keep. Radius -1 keeps everything.
+        self.__center__[2] = -1
+        self.__condition__ = mp.Condition() # Held while the slots or center are used. Notified when something is queued.
+
+
+    def __entries__(self):
+        """The slots as an int64 array indexed [slot, (x, y, QUEUED)]. Made each time so it works on whichever side of a fork this is."""
+        return np.frombuffer(self.__requests__, dtype=np.int64).reshape(-1, 3)
+
+
+    def __distances__(self, positions):
+        """Returns (priority, distance) arrays for positions, an int array indexed [i, (x, y)]. distance is how many chunks the nearest chunk of the position is from the player's in x or y, priority is the square of how far it is."""
+        cx, cy = self.__center__[0], self.__center__[1]
+        low = positions * self.size
+        d = np.maximum(np.maximum(low - (cx, cy), 0), (cx, cy) - (low + self.size - 1))
+        return ((d * d).sum(axis=1), d.max(axis=1))
+
+
+    def __out_of_range__(self, positions):
+        """Bool array, True for each of positions that is further than the radius from the player."""
+        radius = self.__center__[2]
+        if radius < 0: return np.zeros(len(positions), dtype=bool)
+        return self.__distances__(positions)[1] > radius
+
+
+    def put(self, pos):
+        """Queue pos (x, y) if it isn't already queued. If every slot is taken, the request furthest from the player is dropped to make room for it.
+        Returns the (x, y) that was dropped, or None. Raises queue.Full if every queued request is at least as near as pos."""
+        with self.__condition__:
+            entries = self.__entries__()
+            queued = entries[:, QUEUED] == 1
+            if (queued & (entries[:, 0] == pos[0]) & (entries[:, 1] == pos[1])).any(): return None
+
+            dropped = None
+            free = np.flatnonzero(~queued)
+            if len(free) > 0:
+                slot = free[0]
+            else:
+                priorities = self.__distances__(entries[:, :2])[0]
+                slot = int(np.argmax(priorities))
+                if priorities[slot] <= self.__distances__(np.array([pos]))[0][0]:
+                    raise queue.Full()
+                dropped = (int(entries[slot, 0]), int(entries[slot, 1]))
+            entries[slot] = (pos[0], pos[1], 1)
+            self.__condition__.notify()
+            return dropped
+
+
+    def get(self, block=True, timeout=None):
+        """Take the queued (x, y) nearest the player. Raises queue.Empty if nothing is queued, after waiting up to timeout seconds (forever if None) if block is True."""
+        deadline = None if timeout is None else time() + timeout
+        with self.__condition__:
+            while True:
+                entries = self.__entries__()
+                queued = np.flatnonzero(entries[:, QUEUED])
+                if len(queued) > 0:
+                    slot = queued[np.argmin(self.__distances__(entries[queued, :2])[0])]
+                    entries[slot, QUEUED] = 0
+                    return (int(entries[slot, 0]), int(entries[slot, 1]))
+                remaining = None if deadline is None else deadline - time()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise queue.Empty()
+                self.__condition__.wait(remaining)
+
+
+    def recenter(self, cx, cy, radius=None):
+        """Move the player to chunk (cx, cy). Queued requests further than radius chunks away in x or y are cancelled.
+        Returns the [(x, y), ...] that were cancelled."""
+        with self.__condition__:
+            self.__center__[0], self.__center__[1] = cx, cy
+            self.__center__[2] = -1 if radius is None else radius
+            entries = self.__entries__()
+            queued = np.flatnonzero(entries[:, QUEUED])
+            cancelled = queued[self.__out_of_range__(entries[queued, :2])]
+            entries[cancelled, QUEUED] = 0
+            return [tuple(pos) for pos in entries[cancelled, :2].tolist()]
+
+
+    def in_range(self, pos):
+        """False if pos (x, y) is further from the player than the radius given to recenter."""
+        with self.__condition__:
+            return not self.__out_of_range__(np.array([pos]))[0]
+
+
+    def qsize(self):
+        with self.__condition__:
+            return int(self.__entries__()[:, QUEUED].sum())
+
+
+    def empty(self):
+        return self.qsize() == 0
+
+
+    def clear(self):
+        """Cancel every queued request."""
+        with self.__condition__:
+            self.__entries__()[:, QUEUED] = 0
+
+
+
+class TestChunkScheduler(unittest.TestCase):
+    def test_order(self):
+        scheduler = ChunkScheduler(8)
+        for pos in [(5, 5), (-1, 0), (0, 0), (3, -2), (-1, 0)]:
+            self.assertIsNone(scheduler.put(pos))
+        self.assertEqual(scheduler.qsize(), 4)
+        self.assertEqual([scheduler.get(block=False) for i in range(4)], [(0, 0), (-1, 0), (3, -2), (5, 5)])
+        with self.assertRaises(queue.Empty):
+            scheduler.get(timeout=0.01)
+
+        scheduler.recenter(4, 3)
+        for pos in [(0, 0), (5, 5), (4, 4)]:
+            scheduler.put(pos)
+        self.assertEqual(scheduler.get(), (4, 4))
+        scheduler.clear()
+        self.assertTrue(scheduler.empty())
+
+
+    def test_full(self):
+        scheduler = ChunkScheduler(2)
+        scheduler.put((3, 0))
+        scheduler.put((1, 0))
+        self.assertEqual(scheduler.put((0, 0)), (3, 0))
+        with self.assertRaises(queue.Full):
+            scheduler.put((2, 0))
+        self.assertEqual([scheduler.get(), scheduler.get()], [(0, 0), (1, 0)])
+
+
+    def test_recenter(self):
+        scheduler = ChunkScheduler(8, size=4)
+        for pos in [(0, 0), (1, 0), (2, 0), (-1, -1)]:
+            scheduler.put(pos)
+        self.assertCountEqual(scheduler.recenter(9, 1, radius=2), [(0, 0), (-1, -1)])
+        self.assertTrue(scheduler.in_range((1, 0)))
+        self.assertFalse(scheduler.in_range((0, 0)))
+        self.assertEqual([scheduler.get(), scheduler.get()], [(2, 0), (1, 0)])
+
+
+    def test_processes(self):
+        scheduler = ChunkScheduler(4)
+        process = mp.Process(target=scheduler.put, args=((7, 7),))
+        process.start()
+        self.assertEqual(scheduler.get(timeout=5), (7, 7))
+        process.join()
@@ -0,0 +1,275 @@
+import sys, unittest
+from collections import OrderedDict
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+import config
+from chunk import Chunk
+from block import Block
+
+
+"""Keeps chunk blocks in multiprocessing.shared_memory so the WorldDataServer can send clients a small SharedChunkHandle instead of pickling the whole chunk through a pipe.
+Shared memory is split into pages that each hold one section of a chunk behind a version header. A chunk only takes a page for each section that has blocks in it, so a generated chunk usually takes one or two. Clients copy each page straight into a numpy array and check its header before and after, so a page the server rewrote or reused is never read as the chunk the client asked for."""
+
+
+HEADER_SIZE = np.dtype(np.uint64).itemsize # Bytes at the start of each page that hold the version of the chunk in it.
+
+
+def section_size():
+    """How many bytes a full height section takes up in a page."""
+    return config.WorldDataServer.ChunkSize * config.WorldDataServer.SectionHeight * config.WorldDataServer.ChunkSize
+
+
+def page_size():
+    """How many bytes one section takes up in a segment, with its header."""
+    return HEADER_SIZE + section_size()
+
+
+class SharedChunkHandle:
+    """What the WorldDataServer sends back instead of a chunk. Says where the chunk's blocks are in shared memory."""
+    __slots__ = ('pages', 'version', 'sections', 'generated')
+
+    def __init__(self, pages, version, sections, generated):
+        """pages: (segment name, offset) of the page for each of sections. Empty if the chunk has no blocks.
+        version: The version written in the page headers when this handle was made.
+        sections: The sy of every section that has blocks in it.
+        generated: Whether the chunk is generated."""
+        self.pages = tuple(pages)
+        self.version = version
+        self.sections = tuple(sections)
+        self.generated = generated
+
+
+    def __repr__(self):
+        return "SharedChunkHandle({} pages, version {})".format(len(self.pages), self.version)
+
+
+class SharedChunkStore:
+    """Used inside the WorldDataServer process to copy chunks into shared memory. Each chunk keeps its pages until it is released or they are needed for another chunk, and they are only rewritten when the chunk changed.
+    At most config.WorldDataServer.MaxSharedPages pages are made. Once they are all used, the pages of the chunks that were least recently published are taken back."""
+    def __init__(self):
+        self.__segments__ = [] # shared_memory.SharedMemory() objects, each with config.WorldDataServer.SharedPagesPerSegment pages.
+        self.__chunk_pages__ = OrderedDict() # (cx, cy): (chunk digest, [(segment index, page index), ...], SharedChunkHandle()) from least to most recently published.
+        self.__free_pages__ = [] # (segment index, page index): Pages that can be reused.
+        self.__version__ = 0 # Increases every time a chunk is written.
+
+
+    def page_count(self):
+        """Returns (pages in use, pages made)."""
+        made = len(self.__segments__) * config.WorldDataServer.SharedPagesPerSegment
+        return (made - len(self.__free_pages__), made)
+
+
+    def __allocate__(self, count, cx, cy):
+        """Get count free (segment index, page index)s for chunk (cx, cy). New segments are made until there are config.WorldDataServer.MaxSharedPages pages, after that other chunks' pages are taken back."""
+        while len(self.__free_pages__) < count:
+            per_segment = config.WorldDataServer.SharedPagesPerSegment
+            limit = config.WorldDataServer.MaxSharedPages
+            others = [pos for pos in self.__chunk_pages__ if pos != (cx, cy)]
+            if limit is None or (len(self.__segments__) + 1) * per_segment <= limit or len(others) == 0:
+                segment = shared_memory.SharedMemory(create=True, size=per_segment * page_size())
+                self.__segments__.append(segment)
+                s = len(self.__segments__) - 1
+                self.__free_pages__.extend((s, i) for i in reversed(range(per_segment)))
+            else:
+                self.release(*others[0])
+        return [self.__free_pages__.pop() for i in range(count)]
+
+
+    def publish(self, cx, cy, chunk):
+        """Make sure the blocks of chunk are in shared memory and return a SharedChunkHandle for them."""
+        entry = self.__chunk_pages__.get((cx, cy))
+        if entry is not None and entry[0] == chunk.digest() and entry[2].generated == chunk.is_generated():
+            self.__chunk_pages__.move_to_end((cx, cy))
+            return entry[2]
+
+        sections = [(sy, s) for sy, s in chunk.sections(cache=False) if s.any()]
+        if len(sections) == 0:
+            self.release(cx, cy)
+            return SharedChunkHandle((), 0, (), chunk.is_generated())
+
+        pages = [] if entry is None else entry[1]
+        if len(pages) > len(sections):
+            self.__free__(pages[len(sections):])
+            pages = pages[:len(sections)]
+        elif len(pages) < len(sections):
+            self.__chunk_pages__.pop((cx, cy), None) # So it isn't taken back to make room for itself.
+            pages = pages + self.__allocate__(len(sections) - len(pages), cx, cy)
+
+        self.__version__ += 1
+        locations = []
+        for (s, i), (sy, section) in zip(pages, sections):
+            segment = self.__segments__[s]
+            offset = i * page_size()
+            header = np.ndarray((1,), dtype=np.uint64, buffer=segment.buf, offset=offset)
+            header[0] = 0 # Mark the page as being written.
+            view = np.ndarray(section.shape, dtype=np.uint8, buffer=segment.buf, offset=offset + HEADER_SIZE)
+            view[...] = section
+            header[0] = self.__version__
+            del header, view # Views into the segment have to be gone before it can be closed.
+            locations.append((segment.name, offset))
+
+        handle = SharedChunkHandle(locations, self.__version__, [sy for sy, _ in sections], chunk.is_generated())
+        self.__chunk_pages__[(cx, cy)] = (chunk.digest(), pages, handle)
+        self.__chunk_pages__.move_to_end((cx, cy))
+        return handle
+
+
+    def __free__(self, pages):
+        """Clear the headers of pages so handles to them stop being current, and let them be reused."""
+        for s, i in pages:
+            header = np.ndarray((1,), dtype=np.uint64, buffer=self.__segments__[s].buf, offset=i * page_size())
+            header[0] = 0
+            del header
+        self.__free_pages__.extend(pages)
+
+
+    def release(self, cx, cy):
+        """Stop sharing chunk (cx, cy) so its pages can be reused. Handles for it stop being current."""
+        entry = self.__chunk_pages__.pop((cx, cy), None)
+        if entry is not None:
+            self.__free__(entry[1])
+
+
+    def close(self):
+        """Free all the shared memory. Clients can't read any handles after this."""
+        for segment in self.__segments__:
+            segment.close()
+            segment.unlink()
+        self.__segments__ = []
+        self.__chunk_pages__ = OrderedDict()
+        self.__free_pages__ = []
+
+
+class SharedChunkReader:
+    """Used by a WorldDataClient to turn SharedChunkHandles back into Chunks. The blocks are copied straight out of the shared memory, so nothing is pickled or sent through the pipe."""
+    def __init__(self):
+        self.__segments__ = {} # name: shared_memory.SharedMemory()
+
+
+    def __attach__(self, name):
+        """Get the segment called name, attaching to it the first time."""
+        segment = self.__segments__.get(name)
+        if segment is None:
+            if sys.version_info >= (3, 13):
+                segment = shared_memory.SharedMemory(name=name, track=False)
+            else:
+                segment = shared_memory.SharedMemory(name=name)
+                resource_tracker.unregister(segment._name, 'shared_memory') # The server owns the segment, don't let this process unlink it when it exits.
+            self.__segments__[name] = segment
+        return segment
+
+
+    def read(self, handle):
+        """Returns a read only Chunk with a copy of the blocks for the given SharedChunkHandle, or None if its pages were rewritten or reused since the handle was made, so the chunk has to be asked for again.
+        The blocks are copied because the server reuses pages for other chunks. The page versions are checked again after copying, so a copy of a page the server was writing part way through is never returned."""
+        if not self.is_current(handle): return None
+        sections = [None] * Chunk.section_count()
+        for sy, (name, offset) in zip(handle.sections, handle.pages):
+            view = np.ndarray(Chunk.section_shape(sy), dtype=np.uint8, buffer=self.__attach__(name).buf, offset=offset + HEADER_SIZE)
+            section = view.copy()
+            section.flags.writeable = False
+            sections[sy] = section
+            del view # Views into the segment have to be gone before it can be closed.
+        if not self.is_current(handle): return None
+        return Chunk.from_sections(sections, handle.generated, handle.version)
+
+
+    def is_current(self, handle):
+        """True if none of the pages for handle were rewritten since the handle was made."""
+        for name, offset in handle.pages:
+            if int(np.ndarray((1,), dtype=np.uint64, buffer=self.__attach__(name).buf, offset=offset)[0]) != handle.version:
+                return False
+        return True
+
+
+    def close(self):
+        """Detach from all the segments. Chunks read from them can't be used after this."""
+        for segment in self.__segments__.values():
+            try:
+                segment.close()
+            except BufferError: pass # Something still has a view of it, the OS will clean it up on exit.
+        self.__segments__ = {}
+
+
+class TestSharedChunks(unittest.TestCase):
+    def setUp(self):
+        self.store = SharedChunkStore()
+        self.reader = SharedChunkReader()
+
+
+    def tearDown(self):
+        self.reader.close()
+        self.store.close()
+
+
+    def test_publish_read(self):
+        chunk = Chunk()
+        chunk.set_block(1, 2, 3, Block(config.BlockType.Grass))
+        chunk.set_block(1, 200, 3, Block(config.BlockType.Water))
+        handle = self.store.publish(0, 0, chunk)
+        self.assertEqual(len(handle.sections), 2)
+        res = self.reader.read(handle)
+        self.assertEqual(chunk, res)
+        self.assertTrue(res.is_generated())
+        with self.assertRaises(ValueError):
+            res.set_block(1, 2, 3, Block(config.BlockType.Water))
+
+
+    def test_republish(self):
+        chunk = Chunk()
+        chunk.set_block(1, 2, 3, Block(config.BlockType.Grass))
+        handle = self.store.publish(0, 0, chunk)
+        self.assertIs(handle, self.store.publish(0, 0, chunk))
+
+        chunk.set_block(1, 2, 3, Block(config.BlockType.Water))
+        new_handle = self.store.publish(0, 0, chunk)
+        self.assertEqual(handle.pages, new_handle.pages)
+        self.assertFalse(self.reader.is_current(handle))
+        self.assertTrue(self.reader.is_current(new_handle))
+
+        res = self.reader.read(new_handle)
+        self.assertIsNone(self.reader.read(handle))
+        self.store.release(0, 0)
+        self.assertFalse(self.reader.is_current(new_handle))
+        self.assertIsNone(self.reader.read(new_handle))
+
+        # The page is reused for another chunk, but what was read from it doesn't change.
+        other = Chunk()
+        other.set_block(1, 2, 3, Block(config.BlockType.Grass))
+        self.assertEqual(self.store.publish(5, 5, other).pages, new_handle.pages)
+        self.assertEqual(res.get_block(1, 2, 3), Block(config.BlockType.Water))
+
+
+    def test_pages(self):
+        orig = (config.WorldDataServer.SharedPagesPerSegment, config.WorldDataServer.MaxSharedPages)
+        config.WorldDataServer.SharedPagesPerSegment, config.WorldDataServer.MaxSharedPages = 2, 4
+        try:
+            chunk = Chunk()
+            chunk.set_block(1, 2, 3, Block(config.BlockType.Grass))
+            handles = [self.store.publish(i, 0, chunk) for i in range(4)]
+            self.assertEqual(self.store.page_count(), (4, 4))
+
+            # Full, so the least recently published chunk gives its page back.
+            self.store.publish(0, 0, chunk)
+            tall = Chunk()
+            tall.set_block(1, 2, 3, Block(config.BlockType.Grass))
+            tall.set_block(1, 100, 3, Block(config.BlockType.Grass))
+            handle = self.store.publish(9, 9, tall)
+            self.assertEqual(self.store.page_count(), (4, 4))
+            self.assertEqual(self.reader.read(handle), tall)
+            self.assertTrue(self.reader.is_current(handles[0]))
+            self.assertFalse(self.reader.is_current(handles[1]))
+            self.assertFalse(self.reader.is_current(handles[2]))
+
+            # Fewer sections give pages back.
+            tall.set_block(1, 100, 3, Block(config.BlockType.Empty))
+            self.store.publish(9, 9, tall)
+            self.assertEqual(self.store.page_count(), (3, 4))
+        finally:
+            config.WorldDataServer.SharedPagesPerSegment, config.WorldDataServer.MaxSharedPages = orig
+
+
+    def test_empty(self):
+        handle = self.store.publish(0, 0, Chunk())
+        self.assertEqual(handle.pages, ())
+        self.assertFalse(self.reader.read(handle).is_generated())
@@ -1,15 +1,102 @@
-import logging, random, unittest, string, itertools
+import logging, random, unittest, string, itertools, asyncio, tempfile, os, select
 import multiprocessing as mp
-from collections import defaultdict
-from chunk import Chunk
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from collections import OrderedDict, deque
+from time import time
+from chunk import Chunk, BLOCK_IDS
 from block import Block
+from shared_chunks import SharedChunkStore, SharedChunkReader
+from world_protocol import make_codec
+from metrics import RequestMetrics
+from procedural import ProceduralChunk
+import generations
+import region_files
 import config
 
 
 # TODO Instead of returning request data from a WorldDataClient, it should set a 'last_response' variable.
 
+def chunk_version(chunk):
+    """What a WorldDataClient's read cache compares with the server to see if its copy of a chunk is out of date."""
+    return (chunk.digest(), chunk.is_generated())
+
+
+def shard_of_region(rx, ry, shards):
+    """Which of shards WorldDataServer shards owns region (rx, ry). See region_files.region_of."""
+    return ((rx * 73856093) ^ (ry * 19349663)) % shards
+
+
+def shard_of(cx, cy, shards):
+    """Which of shards WorldDataServer shards owns chunk (cx, cy). Whole regions belong to one shard, so no two processes ever write the same region file."""
+    return shard_of_region(*region_files.region_of(cx, cy)[0], shards)
+
+
+class WorldRequestFuture(Future):
+    """What a WorldDataClient returns for a request sent with block=False. Calling result() waits for the server's reply, handling the replies to any other requests that arrive first.
+    To use it with asyncio, call WorldDataClient.add_to_event_loop first and then `await` it."""
+    def __init__(self, client, req_id, handle_response, cmd=None):
+        """client: The WorldDataClient that sent the request.
+        req_id: The ID the request was sent with.
+        handle_response: Turns the raw reply from the server into the result.
+        cmd: The config.WorldRequests that was sent, for the client's metrics."""
+        super(WorldRequestFuture, self).__init__()
+        self.client = client
+        self.req_id = req_id
+        self.handle_response = handle_response
+        self.cmd = cmd
+        self.sent_at = time()
+
+
+    def result(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for the reply and return the result of the request. Raises concurrent.futures.TimeoutError if it took too long."""
+        self.client.wait_for(self, timeout)
+        return super(WorldRequestFuture, self).result(timeout=0)
+
+
+    def __await__(self):
+        return asyncio.wrap_future(self).__await__()
+
+
+class ShardedRequestFuture(Future):
+    """What a ShardedWorldDataClient returns for a request that was split between WorldDataServer shards with block=False. Its result combines the results of the WorldRequestFutures sent to each shard."""
+    def __init__(self, futures, combine):
+        """futures: The WorldRequestFutures sent to each shard.
+        combine: Turns the list of their results into the result."""
+        super(ShardedRequestFuture, self).__init__()
+        self.futures = futures
+        self.combine = combine
+        self.__remaining__ = len(futures)
+        if len(futures) == 0:
+            self.set_result(combine([]))
+        for future in futures:
+            future.add_done_callback(self.__shard_done__)
+
+
+    def __shard_done__(self, future):
+        """Called as each shard's future is resolved. Resolves this one when they all are."""
+        self.__remaining__ -= 1
+        if self.__remaining__ > 0 or self.done(): return
+        try:
+            self.set_result(self.combine([f.result(timeout=0) for f in self.futures]))
+        except Exception as e:
+            self.set_exception(e)
+
+
+    def result(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for every shard to reply and return the combined result. Raises concurrent.futures.TimeoutError if it took too long."""
+        end = None if timeout is None else time() + timeout
+        for future in self.futures:
+            future.result(None if end is None else max(0, end - time()))
+        return super(ShardedRequestFuture, self).result(timeout=0)
+
+
+    def __await__(self):
+        return asyncio.wrap_future(self).__await__()
+
+
 class WorldDataClient:
-    """An object that connects to the WorldDataServer. Each seperate thread or process requires a seperate instance of this, Not a copy of it. You must use .new_client from the main client to create new instances."""
+    """An object that connects to the WorldDataServer. Each seperate thread or process requires a seperate instance of this, Not a copy of it. You must use .new_client from the main client to create new instances.
+    Every request is sent with an ID and the server's reply carries the same ID, so any number of requests can be in flight at once. Pass block=False to get a WorldRequestFuture instead of waiting for the result."""
     def __init__(self, name, pipe, parent_log):
         """Shouldn't be created unless inside WorldDataServer.
         name:  The name of the client (like WorldGenerator, or WorldRenderer)
@@ -18,28 +105,184 @@ class WorldDataClient:
 
         self.name = name
         self.pipe = pipe
+        self.__codec__ = make_codec() # How requests are written to the pipe. The server uses the same config, so they always match.
+        self.__shared_chunks__ = None # SharedChunkReader(), created the first time the server sends a chunk through shared memory.
+        self.__next_id__ = 0 # The ID to send with the next request.
+        self.__in_flight__ = {} # {request ID: WorldRequestFuture()} for requests that haven't been replied to yet.
+        self.__events__ = deque() # (config.ChunkEvents, (cx, cy), delta or None) received from the server that get_events hasn't returned yet.
+        self.__cache__ = OrderedDict() # {(cx, cy): (Chunk(), SharedChunkHandle() or None)} from least to most recently used. See config.WorldDataClient.CacheSize.
+        self.__cache_stats__ = {'local': 0, 'unchanged': 0, 'fetched': 0} # Chunks returned from the cache without a request, returned from the cache after the server said they're unchanged, and sent by the server.
         try:
             self.log = parent_log.getChild("WorldDataClient")
             self.log.setLevel(config.WorldDataClient.LogLevel)
         except AttributeError as e:
             raise Exception("Invalid parent logger", e)
-        #TODO add some performance metrics tracking the number of requests sent in a minute and time waiting for responses.
+        self.__metrics__ = RequestMetrics() # How many of each request were sent, how long the replies took and how many bytes went each way.
 
 
-    def __send_request__(self, cmd, data=None):
-        """Sends requests to the server as well as logging what is sent and received. WAITS until something is received from the server!
+    def __send_async__(self, cmd, data=None, handle_response=None):
+        """Sends a request to the server without waiting for the reply.
         cmd:  An instance of config.WorldRequests that specifies the request type.
         data: A dictionary of config.WorldRequestData keys that contains the data for the request.
-        returns the response from the server in the form (instance of config.WorldRequests, dict of config.WorldRequestData keys)"""
-
-        req = (cmd, data)
+        handle_response: Turns the reply into the future's result. The raw reply is used if this is None.
+        Returns a WorldRequestFuture for the reply."""
+        req_id = self.__next_id__
+        self.__next_id__ += 1
+        future = WorldRequestFuture(self, req_id, handle_response or (lambda res: res), cmd)
+        self.__in_flight__[req_id] = future
+
+        req = (cmd, data, req_id, future.sent_at) # The server uses the time it was sent to measure how long requests wait for it.
         self.log.debug("Sending request: {}".format(req))
-        self.pipe.send(req)
+        self.__metrics__.sent(cmd, self.__codec__.send(self.pipe, req))
+        return future
 
-        res = self.pipe.recv()
+
+    def __send_request__(self, cmd, data=None):
+        """Sends requests to the server as well as logging what is sent and received. WAITS until something is received from the server!
+        cmd:  An instance of config.WorldRequests that specifies the request type.
+        data: A dictionary of config.WorldRequestData keys that contains the data for the request.
+        returns the response from the server in the form (instance of config.WorldRequests, dict of config.WorldRequestData keys, request ID)"""
+        return self.__send_async__(cmd, data).result()
+
+
+    def __request__(self, cmd, data, handle_response, block):
+        """Send a request and either wait for and return its result, or return a WorldRequestFuture for it if block is False."""
+        future = self.__send_async__(cmd, data, handle_response)
+        if block:
+            return future.result()
+        return future
+
+
+    def __receive__(self):
+        """Receive one reply from the server and resolve the future it belongs to."""
+        res, nbytes = self.__codec__.recv_sized(self.pipe)
+        if self.__metrics__.dump_due():
+            self.log.log(config.Metrics.DumpLevel, "Request metrics for client '{}':\n{}".format(self.name, self.__metrics__.format()))
+        if res[0] is config.WorldRequests.ChunkEventMsg:
+            self.__metrics__.received(res[0], nbytes)
+            event, pos = res[1][config.WorldRequestData.ChunkEvent], res[1][config.WorldRequestData.ChunkPos]
+            if event is not config.ChunkEvents.Evicted:
+                self.__cache__.pop(pos, None)
+            self.__events__.append((event, pos, res[1].get(config.WorldRequestData.Delta)))
+            return
         self.log.debug("Server replied to request: {}".format(res))
 
-        return res
+        future = self.__in_flight__.pop(res[2], None)
+        if future is None:
+            self.log.warning("Received a reply to unknown request {}".format(res[2]))
+            return
+        self.__metrics__.received(future.cmd, nbytes)
+        self.__metrics__.finished(future.cmd, time() - future.sent_at)
+        try:
+            future.set_result(future.handle_response(res))
+        except Exception as e:
+            future.set_exception(e)
+
+
+    def wait_for(self, future, timeout=None):
+        """Receive replies until future is resolved. Raises concurrent.futures.TimeoutError if that takes more than timeout seconds."""
+        end = None if timeout is None else time() + timeout
+        while not future.done():
+            remaining = None if end is None else max(0, end - time())
+            if not self.pipe.poll(remaining):
+                raise FutureTimeoutError("No reply to request {} after {} seconds".format(future.req_id, timeout))
+            self.__receive__()
+
+
+    def poll(self):
+        """Handle every reply and chunk event that has already arrived without waiting. Returns the number of requests still in flight."""
+        while self.pipe.poll():
+            self.__receive__()
+        return len(self.__in_flight__)
+
+
+    def add_to_event_loop(self, loop):
+        """Have an asyncio event loop handle replies as they arrive, so WorldRequestFutures can be awaited in it."""
+        loop.add_reader(self.pipe.fileno(), self.poll)
+
+
+    def __read_shared__(self, handle):
+        """Get the Chunk for a SharedChunkHandle the server sent. None if the server rewrote or reused its pages before they were read, see SharedChunkReader.read."""
+        if self.__shared_chunks__ is None:
+            self.__shared_chunks__ = SharedChunkReader()
+        return self.__shared_chunks__.read(handle)
+
+
+    def __resolved__(self, result, block):
+        """Return result like __request__ would for a request that didn't have to be sent."""
+        if block:
+            return result
+        future = WorldRequestFuture(self, None, None)
+        future.set_result(result)
+        return future
+
+
+    def __cached__(self, cx, cy):
+        """Look up chunk (cx, cy) in the read cache.
+        Returns (Chunk, True) if it can be used without asking the server, (Chunk, False) if the server has to say it is unchanged first, or (None, False) if it isn't cached.
+        Chunks in shared memory are checked against their page versions, so they never need to ask the server."""
+        entry = self.__cache__.get((cx, cy))
+        if entry is None:
+            return (None, False)
+        chunk, handle = entry
+        if handle is None:
+            return (chunk, False)
+        if len(handle.pages) > 0 and self.__shared_chunks__.is_current(handle):
+            self.__cache__.move_to_end((cx, cy))
+            self.__cache_stats__['local'] += 1
+            return (chunk, True)
+        del self.__cache__[(cx, cy)]
+        return (None, False)
+
+
+    def __cache_put__(self, cx, cy, chunk, handle=None):
+        """Add a chunk the server sent (or said is unchanged) to the read cache, dropping the least recently used chunks if it is full."""
+        if not config.WorldDataClient.CacheSize: return
+        self.__cache__[(cx, cy)] = (chunk, handle)
+        self.__cache__.move_to_end((cx, cy))
+        while len(self.__cache__) > config.WorldDataClient.CacheSize:
+            self.__cache__.popitem(last=False)
+
+
+    def __received_chunks__(self, data, cached):
+        """Get {(cx, cy): Chunk()} from the reply to a chunk request and update the read cache with them.
+        data: The reply's dict of config.WorldRequestData keys.
+        cached: {(cx, cy): Chunk()} from the cache whose versions were sent with the request.
+        Returns None if a chunk sent through shared memory was changed before it could be read, so the request has to be sent again."""
+        chunks = {}
+        for pos in data.get(config.WorldRequestData.Unchanged, ()):
+            chunks[pos] = cached[pos]
+            self.__cache_put__(*pos, cached[pos])
+            self.__cache_stats__['unchanged'] += 1
+        handles = dict(data.get(config.WorldRequestData.SharedChunks, {}))
+        if config.WorldRequestData.SharedChunk in data:
+            handles[data[config.WorldRequestData.ChunkPos]] = data[config.WorldRequestData.SharedChunk]
+        for pos, handle in handles.items():
+            chunks[pos] = self.__read_shared__(handle)
+            if chunks[pos] is None:
+                self.log.warning("Chunk {} changed in shared memory before it was read.".format(pos))
+                return None
+            self.__cache_put__(*pos, chunks[pos], handle)
+        sent = dict(data.get(config.WorldRequestData.Chunks, {}))
+        if config.WorldRequestData.ChunkData in data:
+            sent[data[config.WorldRequestData.ChunkPos]] = data[config.WorldRequestData.ChunkData]
+        for pos, chunk in sent.items():
+            chunks[pos] = chunk
+            self.__cache_put__(*pos, chunk)
+        self.__cache_stats__['fetched'] += len(handles) + len(sent)
+        return chunks
+
+
+    def local_stats(self):
+        """Returns metrics.RequestMetrics.snapshot() for the requests this client sent, with cache_stats() added as 'cache'."""
+        return dict(self.__metrics__.snapshot(), cache=self.cache_stats())
+
+
+    def cache_stats(self):
+        """Returns {'local', 'unchanged', 'fetched', 'cached'} counts for the read cache."""
+        stats = dict(self.__cache_stats__)
+        stats['cached'] = len(self.__cache__)
+        return stats
 
 
     def __handle_fail__(self, req):
@@ -51,13 +294,14 @@ class WorldDataClient:
         return False
 
 
-    def ping(self):
+    def ping(self, block=True):
         """Just a ping to check the server is still connected.
         Returns {config.WorldRequestData.Pong: 'pong'} if successful, else returns None."""
         req = config.WorldRequests.PingReq
-        res = self.__send_request__(req)
-        if self.__handle_fail__(res): return None
-        else: return res[1]
+        def handle_response(res):
+            if self.__handle_fail__(res): return None
+            else: return res[1]
+        return self.__request__(req, None, handle_response, block)
 
 
     def new_client(self, name=None):
@@ -70,7 +314,7 @@ class WorldDataClient:
         else: return res[1]
 
 
-    def set_chunk(self, cx, cy, chunk):
+    def set_chunk(self, cx, cy, chunk, block=True):
         """Requests that the server set the chunk data for chunk position (cx, cy). Will wait until the server responds with a success or failure.
         cx: x position of the chunk to set.
         cy: y position of the chunk to set.
@@ -78,41 +322,208 @@ class WorldDataClient:
         Returns False if successful, else returns True."""
         req = config.WorldRequests.SetChunkReq
         req_data = {config.WorldRequestData.ChunkPos: (cx, cy), config.WorldRequestData.ChunkData: chunk}
-        res = self.__send_request__(req, req_data)
-        return self.__handle_fail__(res)
+        self.__cache__.pop((cx, cy), None)
+        return self.__request__(req, req_data, self.__handle_fail__, block)
 
 
-    def init_chunk(self, cx, cy, chunk):
+    def init_chunk(self, cx, cy, chunk, block=True):
         """Requests that the server set the chunk data for chunk position (cx, cy) ONLY if the chunk was previously ungenerated. Will wait until the server responds with a success or failure.
         cx: x position of the chunk to set.
         cy: y position of the chunk to set.
-        chunk: A Chunk object to put at the specified location.
+        chunk: A Chunk object to put at the specified location, or a procedural.ProceduralChunk to only store how to make it. See WorldDataServer.set_procedural.
         Returns False if chunk wasn't already generated and setting the chunk was successful, else returns True."""
         req = config.WorldRequests.InitChunkReq
         req_data = {config.WorldRequestData.ChunkPos: (cx, cy), config.WorldRequestData.ChunkData: chunk}
-        res = self.__send_request__(req, req_data)
-        return self.__handle_fail__(res)
+        self.__cache__.pop((cx, cy), None)
+        return self.__request__(req, req_data, self.__handle_fail__, block)
 
 
-    def get_chunk(self, cx, cy):
+    def get_chunk(self, cx, cy, block=True):
         """Returns a Chunk object for the requested location. Will wait until the server responds with the chunk.
         cx: x position of the chunk to set.
         cy: y position of the chunk to set.
-        Returns {config.WorldRequestData.ChunkData: Chunk()} if successful, else returns None"""
+        Returns {config.WorldRequestData.ChunkData: Chunk()} if successful, else returns None.
+        If the server sent the chunk through shared memory, the Chunk is read only and its blocks change if the server shares a newer version of it.
+        Chunks in the read cache (see config.WorldDataClient.CacheSize) are only sent again if they changed, so the same Chunk object can be returned more than once. Don't change it."""
+        chunk, current = self.__cached__(cx, cy)
+        if current:
+            return self.__resolved__({config.WorldRequestData.ChunkData: chunk}, block)
+
         req = config.WorldRequests.GetChunkReq
         req_data = {config.WorldRequestData.ChunkPos: (cx, cy)}
-        res = self.__send_request__(req, req_data)
-        if self.__handle_fail__(res): return None
-        else: return res[1]
-
-
-    def is_generated(self, cx, cy):
+        cached = {}
+        if chunk is not None:
+            cached[(cx, cy)] = chunk
+            req_data[config.WorldRequestData.Versions] = {(cx, cy): chunk_version(chunk)}
+        def handle_response(res):
+            if self.__handle_fail__(res): return None
+            data = dict(res[1])
+            data[config.WorldRequestData.ChunkPos] = (cx, cy)
+            chunks = self.__received_chunks__(data, cached)
+            if chunks is None: return None
+            return {config.WorldRequestData.ChunkData: chunks[(cx, cy)]}
+        return self.__request__(req, req_data, handle_response, block)
+
+
+    def is_generated(self, cx, cy, block=True):
         """Returns True if the chunk has already been generated, False otherwise."""
         req = config.WorldRequests.IsGenerated
         req_data = {config.WorldRequestData.ChunkPos: (cx, cy)}
-        res = self.__send_request__(req, req_data)
-        if self.__handle_fail__(res): return None
-        else: return res[1][config.WorldRequestData.Boolean]
+        def handle_response(res):
+            if self.__handle_fail__(res): return None
+            else: return res[1][config.WorldRequestData.Boolean]
+        return self.__request__(req, req_data, handle_response, block)
+
+
+    def get_chunks(self, positions, block=True):
+        """Get many chunks with a single request. Will wait until the server responds with all of them.
+        positions: An iterable of (cx, cy) chunk positions.
+        Returns {(cx, cy): Chunk()} if successful, else returns None. See get_chunk for chunks sent through shared memory and the read cache."""
+        positions = list(positions)
+        local = {} # Chunks from the cache that don't need to be requested.
+        cached = {} # Chunks from the cache the server has to say are unchanged.
+        for pos in positions:
+            chunk, current = self.__cached__(*pos)
+            if current:
+                local[pos] = chunk
+            elif chunk is not None:
+                cached[pos] = chunk
+        remaining = [pos for pos in positions if pos not in local]
+        if len(remaining) == 0:
+            return self.__resolved__(local, block)
+
+        req = config.WorldRequests.GetChunksReq
+        req_data = {config.WorldRequestData.ChunkPositions: remaining}
+        if len(cached) > 0:
+            req_data[config.WorldRequestData.Versions] = {pos: chunk_version(chunk) for pos, chunk in cached.items()}
+        def handle_response(res):
+            if self.__handle_fail__(res): return None
+            chunks = self.__received_chunks__(res[1], cached)
+            if chunks is None: return None
+            chunks.update(local)
+            return chunks
+        return self.__request__(req, req_data, handle_response, block)
+
+
+    def init_chunks(self, chunks, block=True):
+        """Like init_chunk, but for many chunks with a single request.
+        chunks: {(cx, cy): Chunk() or ProceduralChunk()} to initialize.
+        Returns {(cx, cy): False if that chunk was initialized, True if it was already generated or failed}, or None if the whole request failed."""
+        req = config.WorldRequests.InitChunksReq
+        req_data = {config.WorldRequestData.Chunks: dict(chunks)}
+        for pos in req_data[config.WorldRequestData.Chunks]:
+            self.__cache__.pop(pos, None)
+        def handle_response(res):
+            if self.__handle_fail__(res): return None
+            else: return res[1][config.WorldRequestData.Results]
+        return self.__request__(req, req_data, handle_response, block)
+
+
+    def is_generated_many(self, positions, block=True):
+        """Like is_generated, but for many chunks with a single request.
+        positions: An iterable of (cx, cy) chunk positions.
+        Returns {(cx, cy): True if generated, False otherwise}, or None if the request failed."""
+        req = config.WorldRequests.IsGeneratedManyReq
+        req_data = {config.WorldRequestData.ChunkPositions: list(positions)}
+        def handle_response(res):
+            if self.__handle_fail__(res): return None
+            else: return res[1][config.WorldRequestData.Results]
+        return self.__request__(req, req_data, handle_response, block)
+
+
+    def claim_chunks(self, positions, block=True):
+        """Claim chunks to generate, so no other client generates them at the same time. A claim lasts until the chunk is set or initialized, this client disconnects, or config.WorldDataServer.ClaimTimeout passes.
+        positions: An iterable of (cx, cy) chunk positions.
+        Returns {(cx, cy): True if this client claimed it and should generate it, False if it is generated or claimed by another client}, or None if the request failed."""
+        req = config.WorldRequests.ClaimChunksReq
+        req_data = {config.WorldRequestData.ChunkPositions: list(positions)}
+        def handle_response(res):
+            if self.__handle_fail__(res): return None
+            else: return res[1][config.WorldRequestData.Results]
+        return self.__request__(req, req_data, handle_response, block)
+
+
+    def get_heightmap(self, cx, cy, block=True):
+        """Returns a numpy array of the y of the top most block in every column of the chunk, indexed [bx, bz]. Empty columns are -1. Much cheaper than get_chunk when only the surface is needed.
+        Returns None if the request failed."""
+        req = config.WorldRequests.GetHeightmapReq
+        req_data = {config.WorldRequestData.ChunkPos: (cx, cy)}
+        def handle_response(res):
+            if self.__handle_fail__(res): return None
+            else: return res[1][config.WorldRequestData.Heightmap]
+        return self.__request__(req, req_data, handle_response, block)
+
+
+    def get_block(self, abx, aby, abz, block=True):
+        """Returns the Block() at an absolute block position without getting the whole chunk, or None if the request failed."""
+        req = config.WorldRequests.GetBlockReq
+        req_data = {config.WorldRequestData.BlockPos: (abx, aby, abz)}
+        def handle_response(res):
+            if self.__handle_fail__(res): return None
+            else: return res[1][config.WorldRequestData.BlockData]
+        return self.__request__(req, req_data, handle_response, block)
+
+
+    def set_block(self, abx, aby, abz, new_block, block=True):
+        """Change the Block() at an absolute block position without sending the whole chunk. The server changes the chunk in place and sends subscribed clients an Edited event.
+        Returns False if successful, else returns True."""
+        req = config.WorldRequests.SetBlockReq
+        req_data = {config.WorldRequestData.BlockPos: (abx, aby, abz), config.WorldRequestData.BlockData: new_block}
+        self.__cache__.pop(self.abs_block_to_chunk_block(abx, aby, abz)[0], None)
+        return self.__request__(req, req_data, self.__handle_fail__, block)
+
+
+    def set_blocks(self, changes, block=True):
+        """Like set_block, but for many blocks in any number of chunks with a single request.
+        changes: An iterable of ((abx, aby, abz), Block()).
+        Returns {(cx, cy): delta} of what actually changed in each chunk (see Chunk.set_blocks), or None if the request failed."""
+        req = config.WorldRequests.SetBlocksReq
+        req_data = {config.WorldRequestData.BlockChanges: list(changes)}
+        for pos, _ in req_data[config.WorldRequestData.BlockChanges]:
+            self.__cache__.pop(self.abs_block_to_chunk_block(*pos)[0], None)
+        def handle_response(res):
+            if self.__handle_fail__(res): return None
+            else: return res[1][config.WorldRequestData.Deltas]
+        return self.__request__(req, req_data, handle_response, block)
+
+
+    def get_stats(self, block=True):
+        """Get the server's metrics: metrics.RequestMetrics.snapshot() with WorldDataServer.cache_stats() added as 'cache' and the shard number as 'shard'. Server latencies are the time spent handling each request, and queue is how long requests waited before that.
+        Returns None if the request failed."""
+        req = config.WorldRequests.StatsReq
+        def handle_response(res):
+            if self.__handle_fail__(res): return None
+            else: return res[1][config.WorldRequestData.Stats]
+        return self.__request__(req, None, handle_response, block)
+
+
+    def subscribe(self, events, block=True):
+        """Have the server send this client chunk events as they happen instead of polling for them. See get_events.
+        events: An iterable of config.ChunkEvents to receive for every chunk.
+        The server keeps events while the pipe is full instead of waiting, but a subscribed client still has to call get_events (or poll) regularly, or it is unsubscribed once config.WorldDataServer.MaxQueuedEvents are waiting for it.
+        Returns False if successful, else returns True."""
+        req = config.WorldRequests.SubscribeReq
+        req_data = {config.WorldRequestData.Events: list(events)}
+        return self.__request__(req, req_data, self.__handle_fail__, block)
+
+
+    def unsubscribe(self, events, block=True):
+        """Stop receiving the given config.ChunkEvents. Events already sent are still returned by get_events.
+        Returns False if successful, else returns True."""
+        req = config.WorldRequests.UnsubscribeReq
+        req_data = {config.WorldRequestData.Events: list(events)}
+        return self.__request__(req, req_data, self.__handle_fail__, block)
+
+
+    def get_events(self, deltas=False):
+        """Returns a list of the (config.ChunkEvents, (cx, cy)) the server sent since the last call, oldest first. Doesn't wait for any.
+        deltas: If True, return (config.ChunkEvents, (cx, cy), delta) instead. The delta is what changed for Edited events (see Chunk.set_blocks) and None for the others."""
+        self.poll()
+        events = list(self.__events__)
+        self.__events__.clear()
+        if deltas:
+            return events
+        return [(event, pos) for event, pos, _ in events]
 
 
     @classmethod
@@ -143,20 +554,216 @@ class WorldDataClient:
         return (abx, aby, abz)
 
 
+class ShardedWorldDataClient:
+    """Connects to every shard of a ShardedWorldDataServer and sends each request to the shard that owns the chunk, so it can be used just like a WorldDataClient. Requests for many chunks are split between the shards and sent to all of them at once.
+    Like a WorldDataClient, each seperate thread or process requires a seperate instance of this created with new_client."""
+    abs_block_to_chunk_block = WorldDataClient.abs_block_to_chunk_block
+    chunk_block_to_abs_block = WorldDataClient.chunk_block_to_abs_block
+
+    def __init__(self, clients):
+        """Shouldn't be created unless inside ShardedWorldDataServer.
+        clients: A WorldDataClient for each shard, in shard order."""
+        self.clients = clients
+        self.name = clients[0].name
+
+
+    def __client__(self, cx, cy):
+        """The WorldDataClient of the shard that owns chunk (cx, cy)."""
+        return self.clients[shard_of(cx, cy, len(self.clients))]
+
+
+    def __split__(self, positions):
+        """Returns {shard: [(cx, cy), ...]} for the positions each shard owns."""
+        split = {}
+        for cx, cy in positions:
+            split.setdefault(shard_of(cx, cy, len(self.clients)), []).append((cx, cy))
+        return split
+
+
+    def __gather__(self, futures, combine, block):
+        """Combine the WorldRequestFutures sent to each shard into one result, or into a ShardedRequestFuture if block is False."""
+        future = ShardedRequestFuture(futures, combine)
+        if block:
+            return future.result()
+        return future
+
+
+    @staticmethod
+    def __merge__(results):
+        """Combine {(cx, cy): result} from each shard. None if any shard failed."""
+        merged = {}
+        for res in results:
+            if res is None: return None
+            merged.update(res)
+        return merged
+
+
+    def wait_for(self, future, timeout=None):
+        """Wait until future is resolved. Raises concurrent.futures.TimeoutError if that takes more than timeout seconds."""
+        future.result(timeout)
+
+
+    def poll(self):
+        """Handle every reply and chunk event that has already arrived from any shard without waiting. Returns the number of requests still in flight."""
+        return sum(cli.poll() for cli in self.clients)
+
+
+    def add_to_event_loop(self, loop):
+        """Have an asyncio event loop handle replies from every shard as they arrive."""
+        for cli in self.clients:
+            cli.add_to_event_loop(loop)
+
+
+    def ping(self, block=True):
+        """Ping every shard. Returns {config.WorldRequestData.Pong: 'pong'} if they all replied, else returns None."""
+        return self.__gather__([cli.ping(block=False) for cli in self.clients], lambda results: None if None in results else results[0], block)
+
+
+    def new_client(self, name=None):
+        """Create another ShardedWorldDataClient connected to every shard. Will wait until every shard responds.
+        Returns {config.WorldRequestData.NewClient: ShardedWorldDataClient()} if successful, else returns None."""
+        clients = []
+        for cli in self.clients:
+            res = cli.new_client(name)
+            if res is None: return None
+            clients.append(res[config.WorldRequestData.NewClient])
+        return {config.WorldRequestData.NewClient: ShardedWorldDataClient(clients)}
+
+
+    def set_chunk(self, cx, cy, chunk, block=True):
+        """See WorldDataClient.set_chunk."""
+        return self.__client__(cx, cy).set_chunk(cx, cy, chunk, block=block)
+
+
+    def init_chunk(self, cx, cy, chunk, block=True):
+        """See WorldDataClient.init_chunk."""
+        return self.__client__(cx, cy).init_chunk(cx, cy, chunk, block=block)
+
+
+    def get_chunk(self, cx, cy, block=True):
+        """See WorldDataClient.get_chunk."""
+        return self.__client__(cx, cy).get_chunk(cx, cy, block=block)
+
+
+    def is_generated(self, cx, cy, block=True):
+        """See WorldDataClient.is_generated."""
+        return self.__client__(cx, cy).is_generated(cx, cy, block=block)
+
+
+    def get_heightmap(self, cx, cy, block=True):
+        """See WorldDataClient.get_heightmap."""
+        return self.__client__(cx, cy).get_heightmap(cx, cy, block=block)
+
+
+    def get_block(self, abx, aby, abz, block=True):
+        """See WorldDataClient.get_block."""
+        return self.__client__(*self.abs_block_to_chunk_block(abx, aby, abz)[0]).get_block(abx, aby, abz, block=block)
+
+
+    def set_block(self, abx, aby, abz, new_block, block=True):
+        """See WorldDataClient.set_block."""
+        return self.__client__(*self.abs_block_to_chunk_block(abx, aby, abz)[0]).set_block(abx, aby, abz, new_block, block=block)
+
+
+    def set_blocks(self, changes, block=True):
+        """See WorldDataClient.set_blocks. Each shard changes its blocks at the same time."""
+        split = {}
+        for pos, new_block in changes:
+            split.setdefault(shard_of(*self.abs_block_to_chunk_block(*pos)[0], len(self.clients)), []).append((pos, new_block))
+        futures = [self.clients[shard].set_blocks(c, block=False) for shard, c in split.items()]
+        return self.__gather__(futures, self.__merge__, block)
+
+
+    def get_chunks(self, positions, block=True):
+        """See WorldDataClient.get_chunks. Each shard is asked for its chunks at the same time."""
+        futures = [self.clients[shard].get_chunks(p, block=False) for shard, p in self.__split__(positions).items()]
+        return self.__gather__(futures, self.__merge__, block)
+
+
+    def init_chunks(self, chunks, block=True):
+        """See WorldDataClient.init_chunks. Each shard initializes its chunks at the same time."""
+        futures = [self.clients[shard].init_chunks({pos: chunks[pos] for pos in p}, block=False) for shard, p in self.__split__(chunks).items()]
+        return self.__gather__(futures, self.__merge__, block)
+
+
+    def is_generated_many(self, positions, block=True):
+        """See WorldDataClient.is_generated_many. Each shard is asked about its chunks at the same time."""
+        futures = [self.clients[shard].is_generated_many(p, block=False) for shard, p in self.__split__(positions).items()]
+        return self.__gather__(futures, self.__merge__, block)
+
+
+    def get_stats(self, block=True):
+        """Returns a list of every shard's WorldDataClient.get_stats, or None if any of them failed."""
+        return self.__gather__([cli.get_stats(block=False) for cli in self.clients], lambda results: None if None in results else results, block)
+
+
+    def local_stats(self):
+        """Returns a list of WorldDataClient.local_stats for the connection to each shard."""
+        return [cli.local_stats() for cli in self.clients]
+
+
+    def claim_chunks(self, positions, block=True):
+        """See WorldDataClient.claim_chunks. Each shard is asked for its chunks at the same time."""
+        futures = [self.clients[shard].claim_chunks(p, block=False) for shard, p in self.__split__(positions).items()]
+        return self.__gather__(futures, self.__merge__, block)
+
+
+    def subscribe(self, events, block=True):
+        """See WorldDataClient.subscribe. Subscribes to the events of every shard."""
+        events = list(events)
+        return self.__gather__([cli.subscribe(events, block=False) for cli in self.clients], any, block)
+
+
+    def unsubscribe(self, events, block=True):
+        """See WorldDataClient.unsubscribe."""
+        events = list(events)
+        return self.__gather__([cli.unsubscribe(events, block=False) for cli in self.clients], any, block)
+
+
+    def get_events(self, deltas=False):
+        """See WorldDataClient.get_events. Events are in order for each chunk, but not between chunks of different shards."""
+        return [event for cli in self.clients for event in cli.get_events(deltas)]
+
+
 class WorldDataServer(mp.Process):
-    """A server in a seperate process that handles all access to the world data. This class could be used to cache different sections of the world or to load between the filesystem and RAM. Currently it just stores the entire world in RAM using a dictionary of Chunk objects."""
-    def __init__(self, parent_log):
-        """parent_log: The logging.getLogger() object that will be the parent for this log."""
+    """A server in a seperate process that handles all access to the world data. This class could be used to cache different sections of the world or to load between the filesystem and RAM. Chunks are kept in RAM using a dictionary of Chunk objects.
+    If config.WorldDataServer.SaveDirectory is set, the world is also kept in region files there (see region_files.py). Chunks are loaded from them the first time they are needed and changed chunks are written back every config.WorldDataServer.SaveInterval seconds and when the server stops. Call region_files.load_seed before creating the server, so ProceduralChunks are made again with the seed the world was saved with.
+    Chunks that haven't been used for config.WorldDataServer.ColdChunkAge seconds, or that don't fit in config.WorldDataServer.MaxResidentChunks, are compressed into cold chunks that are still in RAM and decompressed again the next time they are used.
+    Only config.WorldDataServer.MaxColdChunks cold chunks are kept. When there are more, the least recently used are written to the SaveDirectory and dropped.
+    Chunks initialized as a procedural.ProceduralChunk don't need cold copies or saved blocks at all. Only the ProceduralChunk is kept, and their blocks are made again when they are used."""
+    def __init__(self, parent_log, shard=0, shards=1):
+        """parent_log: The logging.getLogger() object that will be the parent for this log.
+        shard: Which shard of a ShardedWorldDataServer this is. It only loads the regions shard_of_region gives it.
+        shards: How many shards there are in total."""
         super(WorldDataServer, self).__init__()
+        self.shard = shard
+        self.shards = shards
 
         self.__running__ = mp.Value('b', True)
         self.__main_pipe_pub__, self.__main_pipe__ = mp.Pipe(True)
-        self.__chunks__ = defaultdict(lambda: Chunk())
+        self.__codec__ = make_codec() # How requests and replies are written to the pipes.
+        self.__chunks__ = OrderedDict() # {(cx, cy): Chunk()} from least to most recently used. Only chunks that were set or loaded from disk are in here; looking up other positions never adds them.
+        self.__used__ = {} # {(cx, cy): time()} when each chunk in __chunks__ was last used.
+        self.__cold__ = OrderedDict() # {(cx, cy): (compressed chunk, is generated)} from least to most recently used. See region_files.compress.
+        self.__procedural__ = {} # {(cx, cy): ProceduralChunk()} for generated chunks that can be made again by their generator. A chunk in here and __chunks__ always matches its ProceduralChunk.
+        self.__cache_stats__ = {'hits': 0, 'cold_hits': 0, 'misses': 0, 'cooled': 0, 'evictions': 0, 'materialized': 0} # How often get_chunk found the chunk decoded, found it compressed, or didn't find it, how many chunks were compressed and dropped from RAM, and how many ProceduralChunks had their blocks made.
+        self.__generated__ = set() # (cx, cy) of every generated chunk, so checking doesn't need the chunk.
+        self.__shared_chunks__ = SharedChunkStore() if config.WorldDataServer.SharedMemory else None # Segments are only created once chunks are requested, so inside the server process.
+        self.__dirty__ = set() # (cx, cy) of chunks that changed since they were last saved.
+        self.__regions__ = None # region_files.RegionStore() if the world is saved to disk.
+        if config.WorldDataServer.SaveDirectory is not None:
+            self.__regions__ = region_files.RegionStore(config.WorldDataServer.SaveDirectory)
+            self.__generated__.update(self.__regions__.positions(lambda rx, ry: shard_of_region(rx, ry, shards) == shard))
+            self.__regions__.close() # Don't leave the files open in the processes that get forked from this one.
         self.__connections__ = {self.__main_pipe__: config.WorldDataServer.MainConnectionName,}
+        self.__subscribers__ = {} # {client pipe: set(config.ChunkEvents)} the client wants to be sent.
+        self.__event_queues__ = {} # {client pipe: deque of chunk event messages} waiting for room in the client's pipe. See __flush_events__.
+        self.__claims__ = {} # {(cx, cy): (client name, time() the claim runs out)} for chunks being generated. See claim_chunks.
+        self.__metrics__ = RequestMetrics() # How many of each request were handled, how long they took and waited and how many bytes went each way.
         self.parent_log = parent_log
 
         #self.log = logging.getLogger('WorldDataServer')
-        self.log = parent_log.getChild('WorldDataServer')
+        self.log = parent_log.getChild('WorldDataServer' if shards == 1 else 'WorldDataServer{}'.format(shard))
         self.log.setLevel(config.WorldDataServer.LogLevel)
 
         #self.__handler__ = logging.StreamHandler()
@@ -187,12 +794,293 @@ class WorldDataServer(mp.Process):
         """Change the chunk data at a specified location."""
         if not isinstance(chunk, Chunk):
             raise TypeError("Must be Chunk, not {}".format(type(chunk)))
+        chunk.pack()
+        self.__procedural__.pop((cx, cy), None)
         self.__chunks__[(cx, cy)] = chunk
+        self.__chunks__.move_to_end((cx, cy))
+        self.__used__[(cx, cy)] = time()
+        self.__cold__.pop((cx, cy), None)
+        self.__replaced__(cx, cy, chunk.is_generated())
+        self.__evict__()
+
+
+    def set_procedural(self, cx, cy, procedural):
+        """Change the chunk at a specified location to a ProceduralChunk. If it carries the chunk its generator made, that is kept decoded like set_chunk would. Otherwise no blocks are made until the chunk is used."""
+        if not isinstance(procedural, ProceduralChunk):
+            raise TypeError("Must be ProceduralChunk, not {}".format(type(procedural)))
+        chunk = procedural.chunk
+        procedural.drop_cache()
+        if chunk is not None:
+            self.set_chunk(cx, cy, chunk)
+        else:
+            self.__chunks__.pop((cx, cy), None)
+            self.__used__.pop((cx, cy), None)
+            self.__cold__.pop((cx, cy), None)
+            self.__replaced__(cx, cy, True)
+        self.__procedural__[(cx, cy)] = procedural
+
+
+    def __replaced__(self, cx, cy, generated):
+        """Keep track of the chunk at (cx, cy) being replaced and tell subscribers about it.
+        generated: If the new chunk is generated."""
+        if self.__shared_chunks__ is not None:
+            self.__shared_chunks__.release(cx, cy) # Clients holding the old version see it isn't current any more.
+        self.__dirty__.add((cx, cy))
+        self.__claims__.pop((cx, cy), None)
+        if generated:
+            if (cx, cy) in self.__generated__:
+                self.__notify__(config.ChunkEvents.Modified, cx, cy)
+            else:
+                self.__generated__.add((cx, cy))
+                self.__notify__(config.ChunkEvents.Generated, cx, cy)
+        else:
+            self.__generated__.discard((cx, cy))
 
 
     def get_chunk(self, cx, cy):
-        """Get the chunk data at a specified location"""
-        return self.__chunks__[(cx, cy)]
+        """Get the chunk data at a specified location, making it from its ProceduralChunk or loading it from disk if it isn't in RAM. If nothing was ever set there, a new empty Chunk is returned but not stored."""
+        chunk = self.__chunks__.get((cx, cy))
+        if chunk is not None:
+            self.__cache_stats__['hits'] += 1
+            self.__chunks__.move_to_end((cx, cy))
+            self.__used__[(cx, cy)] = time()
+            return chunk
+
+        cold = self.__cold__.pop((cx, cy), None)
+        if cold is not None:
+            self.__cache_stats__['cold_hits'] += 1
+            chunk = region_files.decompress(cold[0])
+        elif (cx, cy) in self.__procedural__:
+            self.__cache_stats__['materialized'] += 1
+            chunk = self.__procedural__[(cx, cy)].materialize()
+        else:
+            self.__cache_stats__['misses'] += 1
+            if self.__regions__ is not None and (cx, cy) in self.__generated__:
+                chunk = self.__regions__.load(cx, cy)
+            if isinstance(chunk, ProceduralChunk):
+                self.__procedural__[(cx, cy)] = chunk
+                self.__cache_stats__['materialized'] += 1
+                chunk = chunk.materialize()
+        if chunk is None:
+            return Chunk()
+
+        chunk.pack()
+        self.__chunks__[(cx, cy)] = chunk
+        self.__used__[(cx, cy)] = time()
+        self.__evict__()
+        return chunk
+
+
+    def is_generated(self, cx, cy):
+        """True if the chunk at a specified location is generated. Doesn't look at or create the chunk."""
+        return (cx, cy) in self.__generated__
+
+
+    def init_chunk(self, cx, cy, chunk):
+        """Set the chunk data at a specified location only if it isn't generated yet. Returns True if it was set, False if the chunk was already generated.
+        chunk: A Chunk() or a ProceduralChunk(), see set_procedural."""
+        if self.is_generated(cx, cy):
+            return False
+        if isinstance(chunk, ProceduralChunk):
+            self.set_procedural(cx, cy, chunk)
+        else:
+            self.set_chunk(cx, cy, chunk)
+        return True
+
+
+    def get_heightmap(self, cx, cy):
+        """Get the heightmap of the chunk at a specified location (see Chunk.get_heightmap). A chunk that is only a ProceduralChunk right now gets it from its generator without making its blocks."""
+        procedural = self.__procedural__.get((cx, cy))
+        if procedural is not None and (cx, cy) not in self.__chunks__:
+            return procedural.get_heightmap()
+        return self.get_chunk(cx, cy).get_heightmap()
+
+
+    def __cool__(self, cx, cy):
+        """Compress the decoded chunk at (cx, cy) into the cold chunks. Chunks with a ProceduralChunk are just dropped, since that is all that is needed to make them again."""
+        chunk = self.__chunks__.pop((cx, cy))
+        del self.__used__[(cx, cy)]
+        if (cx, cy) in self.__procedural__:
+            self.__procedural__[(cx, cy)].version = chunk.get_version()
+            self.__procedural__[(cx, cy)].drop_cache()
+        else:
+            self.__cold__[(cx, cy)] = (region_files.compress(chunk, config.WorldDataServer.ColdCompression), chunk.is_generated())
+        if self.__shared_chunks__ is not None:
+            self.__shared_chunks__.release(cx, cy)
+        self.__cache_stats__['cooled'] += 1
+
+
+    def cool_idle(self):
+        """Compress every decoded chunk that wasn't used for config.WorldDataServer.ColdChunkAge seconds."""
+        if config.WorldDataServer.ColdChunkAge is None: return
+        oldest = time() - config.WorldDataServer.ColdChunkAge
+        while len(self.__chunks__) > 0:
+            pos = next(iter(self.__chunks__))
+            if self.__used__[pos] > oldest: break
+            self.__cool__(*pos)
+        self.__evict__()
+
+
+    def __evict__(self):
+        """Compress the least recently used decoded chunks until only config.WorldDataServer.MaxResidentChunks are left, then drop the least recently used cold chunks until only config.WorldDataServer.MaxColdChunks are left, saving the changed ones first.
+        Cold chunks are only dropped with a SaveDirectory, since they would be lost otherwise."""
+        limit = config.WorldDataServer.MaxResidentChunks
+        if limit is not None:
+            while len(self.__chunks__) > limit:
+                self.__cool__(*next(iter(self.__chunks__)))
+
+        limit = config.WorldDataServer.MaxColdChunks
+        if self.__regions__ is None or limit is None: return
+        while len(self.__cold__) > limit:
+            (cx, cy), (data, generated) = self.__cold__.popitem(last=False)
+            if (cx, cy) in self.__dirty__:
+                if generated:
+                    self.__regions__.save_compressed(cx, cy, data)
+                else:
+                    self.__regions__.delete(cx, cy) # So an older generated copy isn't loaded again.
+                self.__dirty__.discard((cx, cy))
+            self.__cache_stats__['evictions'] += 1
+            self.__notify__(config.ChunkEvents.Evicted, cx, cy)
+
+
+    def __notify__(self, event, cx, cy, delta=None):
+        """Queue a config.ChunkEvents for chunk (cx, cy) for every client subscribed to it. They are sent by __flush_events__, so a client that isn't reading its pipe never makes the server wait.
+        A client that falls more than config.WorldDataServer.MaxQueuedEvents events behind is unsubscribed.
+        delta: What changed, for Edited events. See Chunk.set_blocks."""
+        msg = (config.WorldRequests.ChunkEventMsg, {config.WorldRequestData.ChunkEvent: event, config.WorldRequestData.ChunkPos: (cx, cy)})
+        if delta is not None:
+            msg[1][config.WorldRequestData.Delta] = delta
+        for cli, events in list(self.__subscribers__.items()):
+            if event not in events: continue
+            queued = self.__event_queues__.setdefault(cli, deque())
+            queued.append(msg)
+            if len(queued) > config.WorldDataServer.MaxQueuedEvents:
+                self.log.warning("Client '{}' has {} chunk events it hasn't read, unsubscribing it.".format(self.__connections__.get(cli), len(queued)))
+                del self.__subscribers__[cli]
+                del self.__event_queues__[cli]
+
+
+    @classmethod
+    def __writable__(cls, cli):
+        """True if there is room in cli's pipe to send an event without waiting. Pipes that can't be checked are always writable."""
+        try:
+            return len(select.select([], [cli], [], 0)[1]) > 0
+        except (OSError, ValueError):
+            return True
+
+
+    def __flush_events__(self):
+        """Send the queued chunk events of every client whose pipe has room for them, oldest first. Stops sending to a client as soon as its pipe is full.
+        Returns True if any events are still queued."""
+        for cli, queued in list(self.__event_queues__.items()):
+            while len(queued) > 0 and self.__writable__(cli):
+                msg = queued.popleft()
+                try:
+                    self.__metrics__.sent(msg[0], self.__codec__.send(cli, msg))
+                except OSError as e:
+                    self.log.warning("Failed to send chunk event to client '{}', unsubscribing it.".format(self.__connections__.get(cli)))
+                    self.log.debug(e)
+                    self.__subscribers__.pop(cli, None)
+                    queued.clear()
+            if len(queued) == 0:
+                del self.__event_queues__[cli]
+        return len(self.__event_queues__) > 0
+
+
+    def cache_stats(self):
+        """Returns {'hits', 'cold_hits', 'misses', 'cooled', 'evictions', 'materialized', 'resident', 'cold', 'cold_bytes', 'procedural'} counts for the chunks kept in RAM."""
+        stats = dict(self.__cache_stats__)
+        stats['resident'] = len(self.__chunks__)
+        stats['cold'] = len(self.__cold__)
+        stats['procedural'] = len(self.__procedural__)
+        stats['cold_bytes'] = sum(len(data) for data, _ in self.__cold__.values())
+        return stats
+
+
+    def get_block(self, abx, aby, abz):
+        """Get the Block() at an absolute block position."""
+        (cx, cy), (bx, by, bz) = WorldDataClient.abs_block_to_chunk_block(abx, aby, abz)
+        return self.get_chunk(cx, cy).get_block(bx, by, bz)
+
+
+    def set_blocks(self, changes):
+        """Change blocks in place instead of replacing their chunks.
+        changes: An iterable of ((abx, aby, abz), Block()).
+        Returns {(cx, cy): delta} for every chunk that changed (see Chunk.set_blocks). Clients subscribed to config.ChunkEvents.Edited are sent the same deltas.
+        Raises ValueError without changing anything if any of the blocks are in a chunk that isn't generated yet, since the edit would make it look generated and stop it from ever being generated."""
+        edits = {} # {(cx, cy): ([(bx, by, bz), ...], [block ID, ...])}
+        for (abx, aby, abz), block in changes:
+            (cx, cy), pos = WorldDataClient.abs_block_to_chunk_block(abx, aby, abz)
+            positions, ids = edits.setdefault((cx, cy), ([], []))
+            positions.append(pos)
+            ids.append(BLOCK_IDS[block.block_type])
+        for cx, cy in edits:
+            if not self.is_generated(cx, cy):
+                raise ValueError("Chunk ({}, {}) can't be edited before it is generated".format(cx, cy))
+
+        deltas = {}
+        for (cx, cy), (positions, ids) in edits.items():
+            chunk = self.get_chunk(cx, cy)
+            delta = chunk.set_blocks(positions, ids)
+            if len(delta[1]) == 0: continue
+            if (cx, cy) in self.__procedural__:
+                self.__procedural__[(cx, cy)].add_edits(delta)
+            if (cx, cy) in self.__chunks__:
+                chunk.pack()
+                if self.__shared_chunks__ is not None:
+                    self.__shared_chunks__.release(cx, cy)
+                self.__dirty__.add((cx, cy))
+            else:
+                self.set_chunk(cx, cy, chunk)
+            deltas[(cx, cy)] = delta
+            self.__notify__(config.ChunkEvents.Edited, cx, cy, delta)
+        return deltas
+
+
+    def claim_chunks(self, positions, owner):
+        """Claim ungenerated chunks for a client to generate. A chunk can't be claimed while another client's claim on it hasn't run out. See WorldDataClient.claim_chunks.
+        owner: The name of the client claiming them.
+        Returns {(cx, cy): True if owner claimed it, False otherwise}."""
+        now = time()
+        results = {}
+        for cx, cy in positions:
+            claim = self.__claims__.get((cx, cy))
+            if self.is_generated(cx, cy) or (claim is not None and claim[0] != owner and claim[1] > now):
+                results[(cx, cy)] = False
+            else:
+                self.__claims__[(cx, cy)] = (owner, now + config.WorldDataServer.ClaimTimeout)
+                results[(cx, cy)] = True
+        return results
+
+
+    def release_claims(self, owner):
+        """Drop every claim owner has, like when it disconnects."""
+        self.__claims__ = {pos: claim for pos, claim in self.__claims__.items() if claim[0] != owner}
+
+
+    def save(self):
+        """Write every generated chunk that changed since it was last saved to config.WorldDataServer.SaveDirectory. Chunks that were replaced with ungenerated ones are removed from it."""
+        if self.__regions__ is None: return
+        for cx, cy in self.__dirty__:
+            chunk = self.__chunks__.get((cx, cy))
+            if (cx, cy) in self.__procedural__:
+                self.__regions__.save(cx, cy, self.__procedural__[(cx, cy)])
+            elif chunk is not None and chunk.is_generated():
+                self.__regions__.save(cx, cy, chunk)
+            elif (cx, cy) in self.__cold__ and self.__cold__[(cx, cy)][1]:
+                self.__regions__.save_compressed(cx, cy, self.__cold__[(cx, cy)][0])
+            else:
+                self.__regions__.delete(cx, cy)
+        self.log.info("Saved {} chunks. Cache: {}".format(len(self.__dirty__), self.cache_stats()))
+        self.__dirty__ = set()
+
+
+    def share_chunk(self, cx, cy):
+        """Get what should be sent to a client for the chunk at (cx, cy): A SharedChunkHandle if config.WorldDataServer.SharedMemory is on, else the Chunk itself."""
+        chunk = self.get_chunk(cx, cy)
+        if self.__shared_chunks__ is not None:
+            return self.__shared_chunks__.publish(cx, cy, chunk)
+        return chunk
 
 
     def get_main_client(self):
@@ -278,11 +1166,17 @@ class WorldDataServer(mp.Process):
             self.log.info("Receiuved Get Chunk request from client '{}'".format(cli_name))
 
             cx, cy = req[1][config.WorldRequestData.ChunkPos]
+            versions = req[1].get(config.WorldRequestData.Versions, {})
 
             try:
-                chunk = self.get_chunk(cx, cy)
                 response[0] = req[0]
-                response[1] = {config.WorldRequestData.ChunkData: chunk}
+                if (cx, cy) in versions and versions[(cx, cy)] == chunk_version(self.get_chunk(cx, cy)):
+                    response[1] = {config.WorldRequestData.Unchanged: [(cx, cy)]}
+                elif self.__shared_chunks__ is not None:
+                    chunk = self.share_chunk(cx, cy)
+                    response[1] = {config.WorldRequestData.SharedChunk: chunk}
+                else:
+                    response[1] = {config.WorldRequestData.ChunkData: self.share_chunk(cx, cy)}
             except Exception as e:
                 self.log.warning("Failed to get chunk data.")
                 self.log.debug(e)
@@ -292,27 +1186,26 @@ class WorldDataServer(mp.Process):
             cx, cy = req[1][config.WorldRequestData.ChunkPos]
 
             self.log.info("Received Init Chunk request from client '{}' for ({}, {})".format(cli_name, cx ,cy))
-            if not self.get_chunk(cx, cy).is_generated():
-                chunk_data = req[1][config.WorldRequestData.ChunkData]
+            chunk_data = req[1][config.WorldRequestData.ChunkData]
 
-                try:
-                    self.set_chunk(cx, cy, chunk_data)
+            try:
+                if self.init_chunk(cx, cy, chunk_data):
                     response[0] = req[0]
-                except Exception as e:
-                    self.log.warning("Failed to set chunk data.")
-                    self.log.debug(e)
-                    response[0] = config.WorldRequests.FailedReq
-            else:
-                self.log.warning("A chunk was initialized twice")
-                self.log.debug("Chunk: ({}, {})".format(cx, cy))
-                response[0] = config.WorldRequests.DuplicateInit
+                else:
+                    self.log.warning("A chunk was initialized twice")
+                    self.log.debug("Chunk: ({}, {})".format(cx, cy))
+                    response[0] = config.WorldRequests.DuplicateInit
+            except Exception as e:
+                self.log.warning("Failed to set chunk data.")
+                self.log.debug(e)
+                response[0] = config.WorldRequests.FailedReq
 
         elif req[0] == config.WorldRequests.IsGenerated:
             self.log.info("Received Is Generated request from client '{}'".format(cli_name))
 
             cx, cy = req[1][config.WorldRequestData.ChunkPos]
             try:
-                if self.get_chunk(cx, cy).is_generated():
+                if self.is_generated(cx, cy):
                     response[1] = {config.WorldRequestData.Boolean: True}
                 else:
                     response[1] = {config.WorldRequestData.Boolean: False}
@@ -322,29 +1215,216 @@ class WorldDataServer(mp.Process):
                 self.log.debug("Chunk: ({}, {})".format(cx, cy))
                 response[0] = config.WorldRequests.FailedReq
 
+        elif req[0] == config.WorldRequests.GetHeightmapReq:
+            self.log.info("Received Get Heightmap request from client '{}'".format(cli_name))
+
+            cx, cy = req[1][config.WorldRequestData.ChunkPos]
+            try:
+                response[1] = {config.WorldRequestData.Heightmap: self.get_heightmap(cx, cy)}
+                response[0] = req[0]
+            except Exception as e:
+                self.log.warning("Failed to get chunk heightmap.")
+                self.log.debug(e)
+                response[0] = config.WorldRequests.FailedReq
+
+
+        elif req[0] == config.WorldRequests.GetChunksReq:
+            positions = req[1][config.WorldRequestData.ChunkPositions]
+            self.log.info("Received Get Chunks request from client '{}' for {} chunks".format(cli_name, len(positions)))
+
+            versions = req[1].get(config.WorldRequestData.Versions, {})
+            try:
+                unchanged = [pos for pos, version in versions.items() if version == chunk_version(self.get_chunk(*pos))]
+                chunks = {(cx, cy): self.share_chunk(cx, cy) for cx, cy in positions if (cx, cy) not in unchanged}
+                response[0] = req[0]
+                if self.__shared_chunks__ is not None:
+                    response[1] = {config.WorldRequestData.SharedChunks: chunks}
+                else:
+                    response[1] = {config.WorldRequestData.Chunks: chunks}
+                if len(unchanged) > 0:
+                    response[1][config.WorldRequestData.Unchanged] = unchanged
+            except Exception as e:
+                self.log.warning("Failed to get chunk data.")
+                self.log.debug(e)
+                response[0] = config.WorldRequests.FailedReq
+
+        elif req[0] == config.WorldRequests.InitChunksReq:
+            chunks = req[1][config.WorldRequestData.Chunks]
+            self.log.info("Received Init Chunks request from client '{}' for {} chunks".format(cli_name, len(chunks)))
 
+            results = {}
+            for (cx, cy), chunk_data in chunks.items():
+                try:
+                    results[(cx, cy)] = not self.init_chunk(cx, cy, chunk_data)
+                except Exception as e:
+                    self.log.warning("Failed to set chunk data for ({}, {}).".format(cx, cy))
+                    self.log.debug(e)
+                    results[(cx, cy)] = True
+            response[0] = req[0]
+            response[1] = {config.WorldRequestData.Results: results}
+
+        elif req[0] == config.WorldRequests.IsGeneratedManyReq:
+            positions = req[1][config.WorldRequestData.ChunkPositions]
+            self.log.info("Received Is Generated Many request from client '{}' for {} chunks".format(cli_name, len(positions)))
+
+            try:
+                response[1] = {config.WorldRequestData.Results: {(cx, cy): self.is_generated(cx, cy) for cx, cy in positions}}
+                response[0] = req[0]
+            except Exception as e:
+                self.log.warning("Failed to check if chunks are generated.")
+                self.log.debug(e)
+                response[0] = config.WorldRequests.FailedReq
+
+        elif req[0] in (config.WorldRequests.SubscribeReq, config.WorldRequests.UnsubscribeReq):
+            self.log.info("Received {} request from client '{}'".format(req[0].value, cli_name))
+
+            try:
+                events = self.__subscribers__.get(cli, set())
+                if req[0] is config.WorldRequests.SubscribeReq:
+                    events |= set(config.ChunkEvents(e) for e in req[1][config.WorldRequestData.Events])
+                else:
+                    events -= set(config.ChunkEvents(e) for e in req[1][config.WorldRequestData.Events])
+                if len(events) > 0:
+                    self.__subscribers__[cli] = events
+                else:
+                    self.__subscribers__.pop(cli, None)
+                response[0] = req[0]
+            except Exception as e:
+                self.log.warning("Failed to change chunk event subscriptions.")
+                self.log.debug(e)
+                response[0] = config.WorldRequests.FailedReq
+
+        elif req[0] == config.WorldRequests.ClaimChunksReq:
+            positions = req[1][config.WorldRequestData.ChunkPositions]
+            self.log.info("Received Claim Chunks request from client '{}' for {} chunks".format(cli_name, len(positions)))
+
+            try:
+                response[1] = {config.WorldRequestData.Results: self.claim_chunks(positions, cli_name)}
+                response[0] = req[0]
+            except Exception as e:
+                self.log.warning("Failed to claim chunks.")
+                self.log.debug(e)
+                response[0] = config.WorldRequests.FailedReq
+
+        elif req[0] == config.WorldRequests.GetBlockReq:
+            self.log.info("Received Get Block request from client '{}'".format(cli_name))
+
+            try:
+                response[1] = {config.WorldRequestData.BlockData: self.get_block(*req[1][config.WorldRequestData.BlockPos])}
+                response[0] = req[0]
+            except Exception as e:
+                self.log.warning("Failed to get block.")
+                self.log.debug(e)
+                response[0] = config.WorldRequests.FailedReq
+
+        elif req[0] in (config.WorldRequests.SetBlockReq, config.WorldRequests.SetBlocksReq):
+            if req[0] is config.WorldRequests.SetBlockReq:
+                changes = [(req[1][config.WorldRequestData.BlockPos], req[1][config.WorldRequestData.BlockData])]
+            else:
+                changes = req[1][config.WorldRequestData.BlockChanges]
+            self.log.info("Received Set Blocks request from client '{}' for {} blocks".format(cli_name, len(changes)))
+
+            try:
+                deltas = self.set_blocks(changes)
+                response[0] = req[0]
+                if req[0] is config.WorldRequests.SetBlocksReq:
+                    response[1] = {config.WorldRequestData.Deltas: deltas}
+            except Exception as e:
+                self.log.warning("Failed to set blocks.")
+                self.log.debug(e)
+                response[0] = config.WorldRequests.FailedReq
+
+        elif req[0] == config.WorldRequests.StatsReq:
+            self.log.info("Received Stats request from client '{}'".format(cli_name))
+            response[0] = req[0]
+            response[1] = {config.WorldRequestData.Stats: dict(self.__metrics__.snapshot(), cache=self.cache_stats(), shard=self.shard)}
+
+        self.__flush_events__() # Events the request caused go out before its reply, so a client sees them once the reply arrives unless its pipe is full.
         self.log.debug("Replying with: {}".format(response))
-        cli.send(tuple(response))
+        self.__metrics__.sent(req[0], self.__codec__.send(cli, tuple(response) + tuple(req[2:3]))) # Send the request ID back if there was one, so the client can match the reply to the request.
 
 
     def run(self):
         """The main loop for the WorldDataServer. It waits for messages from clients, then passes the requests to handle_requests. Since this is not multithreaded or multiprocessed all world modifications happen syncronously."""
+        last_save = time()
         while self.__running__.value:
-            ready = mp.connection.wait(self.__connections__.keys(), timeout=config.WorldDataServer.ConnectionWaitTime)
+            if time() - last_save >= config.WorldDataServer.SaveInterval:
+                self.save()
+                last_save = time()
+            self.cool_idle()
+            if self.__metrics__.dump_due():
+                self.log.log(config.Metrics.DumpLevel, "Request metrics:\n{}\nCache: {}".format(self.__metrics__.format(), self.cache_stats()))
+
+            waiting = self.__flush_events__()
+            ready = mp.connection.wait(self.__connections__.keys(), timeout=config.WorldDataServer.EventFlushTime if waiting else config.WorldDataServer.ConnectionWaitTime)
             for cli in ready:
                 name = self.__connections__[cli]
                 try:
-                    req = cli.recv()
+                    req, nbytes = self.__codec__.recv_sized(cli)
                 except EOFError:
                     if name == config.WorldDataServer.MainConnectionName:
                         self.log.info("WorldDataServer: Main connection closed, exiting.")
-                        self.running = False
+                        self.__running__.value = False
                         break
                     else:
                         del self.__connections__[cli]
+                        self.__subscribers__.pop(cli, None)
+                        self.__event_queues__.pop(cli, None)
+                        self.release_claims(name)
                         self.log.info("WorldDataServer: Client closed connection, '{}'".format(name))
                         continue
+                start = time()
+                self.__metrics__.received(req[0], nbytes)
                 self.handle_request(cli, req)
+                self.__metrics__.finished(req[0], time() - start, start - req[3] if len(req) > 3 else None)
+
+        if self.__shared_chunks__ is not None:
+            self.__shared_chunks__.close()
+        if self.__regions__ is not None:
+            self.save()
+            self.__regions__.close()
+
+
+class ShardedWorldDataServer:
+    """Splits the world between config.WorldDataServer.Shards WorldDataServer processes, so requests for chunks in different regions are handled in parallel. It is started, stopped and connected to just like a WorldDataServer.
+    Each shard owns whole regions (see shard_of), so it is the only process that reads and writes their region files."""
+    def __init__(self, parent_log, shards=None):
+        """parent_log: The logging.getLogger() object that will be the parent for the shards' logs.
+        shards: How many WorldDataServer processes to split the world between. Defaults to config.WorldDataServer.Shards."""
+        if shards is None:
+            shards = config.WorldDataServer.Shards
+        self.shards = [WorldDataServer(parent_log, shard=i, shards=shards) for i in range(shards)]
+
+
+    def start(self):
+        """Start every shard."""
+        for shard in self.shards:
+            shard.start()
+
+
+    def stop(self):
+        """Stop every shard. They are all told to stop before waiting for any of them."""
+        for shard in self.shards:
+            shard.__running__.value = False
+        for shard in self.shards:
+            shard.stop()
+
+
+    def join(self, timeout=None):
+        for shard in self.shards:
+            shard.join(timeout)
+
+
+    def get_main_client(self):
+        """Return the main client to the starting process."""
+        return ShardedWorldDataClient([shard.get_main_client() for shard in self.shards])
+
+
+def make_world_server(parent_log):
+    """Create the WorldDataServer, or a ShardedWorldDataServer if config.WorldDataServer.Shards is more than 1."""
+    if config.WorldDataServer.Shards > 1:
+        return ShardedWorldDataServer(parent_log)
+    return WorldDataServer(parent_log)
 
 
 class TestWorldDataServer(unittest.TestCase):
@@ -361,6 +1441,10 @@ class TestWorldDataServer(unittest.TestCase):
         l.setLevel(logging.DEBUG)
         self.log = l
 
+        self.save_directory = tempfile.TemporaryDirectory()
+        self.orig_save_directory = config.WorldDataServer.SaveDirectory
+        config.WorldDataServer.SaveDirectory = self.save_directory.name
+
         self.world_server = WorldDataServer(self.log)
         self.world_client = self.world_server.get_main_client()
         self.world_server.start()
@@ -368,6 +1452,8 @@ class TestWorldDataServer(unittest.TestCase):
     def tearDown(self):
         self.world_server.stop()
         self.world_server.join()
+        config.WorldDataServer.SaveDirectory = self.orig_save_directory
+        self.save_directory.cleanup()
 
     def test_ping(self):
         res = self.world_client.ping()
@@ -415,6 +1501,393 @@ class TestWorldDataServer(unittest.TestCase):
         res = self.world_client.is_generated(0, 0)
         self.assertTrue(res)
 
+    def test_batches(self):
+        chunk = Chunk()
+        chunk.set_block(0, 0, 0, Block(config.BlockType.Grass))
+        res = self.world_client.init_chunks({(0, 0): chunk, (1, 0): chunk})
+        self.assertEqual(res, {(0, 0): False, (1, 0): False})
+        res = self.world_client.init_chunks({(1, 0): chunk, (2, 0): chunk})
+        self.assertEqual(res, {(1, 0): True, (2, 0): False})
+
+        res = self.world_client.is_generated_many([(0, 0), (2, 0), (3, 0)])
+        self.assertEqual(res, {(0, 0): True, (2, 0): True, (3, 0): False})
+
+        res = self.world_client.get_chunks([(0, 0), (3, 0)])
+        self.assertEqual(res[(0, 0)], chunk)
+        self.assertFalse(res[(3, 0)].is_generated())
+
+    def test_pipelined(self):
+        chunk = Chunk()
+        chunk.set_block(0, 0, 0, Block(config.BlockType.Grass))
+        init = self.world_client.init_chunk(0, 0, chunk, block=False)
+        generated = self.world_client.is_generated(0, 0, block=False)
+        ping = self.world_client.ping(block=False)
+        self.assertIn(config.WorldRequestData.Pong, ping.result(timeout=5))
+        self.assertTrue(init.done())
+        self.assertFalse(init.result())
+        self.assertTrue(generated.result())
+        self.assertEqual(self.world_client.poll(), 0)
+
+    def test_asyncio(self):
+        async def get():
+            self.world_client.add_to_event_loop(asyncio.get_running_loop())
+            return await asyncio.wait_for(self.world_client.ping(block=False), 5)
+        res = asyncio.run(get())
+        self.assertIn(config.WorldRequestData.Pong, res)
+
+    def test_lookups_dont_store(self):
+        server = WorldDataServer(self.log) # Not started, so its methods can be called directly.
+        self.assertFalse(server.is_generated(5, 5))
+        self.assertFalse(server.get_chunk(5, 5).is_generated())
+        self.assertEqual(len(server.__chunks__), 0)
+        chunk = Chunk()
+        chunk.set_block(0, 0, 0, Block(config.BlockType.Grass))
+        server.set_chunk(6, 5, chunk)
+        self.assertTrue(server.is_generated(6, 5))
+        self.assertNotIn((5, 5), server.__chunks__)
+
+    def test_evict(self):
+        orig = config.WorldDataServer.MaxResidentChunks, config.WorldDataServer.MaxColdChunks
+        config.WorldDataServer.MaxResidentChunks = 2
+        config.WorldDataServer.MaxColdChunks = 0
+        try:
+            server = WorldDataServer(self.log) # Not started, so its methods can be called directly.
+            server.__regions__ = region_files.RegionStore(os.path.join(self.save_directory.name, 'evict'))
+            chunks = []
+            for i in range(4):
+                chunk = Chunk()
+                chunk.set_block(i, i, i, Block(config.BlockType.Grass))
+                server.set_chunk(i, 0, chunk)
+                chunks.append(chunk)
+            self.assertEqual(len(server.__chunks__), 2)
+            self.assertEqual(server.get_chunk(3, 0), chunks[3])
+            self.assertEqual(server.get_chunk(0, 0), chunks[0]) # Loaded back from disk, which drops (2, 0).
+            self.assertNotIn((2, 0), server.__chunks__)
+            stats = server.cache_stats()
+            self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['resident'], stats['cold']), (1, 1, 3, 2, 0))
+            server.__regions__.close()
+        finally:
+            config.WorldDataServer.MaxResidentChunks, config.WorldDataServer.MaxColdChunks = orig
+
+    def test_cold(self):
+        server = WorldDataServer(self.log) # Not started, so its methods can be called directly.
+        chunk = Chunk()
+        chunk.set_block(1, 2, 3, Block(config.BlockType.Grass))
+        server.set_chunk(1, 1, chunk)
+        server.cool_idle()
+        self.assertIn((1, 1), server.__chunks__)
+
+        server.__used__[(1, 1)] -= config.WorldDataServer.ColdChunkAge
+        server.cool_idle()
+        self.assertNotIn((1, 1), server.__chunks__)
+        self.assertIn((1, 1), server.__cold__)
+        self.assertEqual(server.get_chunk(1, 1), chunk)
+        self.assertIn((1, 1), server.__chunks__)
+        stats = server.cache_stats()
+        self.assertEqual((stats['cold_hits'], stats['cooled'], stats['cold']), (1, 1, 0))
+
+    def test_procedural(self):
+        server = WorldDataServer(self.log) # Not started, so its methods can be called directly.
+        server.__regions__ = region_files.RegionStore(os.path.join(self.save_directory.name, 'procedural'))
+        generator = generations.SimplexHeight
+        self.assertTrue(server.init_chunk(4, 5, ProceduralChunk('SimplexHeight', 4, 5)))
+        self.assertFalse(server.init_chunk(4, 5, ProceduralChunk('SimplexHeight', 4, 5)))
+        self.assertTrue(server.is_generated(4, 5))
+        self.assertEqual(server.get_heightmap(4, 5).tolist(), generator.top_blocks(4, 5).tolist())
+        self.assertEqual(server.cache_stats()['materialized'], 0) # The heightmap didn't need the blocks.
+
+        chunk = server.get_chunk(4, 5)
+        self.assertEqual(chunk, generator.generate(4, 5, None))
+        server.set_blocks([((4 * config.WorldDataServer.ChunkSize, 250, 5 * config.WorldDataServer.ChunkSize), Block(config.BlockType.Water))])
+        edited = Chunk.from_bytes(chunk.to_bytes())
+        version = chunk.get_version()
+
+        # Cooling drops the blocks entirely, and they are made again with the edit when they're used.
+        server.__used__[(4, 5)] -= config.WorldDataServer.ColdChunkAge
+        server.cool_idle()
+        self.assertNotIn((4, 5), server.__chunks__)
+        self.assertNotIn((4, 5), server.__cold__)
+        self.assertEqual(server.get_heightmap(4, 5)[0, 0], 250)
+        self.assertEqual(server.get_chunk(4, 5), edited)
+        self.assertEqual(server.cache_stats()['materialized'], 2)
+        self.assertEqual(server.get_chunk(4, 5).get_version(), version)
+
+        # Saved as the ProceduralChunk, not its blocks.
+        server.save()
+        self.assertEqual(server.__regions__.load(4, 5), server.__procedural__[(4, 5)])
+
+        # A chunk that is set normally isn't procedural any more.
+        server.set_chunk(4, 5, Chunk())
+        self.assertNotIn((4, 5), server.__procedural__)
+        server.__regions__.close()
+
+    def test_save(self):
+        chunk = Chunk()
+        chunk.set_block(1, 2, 3, Block(config.BlockType.Grass))
+        res = self.world_client.set_chunk(2, -3, chunk)
+        self.assertFalse(res)
+
+        self.world_server.stop()
+        self.world_server = WorldDataServer(self.log)
+        self.world_client = self.world_server.get_main_client()
+        self.world_server.start()
+
+        self.assertTrue(self.world_client.is_generated(2, -3))
+        res = self.world_client.get_chunk(2, -3)[config.WorldRequestData.ChunkData]
+        self.assertEqual(chunk, res)
+
+        # Replacing it with an ungenerated chunk has to remove it from disk too.
+        self.world_client.set_chunk(2, -3, Chunk())
+        self.world_server.stop()
+        self.world_server = WorldDataServer(self.log)
+        self.world_client = self.world_server.get_main_client()
+        self.world_server.start()
+        self.assertFalse(self.world_client.is_generated(2, -3))
+
+    def test_subscribe(self):
+        other = self.world_client.new_client()[config.WorldRequestData.NewClient]
+        chunk = Chunk()
+        chunk.set_block(1, 2, 3, Block(config.BlockType.Grass))
+        self.assertFalse(self.world_client.subscribe([config.ChunkEvents.Generated, config.ChunkEvents.Modified]))
+
+        other.set_chunk(4, 4, chunk)
+        other.set_chunk(4, 4, chunk)
+        self.world_client.ping()
+        self.assertEqual(self.world_client.get_events(), [(config.ChunkEvents.Generated, (4, 4)), (config.ChunkEvents.Modified, (4, 4))])
+        self.assertEqual(self.world_client.get_events(), [])
+
+        self.assertFalse(self.world_client.unsubscribe([config.ChunkEvents.Modified]))
+        other.set_chunk(4, 4, chunk)
+        other.set_chunk(5, 4, chunk)
+        self.world_client.ping()
+        self.assertEqual(self.world_client.get_events(), [(config.ChunkEvents.Generated, (5, 4))])
+
+    def test_read_cache(self):
+        other = self.world_client.new_client()[config.WorldRequestData.NewClient]
+        chunk = Chunk()
+        chunk.set_block(1, 2, 3, Block(config.BlockType.Grass))
+        other.set_chunk(0, 0, chunk)
+        self.assertEqual(self.world_client.get_chunk(0, 0)[config.WorldRequestData.ChunkData], chunk)
+        self.assertEqual(self.world_client.get_chunks([(0, 0)]), {(0, 0): chunk})
+        self.assertEqual(self.world_client.cache_stats(), {'local': 1, 'unchanged': 0, 'fetched': 1, 'cached': 1})
+
+        chunk.set_block(1, 2, 3, Block(config.BlockType.Water))
+        other.set_chunk(0, 0, chunk)
+        self.assertEqual(self.world_client.get_chunk(0, 0)[config.WorldRequestData.ChunkData], chunk)
+        self.assertEqual(self.world_client.cache_stats()['fetched'], 2)
+
+    def test_read_cache_pipe(self):
+        orig = config.WorldDataServer.SharedMemory
+        config.WorldDataServer.SharedMemory = False
+        server = WorldDataServer(self.log)
+        client = server.get_main_client()
+        server.start()
+        try:
+            chunk = Chunk()
+            chunk.set_block(1, 2, 3, Block(config.BlockType.Grass))
+            client.set_chunk(0, 0, chunk)
+            self.assertEqual(client.get_chunk(0, 0)[config.WorldRequestData.ChunkData], chunk)
+            self.assertEqual(client.get_chunks([(0, 0), (0, 1)])[(0, 0)], chunk)
+            self.assertEqual(client.cache_stats(), {'local': 0, 'unchanged': 1, 'fetched': 2, 'cached': 2})
+
+            client.subscribe([config.ChunkEvents.Modified])
+            chunk.set_block(1, 2, 3, Block(config.BlockType.Water))
+            other = client.new_client()[config.WorldRequestData.NewClient]
+            other.set_chunk(0, 0, chunk)
+            client.get_events()
+            self.assertEqual(client.cache_stats()['cached'], 1)
+            self.assertEqual(client.get_chunk(0, 0)[config.WorldRequestData.ChunkData], chunk)
+        finally:
+            server.stop()
+            config.WorldDataServer.SharedMemory = orig
+
+    def test_claim_chunks(self):
+        other = self.world_client.new_client()[config.WorldRequestData.NewClient]
+        self.assertEqual(self.world_client.claim_chunks([(0, 0), (0, 1)]), {(0, 0): True, (0, 1): True})
+        self.assertEqual(other.claim_chunks([(0, 0), (0, 2)]), {(0, 0): False, (0, 2): True})
+        self.assertEqual(self.world_client.claim_chunks([(0, 0)]), {(0, 0): True}) # Claiming again renews the claim.
+
+        chunk = Chunk()
+        chunk.set_block(1, 2, 3, Block(config.BlockType.Grass))
+        self.assertEqual(self.world_client.init_chunks({(0, 0): chunk}), {(0, 0): False})
+        self.assertEqual(other.claim_chunks([(0, 0)]), {(0, 0): False})
+
+        server = WorldDataServer(self.log) # Not started, so its methods can be called directly.
+        orig = config.WorldDataServer.ClaimTimeout
+        config.WorldDataServer.ClaimTimeout = 0
+        try:
+            self.assertEqual(server.claim_chunks([(5, 5)], 'a'), {(5, 5): True})
+            self.assertEqual(server.claim_chunks([(5, 5)], 'b'), {(5, 5): True}) # a's claim ran out.
+        finally:
+            config.WorldDataServer.ClaimTimeout = orig
+        server.release_claims('b')
+        self.assertEqual(server.claim_chunks([(5, 5)], 'a'), {(5, 5): True})
+        self.assertEqual(server.claim_chunks([(5, 5)], 'b'), {(5, 5): False})
+
+    def test_set_blocks(self):
+        other = self.world_client.new_client()[config.WorldRequestData.NewClient]
+        other.subscribe([config.ChunkEvents.Generated, config.ChunkEvents.Edited])
+        chunk = Chunk()
+        chunk.set_block(1, 2, 3, Block(config.BlockType.Grass))
+        self.world_client.set_chunk(0, 0, chunk)
+
+        self.assertEqual(self.world_client.get_block(1, 2, 3), Block(config.BlockType.Grass))
+        self.assertFalse(self.world_client.set_block(1, 2, 3, Block(config.BlockType.Water)))
+        self.assertEqual(self.world_client.get_block(1, 2, 3), Block(config.BlockType.Water))
+
+        # Edits to a chunk that isn't generated yet are refused, and nothing else in the request changes.
+        M = config.WorldDataServer.ChunkSize
+        changes = [((4, 5, 6), Block(config.BlockType.Grass)), ((-1, 5, 6), Block(config.BlockType.Grass)), ((1, 2, 3), Block(config.BlockType.Water))]
+        self.assertIsNone(self.world_client.set_blocks(changes))
+        self.assertTrue(self.world_client.set_block(-1, 5, 6, Block(config.BlockType.Grass)))
+        self.assertFalse(self.world_client.is_generated(-1, 0))
+        self.assertEqual(self.world_client.get_block(4, 5, 6), Block(config.BlockType.Empty))
+
+        generated = Chunk()
+        generated.mark_generated()
+        self.world_client.set_chunk(-1, 0, generated)
+        deltas = self.world_client.set_blocks(changes)
+        self.assertEqual(set(deltas), {(0, 0), (-1, 0)})
+        self.assertEqual(deltas[(0, 0)][0].tolist(), [[4, 5, 6]])
+        self.assertEqual(deltas[(-1, 0)][0].tolist(), [[M - 1, 5, 6]])
+
+        # A subscriber can keep its own copy up to date from the deltas alone.
+        other.ping()
+        events = other.get_events(deltas=True)
+        self.assertIn((config.ChunkEvents.Generated, (-1, 0), None), events)
+        for event, pos, delta in events:
+            if event is config.ChunkEvents.Edited and pos == (0, 0):
+                chunk.set_blocks(*delta)
+        self.assertEqual(self.world_client.get_chunk(0, 0)[config.WorldRequestData.ChunkData], chunk)
+
+    def test_event_queue(self):
+        server = WorldDataServer(self.log) # Not started, so its methods can be called directly.
+        ours, theirs = mp.Pipe(True)
+        server.__subscribers__[ours] = {config.ChunkEvents.Generated}
+        client = WorldDataClient('Events', theirs, self.log)
+
+        # Nothing reads the pipe, so events have to wait in the queue once it's full instead of blocking the server.
+        count = 20000
+        for i in range(count):
+            server.__notify__(config.ChunkEvents.Generated, i, 0)
+        self.assertTrue(server.__flush_events__())
+        self.assertGreater(len(server.__event_queues__[ours]), 0)
+
+        received = []
+        while server.__flush_events__():
+            received.extend(pos for _, pos in client.get_events())
+        received.extend(pos for _, pos in client.get_events())
+        self.assertEqual(received, [(i, 0) for i in range(count)])
+
+        orig = config.WorldDataServer.MaxQueuedEvents
+        config.WorldDataServer.MaxQueuedEvents = 10
+        try:
+            for i in range(count):
+                server.__notify__(config.ChunkEvents.Generated, i, 0)
+            self.assertNotIn(ours, server.__subscribers__)
+            self.assertNotIn(ours, server.__event_queues__)
+        finally:
+            config.WorldDataServer.MaxQueuedEvents = orig
+
+
+    def test_stats(self):
+        self.world_client.ping()
+        self.world_client.ping(block=False).result()
+        stats = self.world_client.get_stats()
+        pings = stats['requests'][config.WorldRequests.PingReq.value]
+        self.assertEqual(pings['count'], 2)
+        self.assertEqual(pings['queue']['count'], 2)
+        self.assertGreater(pings['bytes_received'], 0)
+        self.assertIn('resident', stats['cache'])
+
+        local = self.world_client.local_stats()['requests']
+        self.assertEqual(local[config.WorldRequests.PingReq.value]['count'], 2)
+        self.assertEqual(local[config.WorldRequests.StatsReq.value]['bytes_sent'], stats['requests'][config.WorldRequests.StatsReq.value]['bytes_received'])
+
+    def test_get_heightmap(self):
+        chunk = Chunk()
+        chunk.set_block(1, 7, 2, Block(config.BlockType.Grass))
+        res = self.world_client.set_chunk(0, 0, chunk)
+        self.assertFalse(res)
+
+        res = self.world_client.get_heightmap(0, 0)
+        self.assertIsNotNone(res)
+        self.assertEqual(res[1, 2], 7)
+        self.assertEqual(res[0, 0], -1)
+
+
+class TestShardedWorldDataServer(unittest.TestCase):
+    def setUp(self):
+        l = logging.getLogger("TestShardedWorldDataServer")
+        fh = logging.FileHandler(config.TestingLog)
+        ff = logging.Formatter(config.LogFormat)
+        fh.setFormatter(ff)
+        l.addHandler(fh)
+        l.setLevel(logging.DEBUG)
+        self.log = l
+
+        self.save_directory = tempfile.TemporaryDirectory()
+        self.orig_save_directory = config.WorldDataServer.SaveDirectory
+        config.WorldDataServer.SaveDirectory = self.save_directory.name
+
+        self.world_server = ShardedWorldDataServer(self.log, shards=3)
+        self.world_client = self.world_server.get_main_client()
+        self.world_server.start()
+
+        # One chunk in each of a few regions, so every shard has some.
+        size = config.WorldDataServer.RegionSize
+        self.positions = [(rx * size + 1, ry * size + 2) for rx in range(-2, 2) for ry in range(-2, 2)]
+        self.chunks = {}
+        for i, pos in enumerate(self.positions):
+            chunk = Chunk()
+            chunk.set_block(i % config.WorldDataServer.ChunkSize, i, 0, Block(config.BlockType.Grass))
+            self.chunks[pos] = chunk
+
+    def tearDown(self):
+        self.world_server.stop()
+        config.WorldDataServer.SaveDirectory = self.orig_save_directory
+        self.save_directory.cleanup()
+
+    def test_shard_of(self):
+        shards = set(shard_of(cx, cy, 3) for cx, cy in self.positions)
+        self.assertEqual(shards, {0, 1, 2})
+        size = config.WorldDataServer.RegionSize
+        self.assertEqual(shard_of(0, 0, 3), shard_of(size - 1, size - 1, 3))
+
+    def test_ping(self):
+        self.assertEqual(self.world_client.ping(), {config.WorldRequestData.Pong: 'pong'})
+
+    def test_batches(self):
+        res = self.world_client.init_chunks(self.chunks)
+        self.assertEqual(res, {pos: False for pos in self.positions})
+        res = self.world_client.is_generated_many(self.positions + [(1000, 1000)])
+        self.assertFalse(res.pop((1000, 1000)))
+        self.assertEqual(res, {pos: True for pos in self.positions})
+        res = self.world_client.get_chunks(self.positions)
+        self.assertEqual(res, self.chunks)
+        self.assertEqual(self.world_client.get_chunks([]), {})
+
+    def test_new_client(self):
+        other = self.world_client.new_client('other')[config.WorldRequestData.NewClient]
+        self.assertFalse(self.world_client.subscribe([config.ChunkEvents.Generated]))
+        for pos, chunk in self.chunks.items():
+            self.assertFalse(other.set_chunk(*pos, chunk))
+        for pos, chunk in self.chunks.items():
+            self.assertTrue(self.world_client.is_generated(*pos))
+            self.assertEqual(self.world_client.get_chunk(*pos)[config.WorldRequestData.ChunkData], chunk)
+        self.world_client.ping()
+        self.assertCountEqual(self.world_client.get_events(), [(config.ChunkEvents.Generated, pos) for pos in self.positions])
+
+    def test_save(self):
+        self.world_client.init_chunks(self.chunks)
+        self.world_server.stop()
+        self.world_server = ShardedWorldDataServer(self.log, shards=3)
+        self.world_client = self.world_server.get_main_client()
+        self.world_server.start()
+        self.assertEqual(self.world_client.get_chunks(self.positions), self.chunks)
+        for shard in self.world_server.shards:
+            self.assertEqual(shard.__generated__, set(pos for pos in self.positions if shard_of(*pos, 3) == shard.shard))
+
 
 class TestWorldDataClient(unittest.TestCase):
     @classmethod
@@ -3,18 +3,31 @@ from time import sleep, time
 import queue
 from queue import Empty as QueueEmpty
 import multiprocessing as mp
-from world_data import WorldDataServer, WorldDataClient
+from world_data import WorldDataServer, WorldDataClient, ShardedWorldDataClient
 import config
 from block import Block
 from chunk import Chunk
+from procedural import ProceduralChunk
+from scheduler import ChunkScheduler
 import generations
 
 
+def task_of(cx, cy):
+    """Returns the (tx, ty) of the config.WorldGenerator.TaskSize square of chunks that chunk (cx, cy) is generated with."""
+    return (cx // config.WorldGenerator.TaskSize, cy // config.WorldGenerator.TaskSize)
+
+
+def task_chunks(tx, ty):
+    """Returns the [(cx, cy), ...] of every chunk in task (tx, ty)."""
+    size = config.WorldGenerator.TaskSize
+    return [(tx * size + ox, ty * size + oy) for ox in range(size) for oy in range(size)]
+
+
 class WorldGenerator:
     """Controls WorldGeneratorSlaves and handles requesting chunks. An instance of this is held by the main game thread."""
     def __init__(self, world_client, parent_log):
         """Parameters:
-            world_client (WorldDataClient): An instance of WorldDataClient that can be used to access the world data.
+            world_client (WorldDataClient): An instance of WorldDataClient (or ShardedWorldDataClient) that can be used to access the world data.
             parent_log (logging.Logger): The logger that the calling function uses.
         """
         self.__running__ = mp.Value('b', True) # Used to stop any running threads.
@@ -22,14 +35,14 @@ class WorldGenerator:
         self.log = self.parent_log.getChild("WorldGenerator")
         self.log.setLevel(config.WorldGenerator.LogLevel)
         self.world_client = world_client # Used to access the world data
-        self.chunks_to_generate = mp.Queue(config.WorldGenerator.RequestQueueSize) # A queue of chunks to generate.
+        self.chunks_to_generate = ChunkScheduler(config.WorldGenerator.RequestQueueSize, config.WorldGenerator.TaskSize) # Tasks (tx, ty) to generate, nearest the player first. See task_of.
         self.recently_requested = {} # dict[(cx, cy)] = time.time(); A list of chunks that have been recently requested and the time requested. These won't be requested again until removed.
 
         self.generators = []
         for i in range(config.WorldGenerator.Processes):
             response = self.world_client.new_client('WorldGenerator({})'.format(i))
             world_client = response[config.WorldRequestData.NewClient]
-            assert isinstance(world_client, WorldDataClient), ""
+            assert isinstance(world_client, (WorldDataClient, ShardedWorldDataClient)), ""
             self.generators.append(WorldGenerationSlave(self.__running__, world_client, self.log, self.chunks_to_generate))
 
 
@@ -52,13 +65,27 @@ class WorldGenerator:
 
         Parameters: Ignores all arguments"""
         self.log.info("Cleaning recently requested")
-        for (cx, cy), t in self.recently_requested.items():
+        for (cx, cy), t in list(self.recently_requested.items()):
             if time() - t >= config.WorldGenerator.RecentlyRequested:
                 del self.recently_requested[(cx, cy)]
 
 
+    def recenter(self, cx, cy):
+        """Tell the generator the player is now in chunk (cx, cy). Queued tasks nearest it are generated first and ones that are entirely further than config.WorldGenerator.Distance are cancelled, so they can be requested again if the player comes back."""
+        for tx, ty in self.chunks_to_generate.recenter(cx, cy, config.WorldGenerator.Distance):
+            self.log.info("Cancelled task ({}, {}).".format(tx, ty))
+            self.forget_task(tx, ty)
+
+
+    def forget_task(self, tx, ty):
+        """Remove every chunk in task (tx, ty) from recently_requested."""
+        for pos in task_chunks(tx, ty):
+            self.recently_requested.pop(pos, None)
+
+
     def request_chunk(self, cx, cy):
-        """If a chunk has not been recently requested (config.WorldGenerator.RecentlyRequested) then request it to be generated.
+        """If a chunk has not been recently requested (config.WorldGenerator.RecentlyRequested) then request it to be generated, along with the rest of its task (see task_of). Every chunk in the task counts as recently requested.
+        If the queue is full the task furthest from the player is dropped for it, unless this one is further.
         Also calls garbage_collect_recently_requested if the size is above maximum.
 
         Parameters:
@@ -69,10 +96,16 @@ class WorldGenerator:
         if len(self.recently_requested) > config.WorldGenerator.MaxRecentChunksStored:
             self.log.warning("Had to clean up recently_requested on main process because size is {}".format(len(self.recently_requested)))
             self.garbage_collect_recently_requested()
+        tx, ty = task_of(cx, cy)
         try:
-            self.chunks_to_generate.put((cx, cy), block=False)
-            self.log.info("Requested chunk ({}, {}).".format(cx, cy))
-            self.recently_requested[(cx, cy)] = time()
+            dropped = self.chunks_to_generate.put((tx, ty))
+            self.log.info("Requested chunk ({}, {}) as task ({}, {}).".format(cx, cy, tx, ty))
+            now = time()
+            for pos in task_chunks(tx, ty):
+                self.recently_requested[pos] = now
+            if dropped is not None:
+                self.log.warning("Generation queue is full, dropped the furthest task {}".format(dropped))
+                self.forget_task(*dropped)
         except queue.Full:
             self.log.warning("Generation queue is full, dropping request for chunk ({}, {})".format(cx ,cy))
 
@@ -88,20 +121,73 @@ class WorldGenerationSlave(mp.Process):
 
 
     def run(self):
-        """The loop that generation slaves execute."""
+        """The loop that generation slaves execute. Takes up to config.WorldGenerator.BatchSize queued tasks at a time, nearest the player first, so claiming and initializing all their chunks only takes one request to the WorldDataServer each.
+        Only chunks this slave claimed are generated, so no two slaves ever generate the same chunk. See generate_task for how they are generated.
+        The init_chunks request isn't waited for; its reply is handled while the next batch is generated."""
+        pending_init = None # (chunk positions, WorldRequestFuture) for the last init_chunks request.
         while self.__running__.value:
             try:
-                (cx, cy) = self.chunks_to_generate.get(timeout=config.WorldGenerator.WaitTime)
-            except QueueEmpty: continue
-
-            if self.world_client.is_generated(cx, cy): continue
-            generator = generations.pick_generation(cx, cy, self.world_client)
-            chunk = generator.generate(cx, cy, self.world_client)
-            res = self.world_client.init_chunk(cx, cy, chunk)
-            if res:
+                tasks = [self.chunks_to_generate.get(timeout=config.WorldGenerator.WaitTime)]
+            except QueueEmpty:
+                pending_init = self.finish_init(pending_init)
+                continue
+            while len(tasks) < config.WorldGenerator.BatchSize:
+                try:
+                    tasks.append(self.chunks_to_generate.get(block=False))
+                except QueueEmpty: break
+            positions = list(dict.fromkeys(pos for tx, ty in tasks for pos in task_chunks(tx, ty)))
+
+            claimed = self.world_client.claim_chunks(positions)
+            if claimed is None:
+                self.parent_log.warning("Failed to claim chunks, dropping tasks {}".format(tasks))
+                continue
+
+            chunks = {}
+            for tx, ty in dict.fromkeys(tasks):
+                chunks.update(self.generate_task([pos for pos in task_chunks(tx, ty) if claimed[pos]]))
+            if len(chunks) == 0: continue
+
+            self.finish_init(pending_init)
+            pending_init = (list(chunks), self.world_client.init_chunks(chunks, block=False))
+        self.finish_init(pending_init)
+
+
+    def generate_task(self, positions):
+        """Generate the chunks at positions, which must all be in one task. Chunks with the same generator are made with one call to Generation.generate_many, so the noise for them is made in one go. That is only done per task so the noise is never made for the space between tasks far apart.
+        Returns {(cx, cy): Chunk() or ProceduralChunk()} to send with init_chunks."""
+        by_generator = {} # {Generation: [(cx, cy), ...]}
+        for cx, cy in positions:
+            by_generator.setdefault(generations.pick_generation(cx, cy, self.world_client), []).append((cx, cy))
+
+        chunks = {}
+        for generator, generator_positions in by_generator.items():
+            procedural = generator.PROCEDURAL and config.WorldGenerator.Procedural
+            generated = {}
+            if not procedural or config.WorldGenerator.SendBlocks:
+                generated = generator.generate_many(generator_positions, self.world_client)
+            for cx, cy in generator_positions:
+                chunk = generated.get((cx, cy))
+                if chunk is not None:
+                    chunk.mark_generated() # So a chunk the generator left empty isn't generated again.
+                if procedural:
+                    chunk = ProceduralChunk(generator.__name__, cx, cy, chunk=chunk)
+                chunks[(cx, cy)] = chunk
+        return chunks
+
+
+    def finish_init(self, pending_init):
+        """Wait for the reply to an init_chunks request sent by run and log how it went.
+        pending_init: (chunk positions, WorldRequestFuture) or None.
+        Returns None."""
+        if pending_init is None: return None
+        positions, future = pending_init
+        res = future.result()
+        for cx, cy in positions:
+            if res is None or res[(cx, cy)]:
                 self.parent_log.info("Failed to initiate chunk ({}, {})".format(cx, cy))
             else:
                 self.parent_log.info("Successfully initiated chunk ({}, {})".format(cx, cy))
+        return None
 
 
 class TestWorldGeneration(unittest.TestCase):
@@ -114,6 +200,9 @@ class TestWorldGeneration(unittest.TestCase):
         l.setLevel(logging.DEBUG)
         self.log = l
 
+        self.orig_save_directory = config.WorldDataServer.SaveDirectory
+        config.WorldDataServer.SaveDirectory = None
+
         self.world_data = WorldDataServer(self.log)
         self.world_data.start()
         self.world_client = self.world_data.get_main_client()
@@ -123,6 +212,7 @@ class TestWorldGeneration(unittest.TestCase):
     def tearDown(self):
         self.world_data.stop()
         self.world_generator.stop()
+        config.WorldDataServer.SaveDirectory = self.orig_save_directory
 
 
     def test_request_chunk(self):
@@ -130,6 +220,35 @@ class TestWorldGeneration(unittest.TestCase):
         self.assertTrue((0, 0) in self.world_generator.recently_requested.keys())
         self.assertEqual((0, 0), self.world_generator.chunks_to_generate.get())
 
+        size = config.WorldGenerator.TaskSize
+        self.world_generator.request_chunk(size - 1, -1)
+        self.assertEqual((0, -1), self.world_generator.chunks_to_generate.get())
+        self.assertEqual(task_of(-size, size), (-1, 1))
+        self.assertEqual(len(task_chunks(0, -1)), size * size)
+        self.assertTrue(all(pos in self.world_generator.recently_requested for pos in task_chunks(0, -1)))
+        self.world_generator.request_chunk(0, -1)
+        self.assertTrue(self.world_generator.chunks_to_generate.empty())
+
+        self.world_generator.request_chunk(0, size)
+        self.world_generator.request_chunk(10 * size, 0)
+        self.world_generator.request_chunk(-size, 0)
+        self.world_generator.recenter(-size, 0)
+        self.assertEqual((-1, 0), self.world_generator.chunks_to_generate.get())
+        self.assertEqual((0, 1), self.world_generator.chunks_to_generate.get())
+        self.assertTrue(self.world_generator.chunks_to_generate.empty())
+        self.assertFalse((10 * size, 0) in self.world_generator.recently_requested)
+
+
+    def test_generate_task(self):
+        slave = self.world_generator.generators[0]
+        chunks = slave.generate_task(task_chunks(1, -1))
+        self.assertEqual(list(chunks), task_chunks(1, -1))
+        for (cx, cy), chunk in chunks.items():
+            self.assertTrue(chunk.is_generated())
+            if isinstance(chunk, ProceduralChunk):
+                chunk = chunk.materialize()
+            self.assertEqual(chunk, generations.pick_generation(cx, cy, None).generate(cx, cy, None))
+
 
     def test_slave_pickup(self):
         self.world_generator.start()
@@ -137,4 +256,5 @@ class TestWorldGeneration(unittest.TestCase):
         sleep(1)
         self.assertTrue(self.world_generator.chunks_to_generate.empty())
         self.assertTrue(self.world_client.is_generated(0, 0))
+        self.assertTrue(all(self.world_client.is_generated_many(task_chunks(0, 0)).values()))
 
@@ -0,0 +1,219 @@
+import struct, pickle, copyreg, unittest, io
+import multiprocessing as mp
+from multiprocessing.reduction import ForkingPickler
+import numpy as np
+import config
+from chunk import Chunk
+from block import Block
+
+
+"""How requests and replies are written to the pipes between WorldDataClients and the WorldDataServer.
+A message is always (config.WorldRequests, dict of config.WorldRequestData keys or None, request ID or None[, time.time() it was sent]) once it is decoded, so handle_request doesn't care which codec is used.
+Codecs' send returns how many bytes were written and recv_sized returns (message, bytes read), for metrics.RequestMetrics."""
+
+
+REQUESTS = tuple(config.WorldRequests) # The opcode of each request type is its index in here.
+OPCODES = {r: i for i, r in enumerate(REQUESTS)}
+DATA_KEYS = tuple(config.WorldRequestData) # Data keys are sent as their index in here instead of pickling the enum.
+DATA_KEY_IDS = {k: i for i, k in enumerate(DATA_KEYS)}
+
+RAW_OPCODE = 0xFF # The request type isn't a config.WorldRequests, so it is pickled in the body instead.
+HAS_ID = 1 # Flag set when the message has a request ID.
+HAS_POS = 2 # Flag set when the message has a config.WorldRequestData.ChunkPos, which goes in the header.
+HAS_BODY = 4 # Flag set when there is pickled data after the header.
+HAS_TIME = 8 # Flag set when the time the message was sent follows the header.
+
+HEADER = struct.Struct('<BBIiiIH') # opcode, flags, request ID, cx, cy, pickled body length, number of out-of-band buffers
+BUFFER_LENGTH = struct.Struct('<Q')
+SENT_AT = struct.Struct('<d')
+
+
+class Pickler(pickle.Pickler):
+    """A protocol 5 pickler that can also pickle what multiprocessing can, like the Connection in a new WorldDataClient. ForkingPickler itself can't take a buffer_callback."""
+    def __init__(self, file, buffer_callback):
+        super(Pickler, self).__init__(file, protocol=5, buffer_callback=buffer_callback)
+        self.dispatch_table = copyreg.dispatch_table.copy()
+        self.dispatch_table.update(ForkingPickler._extra_reducers)
+
+
+def make_codec():
+    """Create the codec config.WorldDataServer.WireProtocol says to use."""
+    if config.WorldDataServer.WireProtocol is config.WorldDataServer.WireProtocols.Binary:
+        return BinaryCodec()
+    return PickleCodec()
+
+
+class PickleCodec:
+    """Sends messages as pickled tuples, the same way Connection.send does. This is how the pipes worked originally."""
+    def send(self, pipe, msg):
+        data = ForkingPickler.dumps(msg)
+        pipe.send_bytes(data)
+        return len(data)
+
+
+    def recv_sized(self, pipe):
+        data = pipe.recv_bytes()
+        return (ForkingPickler.loads(data), len(data))
+
+
+    def recv(self, pipe):
+        return self.recv_sized(pipe)[0]
+
+
+class BinaryCodec:
+    """Sends messages as a fixed size header with the opcode, request ID and chunk position, followed by any other data pickled with protocol 5.
+    Large buffers like the numpy arrays in chunks are pickled out-of-band and put after the pickle as they are, so they are never pickled and the whole message is still a single send_bytes."""
+    def send(self, pipe, msg):
+        cmd, data = msg[0], msg[1]
+        req_id = msg[2] if len(msg) > 2 else None
+        sent_at = msg[3] if len(msg) > 3 else None
+
+        flags = 0
+        opcode = OPCODES.get(cmd, RAW_OPCODE) if isinstance(cmd, config.WorldRequests) else RAW_OPCODE
+        cx = cy = 0
+        if req_id is not None:
+            flags |= HAS_ID
+        else:
+            req_id = 0
+        if sent_at is not None:
+            flags |= HAS_TIME
+
+        body = None
+        if isinstance(data, dict):
+            body = {DATA_KEY_IDS.get(k, k): v for k, v in data.items() if k is not config.WorldRequestData.ChunkPos}
+            if config.WorldRequestData.ChunkPos in data:
+                flags |= HAS_POS
+                cx, cy = data[config.WorldRequestData.ChunkPos]
+            if len(body) == 0 and flags & HAS_POS:
+                body = None
+        elif data is not None:
+            body = data
+        if opcode == RAW_OPCODE:
+            body = (cmd, body)
+
+        pickled = b''
+        buffers = []
+        if body is not None or opcode == RAW_OPCODE:
+            flags |= HAS_BODY
+            f = io.BytesIO()
+            Pickler(f, buffers.append).dump(body)
+            pickled = f.getbuffer()
+
+        buffers = [b.raw() for b in buffers]
+        frame = bytearray(HEADER.pack(opcode, flags, req_id, cx, cy, len(pickled), len(buffers)))
+        if sent_at is not None:
+            frame += SENT_AT.pack(sent_at)
+        for b in buffers:
+            frame += BUFFER_LENGTH.pack(b.nbytes)
+        frame += pickled
+        for b in buffers:
+            frame += b
+        pipe.send_bytes(frame)
+        return len(frame)
+
+
+    def recv(self, pipe):
+        return self.recv_sized(pipe)[0]
+
+
+    def recv_sized(self, pipe):
+        frame = pipe.recv_bytes()
+        opcode, flags, req_id, cx, cy, length, count = HEADER.unpack_from(frame)
+        offset = HEADER.size
+        sent_at = None
+        if flags & HAS_TIME:
+            sent_at = SENT_AT.unpack_from(frame, offset)[0]
+            offset += SENT_AT.size
+        lengths = []
+        for i in range(count):
+            lengths.append(BUFFER_LENGTH.unpack_from(frame, offset)[0])
+            offset += BUFFER_LENGTH.size
+
+        buffers = []
+        start = offset + length
+        for n in lengths:
+            buffers.append(bytearray(memoryview(frame)[start:start+n])) # Copied so arrays unpickled from it can be changed.
+            start += n
+
+        body = None
+        if flags & HAS_BODY:
+            body = pickle.loads(memoryview(frame)[offset:offset+length], buffers=buffers)
+
+        if opcode == RAW_OPCODE:
+            cmd, body = body
+        else:
+            cmd = REQUESTS[opcode]
+
+        data = body
+        if isinstance(body, dict):
+            data = {DATA_KEYS[k] if isinstance(k, int) else k: v for k, v in body.items()}
+        if flags & HAS_POS:
+            if data is None: data = {}
+            data[config.WorldRequestData.ChunkPos] = (cx, cy)
+
+        size = len(frame)
+        if sent_at is not None:
+            return ((cmd, data, req_id if flags & HAS_ID else None, sent_at), size)
+        if flags & HAS_ID:
+            return ((cmd, data, req_id), size)
+        return ((cmd, data), size)
+
+
+class TestCodecs(unittest.TestCase):
+    def setUp(self):
+        self.a, self.b = mp.Pipe(True)
+
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+
+    def roundtrip(self, codec, msg):
+        codec.send(self.a, msg)
+        return codec.recv(self.b)
+
+
+    def test_binary(self):
+        codec = BinaryCodec()
+        tests = [
+            (config.WorldRequests.PingReq, None, 0),
+            (config.WorldRequests.PingReq, {config.WorldRequestData.Pong: 'pong'}, 1),
+            (config.WorldRequests.IsGenerated, {config.WorldRequestData.ChunkPos: (-3, 7)}, 2),
+            (config.WorldRequests.IsGenerated, {config.WorldRequestData.Boolean: True}, 3),
+            (config.WorldRequests.FailedReq, None),
+            ('not a request', {config.WorldRequestData.ChunkPos: (1, 2)}, 4),
+            (config.WorldRequests.NewClientReq, {'name': 'test'}, 5),
+            (config.WorldRequests.PingReq, None, 7, 1234.5),
+        ]
+        for msg in tests:
+            self.assertEqual(msg, self.roundtrip(codec, msg))
+
+
+    def test_binary_chunk(self):
+        codec = BinaryCodec()
+        chunk = Chunk()
+        chunk.set_block(1, 2, 3, Block(config.BlockType.Grass))
+        heightmap = np.arange(16, dtype=np.int16).reshape(4, 4)
+        msg = (config.WorldRequests.SetChunkReq, {config.WorldRequestData.ChunkPos: (4, 5), config.WorldRequestData.ChunkData: chunk, config.WorldRequestData.Heightmap: heightmap}, 6)
+        res = self.roundtrip(codec, msg)
+        self.assertEqual(res[1][config.WorldRequestData.ChunkData], chunk)
+        self.assertTrue(np.array_equal(res[1][config.WorldRequestData.Heightmap], heightmap))
+        res[1][config.WorldRequestData.ChunkData].set_block(1, 2, 3, Block(config.BlockType.Water))
+
+
+    def test_pickle(self):
+        codec = PickleCodec()
+        msg = (config.WorldRequests.IsGenerated, {config.WorldRequestData.ChunkPos: (-3, 7)}, 2)
+        self.assertEqual(msg, self.roundtrip(codec, msg))
+
+
+    def test_sizes(self):
+        for codec in (BinaryCodec(), PickleCodec()):
+            chunk = Chunk()
+            chunk.set_block(1, 2, 3, Block(config.BlockType.Grass))
+            msg = (config.WorldRequests.SetChunkReq, {config.WorldRequestData.ChunkPos: (4, 5), config.WorldRequestData.ChunkData: chunk}, 6)
+            sent = codec.send(self.a, msg)
+            res, received = codec.recv_sized(self.b)
+            self.assertEqual(res[1][config.WorldRequestData.ChunkData], chunk)
+            self.assertEqual(sent, received)
@@ -5,6 +5,7 @@ import queue, pyglet, time, unittest, logging
 import multiprocessing as mp
 import config, world_data
 import time
+from scheduler import ChunkScheduler
 
 
 class RenderedBatch:
@@ -24,12 +25,14 @@ class WorldRenderer(mp.Process):
 
         self.world_client = world_client
 
-        self.chunks_to_render = mp.Queue(config.WorldRenderer.MaxQueuedChunks) # (cx, cy): Chunks that are requested to be rendered.
+        self.chunks_to_render = ChunkScheduler(config.WorldRenderer.MaxQueuedChunks) # (cx, cy): Chunks that are requested to be rendered, nearest the player first.
         self.rendered_chunks = {} # (cx, cy): pyglet.graphics.Batch to draw
         self.requested = [] # (cx, cy): Chunks that have been requested and aren't drawn yet.
         self.finished_chunks = mp.Queue(maxsize=config.WorldRenderer.MaxFinishedChunks) # ((cx, cy), chunk_data): Chunks that have been pre-calculated but have yet to be saved to the GPU for drawing.
         self.rendering_chunk = None # ((cx, cy), render_data): The chunk that is being drawn over more than one frame.
         self.pending_chunks = [] # (cx, cy): Chunks that were attempted but something happened (like it wasn't generated yet).
+        self.retry_chunks = set() # (cx, cy): Pending chunks that failed for some other reason than not being generated (finished_chunks was full or the request failed). No Generated event will come for them, so they are retried every config.WorldRenderer.PendingWaitTime.
+        self.last_retry = 0 # time.time() retry_chunks were last retried.
         self.__running__ = mp.Value('b', False)
 
 
@@ -42,10 +45,7 @@ class WorldRenderer(mp.Process):
     def stop(self):
         """Stop the pre-calculation process."""
         self.__running__.value = False
-        while not self.chunks_to_render.empty():
-            try:
-                self.chunks_to_render.get(block=False)
-            except queue.Empty: pass
+        self.chunks_to_render.clear()
         while not self.finished_chunks.empty():
             try:
                 self.finished_chunks.get(block=False)
@@ -72,7 +72,7 @@ class WorldRenderer(mp.Process):
 
 
     def request_chunk(self, cx, cy, force=False):
-        """Put in a request for a chunk to be rendered.
+        """Put in a request for a chunk to be rendered. If the queue is full the queued chunk furthest from the player is dropped for it, unless this one is further.
         Parameters:
             force (boolean): False means never rerender a chunk."""
         if (cx, cy) in self.requested and not force:
@@ -81,26 +81,41 @@ class WorldRenderer(mp.Process):
 
         self.log.info("Requesting chunk ({}, {})".format(cx, cy))
         try:
-            self.chunks_to_render.put((cx, cy), block=False)
-            self.requested.append((cx, cy))
+            dropped = self.chunks_to_render.put((cx, cy))
+            if (cx, cy) not in self.requested:
+                self.requested.append((cx, cy))
+            if dropped is not None:
+                self.log.warning("Render queue is full, dropped the furthest chunk {}.".format(dropped))
+                if dropped in self.requested: # It isn't if it was queued again with force and finished since.
+                    self.requested.remove(dropped)
         except queue.Full:
             self.log.warning("Dropping request for chunk ({}, {}) because render queue is full.".format(cx, cy))
 
 
-    def calc_chunk_render_data(self, cx, cy):
+    def recenter(self, cx, cy):
+        """Tell the renderer the player is now in chunk (cx, cy). Queued chunks nearest it are rendered first. Requested chunks further than config.WorldRenderer.Distance are cancelled and forgotten, so they are requested again if the player comes back.
+        The renderer process drops its pending chunks that are out of range on its own."""
+        self.chunks_to_render.recenter(cx, cy, config.WorldRenderer.Distance)
+        self.requested = [pos for pos in self.requested if self.chunks_to_render.in_range(pos)]
+
+
+    def calc_chunk_render_data(self, cx, cy, chunk=None):
         """Get all the data necessary to create all the rendering data (vertices, colours, the chunk data...).
-        Add that data to the finished_chunks queue so the main thread can draw it."""
-        if self.world_client.is_generated(cx, cy):
-            batch_data = []
+        Add that data to the finished_chunks queue so the main thread can draw it.
+        chunk: The Chunk at (cx, cy) if it was already fetched from the WorldDataServer. Otherwise it is requested.
+        Returns True if the chunk couldn't be rendered yet, False otherwise."""
+        if chunk is None:
+            res = self.world_client.get_chunk(cx, cy)
+            if res is None or config.WorldRequestData.ChunkData not in res:
+                self.log.warning("Didn't receive chunk data, queuing for later.")
+                self.log.debug("Actually received: {}".format(res))
+                self.retry_chunks.add((cx, cy))
+                return True
+            chunk = res[config.WorldRequestData.ChunkData]
 
-            chunk = self.world_client.get_chunk(cx, cy)
+        if chunk.is_generated():
+            batch_data = []
             self.log.debug("Calculating render data for chunk ({}, {})".format(cx, cy))
-            if config.WorldRequestData.ChunkData not in chunk:
-                self.log.warning("Didn't receive chunk data, queuing for later.")
-                self.log.debug("Actually received: {}".format(chunk))
-                self.request_chunk(cx, cy)
-                return
-            chunk = chunk[config.WorldRequestData.ChunkData]
 
             for pos, block in chunk:
                 pos = self.world_client.chunk_block_to_abs_block(cx, cy, *pos)
@@ -108,13 +123,16 @@ class WorldRenderer(mp.Process):
 
             try:
                 self.finished_chunks.put([(cx, cy), batch_data], timeout=config.WorldRenderer.PutFinishedChunkTimeout)
+                self.retry_chunks.discard((cx, cy))
                 return False
 
             except queue.Full:
                 self.log.warning("Failed to put finished chunk into queue ({}, {}).".format(cx, cy))
+                self.retry_chunks.add((cx, cy))
                 return True
         else:
             self.log.info("Requested chunk isn't generated ({}, {})".format(cx, cy))
+            self.retry_chunks.discard((cx, cy))
             return True
 
 
@@ -171,7 +189,8 @@ class WorldRenderer(mp.Process):
             for i in range(config.WorldRenderer.TrashChunksOnFullFinishedQueue):
                 try:
                     (cx, cy), _ = self.finished_chunks.get(block=False)
-                    self.requested.remove((cx, cy))
+                    if (cx, cy) in self.requested:
+                        self.requested.remove((cx, cy))
                     if (cx, cy) in self.rendered_chunks:
                         del self.rendered_chunks[(cx, cy)]
                 except queue.Empty: break
@@ -182,7 +201,8 @@ class WorldRenderer(mp.Process):
             try:
                 self.rendering_chunk = self.finished_chunks.get(block=False)
                 self.log.info("Finished rendering chunk ({}, {}).".format(*self.rendering_chunk[0]))
-                self.requested.remove(self.rendering_chunk[0])
+                if self.rendering_chunk[0] in self.requested: # It isn't if it was cancelled by recenter after it was calculated.
+                    self.requested.remove(self.rendering_chunk[0])
             except queue.Empty: pass
             self.continue_rendering(config.WorldRenderer.MaxBlocksPerFrame - rendered_blocks)
 
@@ -198,20 +218,41 @@ class WorldRenderer(mp.Process):
             batch.batch.draw()
 
 
+    def render_generated(self):
+        """Render the pending chunks the WorldDataServer said were generated since this was last called, and retry the retry_chunks if they weren't tried in the last config.WorldRenderer.PendingWaitTime."""
+        ready = [pos for event, pos in self.world_client.get_events() if event is config.ChunkEvents.Generated and pos in self.pending_chunks]
+        if len(self.retry_chunks) > 0 and time.time() - self.last_retry >= config.WorldRenderer.PendingWaitTime:
+            self.last_retry = time.time()
+            ready.extend(pos for pos in self.retry_chunks if pos not in ready)
+        if len(ready) == 0: return
+
+        chunks = self.world_client.get_chunks(ready)
+        if chunks is None:
+            self.log.warning("Didn't receive pending chunks, retrying later.")
+            self.retry_chunks.update(ready)
+            return
+        for (cx, cy), chunk in chunks.items():
+            if not self.calc_chunk_render_data(cx, cy, chunk):
+                self.log.info("Finished pending chunk ({}, {}).".format(cx, cy))
+                self.pending_chunks.remove((cx, cy))
+
+
     def run(self):
-        """What the renderer process runs in the background. Receives chunk requests, gets the chunk data, pre-calculates vertex and colour arrays, sends the results to the main thread."""
+        """What the renderer process runs in the background. Receives chunk requests, gets the chunk data, pre-calculates vertex and colour arrays, sends the results to the main thread.
+        Chunks that aren't generated yet wait in pending_chunks until the WorldDataServer sends an event saying they were generated, or until the player moves too far from them. Pending chunks that failed for another reason are retried, see retry_chunks."""
+        self.world_client.subscribe([config.ChunkEvents.Generated])
         while self.__running__.value:
+            self.pending_chunks = [pos for pos in self.pending_chunks if self.chunks_to_render.in_range(pos)]
+            self.retry_chunks.intersection_update(self.pending_chunks)
+            self.render_generated()
+            wait = config.WorldRenderer.PendingWaitTime if len(self.pending_chunks) > 0 else config.WorldRenderer.WaitTime
             try:
-                cx, cy = self.chunks_to_render.get(timeout=config.WorldRenderer.WaitTime)
+                cx, cy = self.chunks_to_render.get(timeout=wait)
                 self.log.debug("Received chunk render request for ({}, {})".format(cx, cy))
-                if self.calc_chunk_render_data(cx, cy):
-                    self.log.info("Saving chunk to pending because render failed ({}, {})".format(cx, cy))
-                    self.pending_chunks.append((cx, cy))
 
-                for cx, cy in self.pending_chunks:
-                    if not self.calc_chunk_render_data(cx, cy):
-                        self.log.info("Finished pending chunk ({}, {}).".format(cx, cy))
-                        self.pending_chunks.remove((cx, cy))
+                if self.calc_chunk_render_data(cx, cy) and (cx, cy) not in self.pending_chunks:
+                    self.log.info("Saving chunk to pending until it is generated ({}, {})".format(cx, cy))
+                    self.pending_chunks.append((cx, cy))
             except queue.Empty: pass
 
 
@@ -272,6 +313,8 @@ class TestWorldRenderer(unittest.TestCase):
 
 
     def setUp(self):
+        self.orig_save_directory = config.WorldDataServer.SaveDirectory
+        config.WorldDataServer.SaveDirectory = None
         self.world_server = world_data.WorldDataServer(self.log)
         self.world_client = self.world_server.get_main_client()
         self.renderer = WorldRenderer(self.world_client, self.log)
@@ -281,6 +324,7 @@ class TestWorldRenderer(unittest.TestCase):
     def tearDown(self):
         self.world_server.stop()
         #self.world_server.join()
+        config.WorldDataServer.SaveDirectory = self.orig_save_directory
 
 
     def test_block_vertices(self):